@@ -1,8 +1,9 @@
 #!/usr/bin/python
 
 from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils.ibm_process import running_servers
+from ansible.module_utils.ibm_purge import find_tombstones, purge, purge_in_background, tombstone
 import subprocess as sp
-import shutil
 
 
 ANSIBLE_METADATA = {
@@ -25,8 +26,11 @@ description:
     - Module has many saftey checks to ensure that no harm can be done to fs
     - For this reason, was_root was forced to have choices, so that a user could not specify "/" or "/var" or "/var/messages", etc..
     - Module will check for any running IBM Java processes before attempting cleanup
+    - Running processes are found from logs/<server>/<server>.pid, each pid is verified through /proc
     - If module detects running processes it will fail
     - Module cleanups the following dirs: <WAS_Profile_Root>/temp, /wstemp, /workspace
+    - Each dir is renamed to a tombstone first, so the profile is usable straight away,
+    - then the tombstones are deleted by a bounded pool of worker threads
     - After dir is cleaned, then will clear classCache, and osgiCfgInit cache
     - Module will catch itsel and not clear cache if cleanup dirs are not present
 
@@ -43,6 +47,21 @@ options:
         - Required: True
         - Location of IBM install directory
 
+    workers:
+      description:
+        - Type: int
+        - Required: False
+        - Default: 8
+        - Number of threads unlinking files in parallel
+
+    background:
+      description:
+        - Type: bool
+        - Required: False
+        - Default: False
+        - Delete the tombstones in a detached background process and return straight away
+        - Files and bytes reclaimed are only reported when this is False
+
 author: Tommy Davison <tommy.davison@state.mn.us>
 '''
 
@@ -53,6 +72,12 @@ EXAMPLES='''
   cleanup:
     profile_name: AppSrv01
     was_root: /opt/WebSphere/AppServer
+-
+  name: Run WAS cleanup, deleting old workspace in the background
+  cleanup:
+    profile_name: AppSrv01
+    was_root: /opt/WebSphere/AppServer
+    background: True
 '''
 
 
@@ -60,16 +85,19 @@ def run_cleanup():
     """Function to run general cleanup of IBM Application server
 	Function will do the following saftey checks
 	1. Check to see if any running JAVA processes exist
-	if .pid files exist in <WAS_Profile_Root>/logs dir
-	then changed=False and will print message to ensure
-	all java processes are stopped before running cleanup
+	if a <WAS_Profile_Root>/logs/<server>/<server>.pid file
+	points at a live java process then changed=False and will
+	print message to ensure all java processes are stopped
+	before running cleanup. Stale .pid files are ignored
     """
 	
     module_args=dict(
 	profile_name=dict(type='str', required=True),
 	was_root=dict(type='str', required=True, choices=['/opt/WebSphere/AppServer', 
         '/opt/WebSphere85/AppServer', '/opt/WebSphere/AppServer8.5.5', '/opt/IBM/WebSphere/AppServer',
-        '/opt/IBM/ProcessServer'])
+        '/opt/IBM/ProcessServer']),
+	workers=dict(type='int', required=False, default=8),
+	background=dict(type='bool', required=False, default=False)
     )
 	
     module = AnsibleModule(
@@ -82,37 +110,66 @@ def run_cleanup():
     cleanup_dirs = ['/wstemp', '/temp', '/workspace']
     cache = ['clearClassCache.sh', 'osgiCfgInit.sh -all']
 
-    child = sp.Popen(
-        [
-            'find ' + was_root + '/profiles/' + profile_name +
-            ' -name *.pid'
-	],
-	shell=True,
-	stdout=sp.PIPE,
-	stderr=sp.PIPE
-    ) 
-    stdout_value, stderr_value = child.communicate()
-
-    if stdout_value:
+    running = running_servers(was_root + '/profiles/' + profile_name)
+
+    if running:
         module.fail_json(
             msg="Won't run cleanup as java processes are still running... please stop them then try again",
             changed=False,
-	    stdout=stdout_value
+            running=running
 	)
     else:
+        profile_root = was_root + '/profiles/' + profile_name
+        tombstones = find_tombstones(profile_root)
         try:
+            moved = [tombstone(profile_root + dirs) for dirs in cleanup_dirs]
+        except OSError as err:
+            module.fail_json(
+                msg='Failed to move cleanup dirs out of the way: ' + str(err),
+                changed=False
+            )
+        moved = [grave for grave in moved if grave is not None]
 
-            for dirs in cleanup_dirs:
-                shutil.rmtree(was_root+'/profiles/'+profile_name+dirs)
-        except OSError:
+        if not moved and not tombstones:
             module.exit_json(
                 msg='Cleanup dirs have already been deleted',
                 changed=False
-            ) 
+            )
+        tombstones.extend(moved)
+
+        if module.params['background']:
+            purge_in_background(tombstones, module.params['workers'])
+            stats = dict(background=True, tombstones=tombstones)
+        else:
+            stats = purge(tombstones, module.params['workers'])
+
+        if not moved:
+            module.exit_json(
+                msg='Cleanup dirs have already been deleted, purged tombstones left by an earlier run',
+                changed=True,
+                stats=stats
+            )
+
+        child = sp.Popen(
+            [
+                was_root + '/profiles/' + profile_name + '/bin/' + cache[0]
+            ],
+            shell=True,
+            stdout=sp.PIPE,
+            stderr=sp.PIPE
+        )
+        stdout_value, stderr_value = child.communicate()
+        if child.returncode != 0:
+            module.fail_json(
+                msg='Something went wrong and failed to clean all class cache',
+                changed=False,
+                stderr=stderr_value,
+                stdout=stdout_value
+            )
         else:
             child = sp.Popen(
                 [
-                    was_root + '/profiles/' + profile_name + '/bin/' + cache[0]
+                    was_root + '/profiles/' + profile_name + '/bin/' + cache[1]
                 ],
                 shell=True,
                 stdout=sp.PIPE,
@@ -121,32 +178,16 @@ def run_cleanup():
             stdout_value, stderr_value = child.communicate()
             if child.returncode != 0:
                 module.fail_json(
-                    msg='Something went wrong and failed to clean all class cache',
+                    msg='Failed to clear osgi cache',
                     changed=False,
                     stderr=stderr_value,
                     stdout=stdout_value
                 )
-            else:
-                child = sp.Popen(
-                    [
-                        was_root + '/profiles/' + profile_name + '/bin/' + cache[1]
-                    ],
-                    shell=True,
-                    stdout=sp.PIPE,
-                    stderr=sp.PIPE
-                )
-                stdout_value, stderr_value = child.communicate()
-                if child.returncode != 0:
-                    module.fail_json(
-                        msg='Failed to clear osgi cache',
-                        changed=False,
-                        stderr=stderr_value,
-                        stdout=stdout_value
-                    )
-                module.exit_json(
-                    msg='Successfully cleared class cache and osgi cache',
-                    changed=True
-                )
+            module.exit_json(
+                msg='Successfully cleared class cache and osgi cache',
+                changed=True,
+                stats=stats
+            )
 
 
 def main():
@@ -0,0 +1,265 @@
+#!/usr/bin/python
+
+from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils.ibm_parallel import run_parallel, timed
+import socket
+import time
+
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+
+
+ANSIBLE_METADATA = {
+    'metadata_version': '1.1',
+    'status': ['preview'],
+    'supported_by': 'community'
+}
+
+
+DOCUMENTATION = '''
+---
+module: ibm_cell_restart
+
+short_description: Module that performs a rolling restart of a WebSphere ND cell.
+
+version_added: "2.5"
+
+description:
+    - Module that restarts a whole WebSphere ND cell in dependency order.
+    - The Deployment Manager is restarted first, then every node agent in parallel,
+    - then the members of each cluster in batches that keep min_capacity percent of
+    - the cluster up.
+    - Processes on other hosts are controlled over ssh, so the module runs once for the
+    - whole cell, e.g. from the dmgr host, with run_once or delegate_to.
+    - Returns a per phase timeline. In check mode the restart plan is returned.
+
+options:
+    was_root:
+        description:
+            - Path of IBM Install root. E.g /opt/WebSphere/AppServer.
+            - Entries of dmgr, nodes and members may override it with their own was_root.
+        required: true
+    dmgr:
+        description:
+            - The Deployment Manager, as a dict with profile and optionally host.
+            - The phase is skipped when it isn't given.
+        required: false
+    nodes:
+        description:
+            - Node agents to restart, as a list of dicts with profile and optionally host.
+        required: false
+    clusters:
+        description:
+            - Clusters to roll, as a list of dicts with name and members.
+            - members is a list of dicts with server, profile and optionally host.
+        required: false
+    min_capacity:
+        description:
+            - Percentage of each cluster's members that must stay up while it is rolled.
+            - Decides the batch size, a cluster too small to restart any member while
+            - keeping min_capacity up fails before anything is restarted.
+        required: false
+        default: 50
+    parallel:
+        description:
+            - Number of node agents restarted at the same time.
+        required: false
+        default: 8
+    ssh_options:
+        description:
+            - Options handed to ssh for hosts other than this one.
+        required: false
+        default: -o BatchMode=yes
+
+author:
+    - Tom Davison (@tntdavison784)
+'''
+
+EXAMPLES = '''
+- name: Rolling restart of the cell
+  ibm_cell_restart:
+    was_root: /opt/WebSphere/AppServer
+    dmgr:
+      profile: Dmgr01
+    nodes:
+      - profile: AppSrv01
+        host: was01.example.com
+      - profile: AppSrv01
+        host: was02.example.com
+    clusters:
+      - name: AppCluster
+        members:
+          - server: AppCluster_was01
+            profile: AppSrv01
+            host: was01.example.com
+          - server: AppCluster_was02
+            profile: AppSrv01
+            host: was02.example.com
+    min_capacity: 50
+  run_once: true
+'''
+
+RETURN = '''
+timeline:
+    description: One entry per phase with its start offset, elapsed seconds and steps
+    type: list
+plan:
+    description: Phases and cluster batches that are (or would be) restarted
+    type: list
+elapsed:
+    description: Seconds the whole restart took
+    type: float
+'''
+
+
+LOCAL_HOSTS = ('localhost', '127.0.0.1', socket.gethostname(), socket.getfqdn())
+
+
+def remote_command(host, cmd, ssh_options):
+    """Function that wraps cmd in ssh when host isn't this machine."""
+
+    if not host or host in LOCAL_HOSTS:
+        return cmd
+    return 'ssh {0} {1} {2}'.format(ssh_options, host, quote(cmd))
+
+
+def batch_size(members, min_capacity):
+    """Function that returns how many members of a cluster can be down at once
+    while min_capacity percent of them stays up.
+    """
+
+    return len(members) - -(-len(members) * min_capacity // 100)
+
+
+def build_plan(module):
+    """Function that lays out the restart as ordered phases.
+    Cluster members are split into batches sized by min_capacity.
+    """
+
+    params = module.params
+    plan = []
+    if params['dmgr']:
+        plan.append(dict(phase='dmgr', steps=[dict(params['dmgr'], kind='dmgr')]))
+    if params['nodes']:
+        plan.append(dict(phase='nodeagents', steps=[dict(node, kind='nodeagent') for node in params['nodes']]))
+
+    for cluster in params['clusters'] or []:
+        members = cluster.get('members') or []
+        size = batch_size(members, params['min_capacity'])
+        if members and size < 1:
+            module.fail_json(
+                msg='Cluster {0} has {1} member(s), none can be restarted while keeping {2}% up'.format(
+                    cluster.get('name'), len(members), params['min_capacity']),
+                changed=False
+            )
+        for index in range(0, len(members), max(size, 1)):
+            plan.append(dict(
+                phase='cluster {0} batch {1}'.format(cluster.get('name'), index // size + 1),
+                steps=[dict(member, kind='server') for member in members[index:index + size]]
+            ))
+    return plan
+
+
+def restart_step(module, step):
+    """Function that restarts one process, the stop and start scripts run on the step's host.
+    A stop that fails, e.g. because the process was already down, doesn't fail the step,
+    the start script decides the outcome. Returns the step's result.
+    """
+
+    start = time.time()
+    bin_dir = (step.get('was_root') or module.params['was_root']) + '/profiles/' + step['profile'] + '/bin/'
+    if step['kind'] == 'dmgr':
+        scripts = ('stopManager.sh', 'startManager.sh')
+    elif step['kind'] == 'nodeagent':
+        scripts = ('stopNode.sh', 'startNode.sh')
+    else:
+        scripts = ('stopServer.sh ' + step['server'], 'startServer.sh ' + step['server'])
+
+    result = dict(target=step.get('server', step['kind']), host=step.get('host') or 'localhost',
+                  profile=step['profile'], changed=False, failed=False)
+    stop = module.run_command(remote_command(step.get('host'), bin_dir + scripts[0], module.params['ssh_options']),
+                              use_unsafe_shell=True)
+    result['stop_rc'] = stop[0]
+    started = module.run_command(remote_command(step.get('host'), bin_dir + scripts[1], module.params['ssh_options']),
+                                 use_unsafe_shell=True)
+    if started[0] != 0:
+        result.update(failed=True, changed=stop[0] == 0, rc=started[0], stderr=started[2],
+                      msg='Failed to run ' + scripts[1])
+    else:
+        result.update(changed=True, msg='Restarted')
+    result['elapsed'] = round(time.time() - start, 3)
+    return result
+
+
+def run_phase(module, phase, begin):
+    """Function that restarts every step of a phase at the same time (bounded by parallel)
+    and returns the phase's timeline entry.
+    """
+
+    offset = round(time.time() - begin, 3)
+    steps, elapsed = timed(run_parallel, lambda step: restart_step(module, step), phase['steps'],
+                           module.params['parallel'])
+    return dict(phase=phase['phase'], start=offset, elapsed=elapsed, steps=steps,
+                failed=any(step['failed'] for step in steps))
+
+
+def main():
+    """Main Function of the module.
+    Builds the restart plan and runs its phases in order, stopping at the first failed phase.
+    """
+
+    module = AnsibleModule(
+        argument_spec=dict(
+            was_root=dict(type='str', required=True),
+            dmgr=dict(type='dict', required=False),
+            nodes=dict(type='list', required=False),
+            clusters=dict(type='list', required=False),
+            min_capacity=dict(type='int', required=False, default=50),
+            parallel=dict(type='int', required=False, default=8),
+            ssh_options=dict(type='str', required=False, default='-o BatchMode=yes')
+        ),
+        required_one_of=[['dmgr', 'nodes', 'clusters']],
+        supports_check_mode=True
+    )
+
+    if not 0 <= module.params['min_capacity'] < 100:
+        module.fail_json(msg='min_capacity must be between 0 and 99', changed=False)
+
+    plan = build_plan(module)
+    summary = [dict(phase=phase['phase'], targets=[step.get('server', step['kind']) + '@' +
+                                                   (step.get('host') or 'localhost') for step in phase['steps']])
+               for phase in plan]
+
+    if module.check_mode:
+        module.exit_json(
+            msg='Would restart {0} phase(s)'.format(len(plan)),
+            changed=bool(plan),
+            plan=summary
+        )
+
+    begin = time.time()
+    timeline = []
+    for phase in plan:
+        timeline.append(run_phase(module, phase, begin))
+        if timeline[-1]['failed']:
+            module.fail_json(
+                msg='Rolling restart stopped, phase {0} failed'.format(phase['phase']),
+                changed=True,
+                timeline=timeline,
+                plan=summary,
+                elapsed=round(time.time() - begin, 3)
+            )
+
+    module.exit_json(
+        msg='Restarted {0} phase(s)'.format(len(timeline)),
+        changed=bool(timeline),
+        timeline=timeline,
+        plan=summary,
+        elapsed=round(time.time() - begin, 3)
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,14 @@
 #!/usr/bin/python
 
 import os
+import re
+import signal
+import time
 from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils.ibm_httpd_conf import find_directives, load_config
+from ansible.module_utils.ibm_parallel import run_parallel, timed
+from ansible.module_utils.ibm_process import child_pids, pid_alive, read_pid
+from ansible.module_utils.urls import open_url
 
 
 ANSIBLE_METADATA = {
@@ -27,10 +34,17 @@ options:
     state:
         description:
             - Describes the state in which to send IBM IHS server.
+            - graceful and graceful-stop check the config with apachectl -t first and then
+            - signal the httpd parent from the pid file, SIGUSR1 and SIGWINCH respectively.
+            - graceful waits until every worker the parent had before the signal is replaced,
+            - graceful-stop waits until the parent has exited, both for graceful_timeout seconds.
         required: true
         choices:
           - start
           - stop
+          - restart
+          - graceful
+          - graceful-stop
     path:
         description:
             - Path of IBM Install root. E.g /opt/IBM/WebSphere/HTTPServer
@@ -44,6 +58,37 @@ options:
         choices:
           - adminctl
           - apachectl
+        default: apachectl
+    instances:
+        description:
+            - List of httpd config files, one per IHS instance run from this install.
+            - Relative paths are taken from path. E.g conf/site1.conf.
+            - Every instance is sent into state with apachectl -k <state> -f <conf>, up to
+            - parallel instances at the same time.
+            - Instance state is taken from the PidFile of its config (logs/httpd.pid by default),
+            - the pid has to belong to a live httpd process.
+        required: false
+    parallel:
+        description:
+            - Number of instances sent into state at the same time.
+        required: false
+        default: 8
+    wait:
+        description:
+            - Seconds to wait for an instance's pid file to show it started or stopped.
+        required: false
+        default: 10
+    graceful_timeout:
+        description:
+            - Seconds to wait for graceful workers to roll over, or for graceful-stop to finish.
+        required: false
+        default: 60
+    status_url:
+        description:
+            - mod_status URL of the instance, e.g http://localhost/server-status.
+            - With graceful, the ParentServerConfigGeneration it reports must go up as well.
+            - Only used when a single instance is controlled.
+        required: false
 author:
     - Tom Davison (@tntdavison784)
 '''
@@ -68,6 +113,14 @@ EXAMPLES = '''
   loop:
     - { service: adminctl }
     - { service: apachectl }
+- name: Graceful restart of every IHS instance on the host
+  ibm_ihs:
+    state: graceful
+    path: /opt/IBM/WebSphere/HTTPServer
+    instances:
+      - conf/site1.conf
+      - conf/site2.conf
+      - conf/site3.conf
 '''
 
 
@@ -77,136 +130,234 @@ result:
     type: str
 message:
     description: Succesfully sent ihs into desired state.
+instances:
+    description: Per instance outcome with conf, pid_file, pid, running, changed and elapsed seconds
+    type: list
+elapsed:
+    description: Seconds taken to send every instance into state
+    type: float
 '''
 
 
-def send_service(module):
+def instance_pid_file(path, name, conf=None):
+    """Function that returns the pid file of an IHS instance.
+    Without a config file that is logs/admin.pid or logs/httpd.pid under path,
+    otherwise the config's PidFile, relative to its ServerRoot.
+    """
+
+    if conf is None:
+        return "{0}/logs/{1}".format(path, 'admin.pid' if name == 'adminctl' else 'httpd.pid')
+
+    try:
+        tree = load_config(conf, path)
+    except (IOError, ValueError):
+        return os.path.join(path, 'logs/httpd.pid')
+    pid_files = find_directives(tree, 'PidFile')
+    pid_file = pid_files[-1]['args'][0] if pid_files and pid_files[-1]['args'] else 'logs/httpd.pid'
+    return os.path.join(tree['server_root'], pid_file)
+
+
+def instance_status(path, name, conf=None):
+    """Function that returns dict(conf, pid_file, pid, running) for an IHS instance.
+    The instance is running only when its pid file points at a live httpd process.
+    """
+
+    pid_file = instance_pid_file(path, name, conf)
+    pid = read_pid(pid_file)
+    return dict(conf=conf, pid_file=pid_file, pid=pid, running=pid_alive(pid, 'httpd'))
+
+
+def wait_for_state(path, name, conf, running, timeout):
+    """Function that polls an instance's pid file until it is (or isn't) running."""
+
+    deadline = time.time() + timeout
+    status = instance_status(path, name, conf)
+    while status['running'] != running and time.time() < deadline:
+        time.sleep(0.2)
+        status = instance_status(path, name, conf)
+    return status
+
+
+def config_generation(url):
+    """Function that returns the ParentServerConfigGeneration reported by mod_status,
+    or None when it can't be read.
+    """
+
+    try:
+        body = open_url(url + '?auto', timeout=5).read()
+    except Exception:
+        return None
+    match = re.search(r'ParentServerConfigGeneration:\s*(\d+)', body.decode('utf-8', 'replace'))
+    return int(match.group(1)) if match else None
+
+
+def graceful_service(module, conf, status, result):
+    """Function that reloads (graceful) or drains (graceful-stop) an instance without
+    dropping in-flight connections. The config is tested first, the httpd parent is then
+    signalled and the outcome watched through /proc: graceful is confirmed once none of the
+    workers the parent had before the signal is left and new ones have taken over. Only
+    children running httpd count as workers, piped loggers outlive a graceful restart.
+    graceful-stop once the parent is gone.
+    """
+
+    path, name, state = module.params['path'], module.params['name'], module.params['state']
+    config_test = """{0}/bin/{1} -t""".format(path, name) + (""" -f {0}""".format(conf) if conf else '')
+    run_test = module.run_command(config_test)
+    if run_test[0] != 0:
+        result.update(failed=True, msg="Config test failed, service {0} was not signalled".format(name),
+                      stdout=run_test[1], stderr=run_test[2])
+        return result
+
+    pid = status['pid']
+    status_url = module.params['status_url'] if not module.params['instances'] or \
+        len(module.params['instances']) == 1 else None
+    workers = set(child_pids(pid, same_command=True))
+    generation = config_generation(status_url) if status_url else None
+    try:
+        os.kill(pid, signal.SIGUSR1 if state == 'graceful' else signal.SIGWINCH)
+    except OSError as err:
+        result.update(failed=True, msg="Could not signal httpd parent {0} of service {1}: {2}".format(
+            pid, name, err.strerror))
+        return result
+    result['changed'] = True
+
+    deadline = time.time() + module.params['graceful_timeout']
+    while True:
+        alive = pid_alive(pid, 'httpd')
+        if state == 'graceful-stop':
+            done = not alive
+        else:
+            current = set(child_pids(pid, same_command=True))
+            done = alive and bool(current) and not current & workers
+            if done and generation is not None:
+                done = (config_generation(status_url) or 0) > generation
+        if done or time.time() >= deadline or (state == 'graceful' and not alive):
+            break
+        time.sleep(0.2)
+
+    if state == 'graceful-stop':
+        result.update(running=alive, failed=alive,
+                      msg="Service {0} {1} within {2} seconds".format(
+                          name, 'is still draining' if alive else 'stopped gracefully',
+                          module.params['graceful_timeout']))
+    elif not alive:
+        result.update(running=False, failed=True, msg="httpd parent {0} exited after graceful restart".format(pid))
+    else:
+        remaining = set(child_pids(pid, same_command=True))
+        result.update(rolled_over=done, workers_replaced=len(workers - remaining), workers_before=len(workers),
+                      msg="Service {0} {1}".format(name, 'reloaded gracefully' if done else
+                                                   'reloaded, old workers still finishing requests'))
+    return result
+
+
+def send_service(module, conf=None):
     """Function that will send adminctl or apachectl ihs
     service into desired state. Function is dynamic and not tied
     to any state so will run regardless of the state provided.
-    There os lock file checks done in the main function to check service
-    state."""
+    With conf, the instance started from that config file is controlled.
+    Runs inside the worker pool, so the outcome is returned instead of exiting.
+    """
+
+    start = time.time()
+    path, name, state = module.params['path'], module.params['name'], module.params['state']
+    status = instance_status(path, name, conf)
+    result = dict(status, changed=False, failed=False)
 
+    if (state == 'start' and status['running']) or (state in ('stop', 'graceful-stop') and not status['running']):
+        result.update(msg="Service {0} is already {1}".format(name, 'running' if state == 'start' else 'stopped'))
+        result['elapsed'] = round(time.time() - start, 3)
+        return result
+    if module.check_mode:
+        result.update(changed=True, msg="Service {0} will be sent into {1} state".format(name, state))
+        result['elapsed'] = round(time.time() - start, 3)
+        return result
 
-    service_cmd = """{0}/bin/{1} {2}""".format(module.params['path'],
-                                                     module.params['name'],
-                                                     module.params['state'])
+    if state in ('graceful', 'graceful-stop') and status['running']:
+        graceful_service(module, conf, status, result)
+        result['elapsed'] = round(time.time() - start, 3)
+        return result
+
+    # graceful of a stopped instance is a plain start.
+    verb = 'start' if state == 'graceful' else state
+    if conf is None:
+        service_cmd = """{0}/bin/{1} {2}""".format(path, name, verb)
+    else:
+        service_cmd = """{0}/bin/{1} -k {2} -f {3}""".format(path, name, verb, conf)
 
     run_service = module.run_command(service_cmd)
 
     if run_service[0] != 0:
-        module.fail_json(
-            msg="Failed to send service {0} into state: {1}. See stdout/stderr for details.".format(module.params['name'],
-                                                                                                    module.params['state']),
-            changed=False,
+        result.update(
+            failed=True,
+            msg="Failed to send service {0} into state: {1}. See stdout/stderr for details.".format(name, state),
             stdout=run_service[1],
             stderr=run_service[2]
         )
-
-    module.exit_json(
-        msg="Successfully sent service: {0} into state: {1}".format(module.params['name'],
-                                                                    module.params['state']),
-        changed=True
-    )
+    else:
+        result.update(wait_for_state(path, name, conf, verb != 'stop', module.params['wait']))
+        result.update(changed=True, msg="Successfully sent service: {0} into state: {1}".format(name, state))
+    result['elapsed'] = round(time.time() - start, 3)
+    return result
 
 
 def main():
 
     module = AnsibleModule(
             argument_spec=dict(
-                state=dict(type='str',required=True, choices=['start','stop','restart']),
-                name=dict(type='str',required=True, choices=['adminctl', 'apachectl']),
-                path=dict(type='str',required=True, defaults='/opt/IBM/WebSphere/HTTPServer')
+                state=dict(type='str',required=True, choices=['start','stop','restart','graceful','graceful-stop']),
+                name=dict(type='str',required=False, choices=['adminctl', 'apachectl'], default='apachectl'),
+                path=dict(type='str',required=True),
+                instances=dict(type='list',required=False),
+                parallel=dict(type='int',required=False, default=8),
+                wait=dict(type='int',required=False, default=10),
+                graceful_timeout=dict(type='int',required=False, default=60),
+                status_url=dict(type='str',required=False)
             ),
             supports_check_mode = True
     )
 
-    state = module.params['state']
     name = module.params['name']
     path = module.params['path']
+    instances = module.params['instances']
 
+    if instances and name != 'apachectl':
+        module.fail_json(
+            msg="instances can only be used with apachectl",
+            changed=False
+        )
+
+    confs = [conf if os.path.isabs(conf) else os.path.join(path, conf) for conf in instances or []]
+    results, elapsed = timed(run_parallel, lambda conf: send_service(module, conf), confs or [None],
+                             module.params['parallel'])
+
+    changed = any(result['changed'] for result in results)
+    failed = [result for result in results if result['failed']]
+    if not instances:
+        # A single service keeps the plain result it always had.
+        result = results[0]
+        if failed:
+            module.fail_json(msg=result['msg'], changed=changed, stdout=result.get('stdout'),
+                             stderr=result.get('stderr'))
+        module.exit_json(msg=result['msg'], changed=changed, pid=result['pid'], elapsed=elapsed,
+                         rolled_over=result.get('rolled_over'))
+
+    if failed:
+        module.fail_json(
+            msg="Failed to send instance(s) {0} into state: {1}".format(
+                ', '.join(result['conf'] for result in failed), module.params['state']),
+            changed=changed,
+            instances=results,
+            elapsed=elapsed
+        )
+    module.exit_json(
+        msg="{0} of {1} instance(s) {2} sent into state: {3}".format(
+            sum(1 for result in results if result['changed']), len(results),
+            'would be' if module.check_mode else '', module.params['state']).replace('  ', ' '),
+        changed=changed,
+        instances=results,
+        elapsed=elapsed
+    )
 
-    admin_pid = "{0}/logs/admin.pid".format(path)
-    httpd_pid = "{0}/logs/httpd.pid".format(path)
-
-    if state =='start':
-        if name == 'adminctl':
-            if os.path.exists(admin_pid):
-                module.exit_json(
-                    msg="Service {0} is already running".format(name),
-                    changed=False
-                )
-            send_service(module)
-        if name == 'apachectl':
-            if os.path.exists(httpd_pid):
-                module.exit_json(
-                    msg="Service {0} is already running".format(name),
-                    changed=False
-                )
-            send_service(module)
-    if state == 'stop':
-        if name == 'adminctl':
-            if not os.path.exists(admin_pid):
-                module.exit_json(
-                    msg="Service {0} is already stopped".format(name),
-                    changed=False
-                )
-            send_service(module)
-        if name == 'apachectl':
-            if not os.path.exists(httpd_pid):
-                module.exit_json(
-                    msg="Service {0} is not running".format(name),
-                    changed=False
-                )
-            send_service(module)
-    if module.check_mode:
-        if state == 'start':
-            if name == 'adminctl':
-                if os.path.exists(admin_pid):
-                    module.exit_json(
-                            msg="Service {0} is already running".format(name),
-                            changed=False
-                    )
-                else:
-                    module.exit_json(
-                            msg="Service {0} will be sent into start state".format(name),
-                            changed=True
-                    )
-            if name == 'apachectl':
-                if os.path.exists(httpd_pid):
-                    module.exit_json(
-                            msg="Service {0} is already running ".format(name),
-                            changed=False
-                    )
-                else:
-                    module.exit_json(
-                            msg="Service {0} will be sent into start state".format(name),
-                            changed=True
-                    )
-        if state == 'stop': 
-            if name == 'adminctl':
-                if not os.path.exists(admin_pid):
-                    module.exit_json(
-                            msg="Service {0} is already stopped".format(name),
-                            changed=False
-                    )
-                else:
-                    module.exit_json(
-                            msg="Service {0} will be sent into stop state".format(name),
-                            changed=True
-                    )
-            if name == 'apachectl':
-                if not os.path.exists(httpd_pid):
-                    module.exit_json(
-                            msg="Service {0} is already stopped".format(name),
-                            changed=False
-                    )
-                else:
-                    module.exit_json(
-                            msg="Service {0} will be sent into stop state".format(name),
-                            changed=True
-                    )
-        
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,182 @@
+#!/usr/bin/python
+
+import os
+from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils.ibm_httpd_conf import (find_directives, load_config, loaded_modules,
+                                                 plan_directive, virtual_hosts, write_files)
+
+
+ANSIBLE_METADATA = {
+    'metadata_version': '1.1',
+    'status': ['preview'],
+    'supported_by': 'community'}
+
+
+DOCUMENTATION = '''
+---
+module: ibm_ihs_conf
+
+short_description: Module that inspects and edits IBM IHS httpd configuration.
+
+version_added: "4.1"
+
+description:
+    - Module that reads an IHS httpd.conf natively, following Include and IncludeOptional.
+    - The parsed configuration is cached on the host until any file it was read from changes.
+    - Directives are added or removed idempotently, the change is returned as a diff.
+    - Support of dry run is provided with this module.
+
+options:
+    state:
+        description:
+            - present makes sure the directive is in the configuration, absent removes it.
+            - check returns the loaded modules, virtual hosts and included files, plus
+            - every occurrence of directive when one is given.
+        required: true
+        choices:
+          - present
+          - absent
+          - check
+    path:
+        description:
+            - Path of IBM IHS Install root, the default ServerRoot. E.g /opt/IBM/WebSphere/HTTPServer
+        required: true
+    conf:
+        description:
+            - Config file to read. Relative paths are taken from path.
+        required: false
+        default: conf/httpd.conf
+    directive:
+        description:
+            - Name of the directive, e.g LoadModule or Include.
+            - Required for present and absent.
+        required: false
+    args:
+        description:
+            - Arguments of the directive. Only occurrences with exactly these arguments match.
+        required: false
+    section:
+        description:
+            - Only look inside (and add into) this section, e.g 'VirtualHost *:443'.
+        required: false
+    backup:
+        description:
+            - Keep a copy of each file before its first change as <file>.ORIG.
+        required: false
+        default: false
+author:
+    - Tom Davison (@tntdavison784)
+'''
+
+
+EXAMPLES = '''
+- name: Load mod_status
+  ibm_ihs_conf:
+    state: present
+    path: /opt/IBM/WebSphere/HTTPServer
+    directive: LoadModule
+    args:
+      - status_module
+      - modules/mod_status.so
+- name: Remove a ServerAlias from the 443 virtual host
+  ibm_ihs_conf:
+    state: absent
+    path: /opt/IBM/WebSphere/HTTPServer
+    directive: ServerAlias
+    args:
+      - old.example.com
+    section: VirtualHost *:443
+- name: Read the configuration for drift checks
+  ibm_ihs_conf:
+    state: check
+    path: /opt/IBM/WebSphere/HTTPServer
+  register: ihs_conf
+'''
+
+
+RETURN = '''
+diff:
+    description: Unified diff of the change made (or that would be made in check mode) under prepared
+    type: dict
+files:
+    description: Every config file read, the main one first
+    type: list
+modules:
+    description: LoadModule directives as module name -> shared object
+    type: dict
+virtual_hosts:
+    description: Addresses, ServerName, ServerAlias and DocumentRoot of each VirtualHost
+    type: list
+found:
+    description: Occurrences of directive with their file and line
+    type: list
+'''
+
+
+def main():
+
+    module = AnsibleModule(
+            argument_spec=dict(
+                state=dict(type='str',required=True, choices=['present','absent','check']),
+                path=dict(type='str',required=True),
+                conf=dict(type='str',required=False, default='conf/httpd.conf'),
+                directive=dict(type='str',required=False),
+                args=dict(type='list',required=False),
+                section=dict(type='str',required=False),
+                backup=dict(type='bool',required=False, default=False)
+            ),
+            required_if=[['state', 'present', ['directive']], ['state', 'absent', ['directive']]],
+            supports_check_mode = True
+    )
+
+    state = module.params['state']
+    path = module.params['path']
+    conf = module.params['conf']
+    directive = module.params['directive']
+    if not os.path.isabs(conf):
+        conf = os.path.join(path, conf)
+
+    try:
+        tree = load_config(conf, path)
+    except (IOError, ValueError) as err:
+        module.fail_json(msg="Failed to read {0}: {1}".format(conf, err), changed=False)
+
+    if state == 'check':
+        found = []
+        if directive:
+            found = [dict(file=node['file'], line=node['line'], args=node['args'])
+                     for node in find_directives(tree, directive, module.params['args'], module.params['section'])]
+        module.exit_json(
+            msg="Read {0} config file(s) for {1}".format(len(tree['files']), conf),
+            changed=False,
+            files=tree['files'],
+            server_root=tree['server_root'],
+            modules=loaded_modules(tree),
+            virtual_hosts=virtual_hosts(tree),
+            found=found
+        )
+
+    try:
+        plan = plan_directive(tree, directive, module.params['args'], state, module.params['section'])
+    except ValueError as err:
+        module.fail_json(msg=str(err), changed=False)
+
+    if plan['changed'] and not module.check_mode:
+        try:
+            write_files(plan['files'], '.ORIG' if module.params['backup'] else None)
+        except (IOError, OSError) as err:
+            module.fail_json(msg="Failed to write config: {0}".format(err), changed=False,
+                             diff=dict(prepared=plan['diff']))
+
+    module.exit_json(
+        msg="Directive {0} is {1}".format(directive, state) if not plan['changed'] else
+            "Directive {0} {1} {2}".format(directive, 'will be' if module.check_mode else 'was',
+                                           'added' if state == 'present' else 'removed'),
+        changed=plan['changed'],
+        files=sorted(plan['files']),
+        diff=dict(prepared=plan['diff'])
+    )
+
+
+if __name__ == '__main__':
+    main()
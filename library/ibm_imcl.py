@@ -1,7 +1,17 @@
 #!/usr/bin/python
 
 import os
+import time
 from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils.ibm_cache import fact_cache
+from ansible.module_utils.ibm_imcl_queue import queue_dir, queue_lock, submit
+from ansible.module_utils.ibm_im_image import (AGENT_ID, capture_image, extract_image, place_image,
+                                               read_manifest, target_problems)
+from ansible.module_utils.ibm_im_shared import plan_gc, scan_shared
+from ansible.module_utils.ibm_purge import purge
+from ansible.module_utils.ibm_im_registry import installed_xml_path, read_installed_packages
+from ansible.module_utils.ibm_im_repository import (is_local, payload_size, repository_catalog, repository_index,
+                                                    resolve_offering)
 
 
 ANSIBLE_METADATA = {
@@ -21,7 +31,7 @@ description:
     - Module that takes care of installing IBM products via imcl cli.
     - Module does a package lookup within the target cell to check for package existance.
     - Depending on the specified module state, the package check will determine the outcome of the run.
-    - Module supports dry runs.
+    - Module supports dry runs. Dry runs read IM's installed.xml and do not start imcl.
 
 options:
     state:
@@ -32,6 +42,9 @@ options:
           - present
           - absent
           - update
+          - rollback
+          - capture
+          - gc
     src:
         description:
             - Path to IBM IM installation binaries. E.g /tmp/WASND8.5.5/
@@ -53,6 +66,7 @@ options:
     name:
         description:
             - Name of package to be installed, updated, or removed from any given cell.
+            - Accepts a list of packages. All packages that need work are handed to a single imcl call.
         required: true
     shared_resource:
         description:
@@ -83,6 +97,93 @@ options:
         required_if: secure_storage != None
         default:
           - None
+    version:
+        description:
+            - Version to pick for names given as a bare offering id, e.g com.ibm.websphere.ND.v85.
+            - latest, an exact version, a version prefix such as 8.5.5013, or a range such as [8.5.5000,8.5.6000).
+            - For present and update the version is resolved from the local repositories in src, read
+            - directly from repository.config, repository.xml and Offerings/ (zipped repositories too),
+            - without starting imcl. For absent and rollback it is resolved from the installed packages.
+            - Names that already carry a version are used as given.
+        required: false
+        default:
+          - None
+    preflight:
+        description:
+            - Before present or update start imcl, check the local repositories in src hold every
+            - requested package and that dest and shared_resource have room for it. A bare offering
+            - id is checked against the latest version the repositories hold, the one imcl installs.
+            - Remote repositories can't be checked and are skipped.
+        required: false
+        default: true
+    space_factor:
+        description:
+            - The preflight expects an install to take space_factor times the size of the repositories
+            - it installs from in dest, plus that size again in shared_resource for IM's cache. Each
+            - repository counts once, however many of its packages are installed.
+        required: false
+        default: 2.0
+    queue:
+        description:
+            - Send imcl operations through an on-host queue next to the IM data location, so
+            - plays hitting the same host at the same time don't collide on IM's agent lock.
+            - Compatible operations (same state, imcl, src, dest, shared_resource, properties and
+            - credentials) queued together run as one imcl call, every play gets its own outcome.
+        required: false
+        default: true
+    queue_window:
+        description:
+            - Seconds the queue waits for more operations before starting imcl, only when other plays'
+            - operations are already queued. A lone operation starts imcl straight away.
+        required: false
+        default: 2.0
+    image:
+        description:
+            - Golden image of a verified install, see state capture. With state present the install is
+            - extracted from the image instead of running imcl, which takes minutes rather than the full
+            - IM install. The image is streamed into staging directories next to dest, shared_resource and
+            - the IM data location, every file is checked against the image's sha256 manifest, and only then
+            - swapped into place. Permissions, symlinks, hardlinks and (as root) ownership are kept.
+            - IM's registry comes with the image, so later update and rollback through imcl work as usual.
+            - This needs the same dest, shared_resource, data location, imcl path and IM agent version as the
+            - captured host, an empty dest and shared_resource, and an IM registry with nothing installed.
+            - With state capture dest, shared_resource and the IM data location are written to this path,
+            - with its manifest in <image>.json and its sha256 in <image>.sha256. Queued imcl operations
+            - are held off while the image is captured.
+        required: false
+        default:
+          - None
+    compression:
+        description:
+            - Compression of captured images. zstd needs the zstandard python library.
+        required: false
+        default: gzip
+        choices:
+          - gzip
+          - zstd
+    workers:
+        description:
+            - Threads used to compress captured images, and to prune shared_resource with state gc.
+        required: false
+        default: 4
+    rollback_depth:
+        description:
+            - With state gc, how many versions below each installed version of an offering are kept in
+            - shared_resource, so imcl rollback can still go back that far from every install.
+            - Artifacts of older versions are pruned in parallel and their size reported, in check
+            - mode the report is returned without removing anything. Artifacts that can't be tied
+            - to an installed offering by their <id>_<version> name are never removed.
+        required: false
+        default: 1
+    data_location:
+        description:
+            - IM agent data location that holds installed.xml. E.g /var/ibm/InstallationManager
+            - Defaults to cic.appDataLocation from the IM config.ini, then the IM default locations.
+            - Package state is read from installed.xml directly, imcl is only used when the file can't be found.
+            - The installed package index is cached on the host and only rebuilt when installed.xml changes.
+        required: false
+        default:
+          - None
 author:
     - Tom Davison (@tntdavison784)
 '''
@@ -115,6 +216,47 @@ EXAMPLES = '''
     name: com.ibm.websphere.IHS.v85_8.5.5000.20130514_1044
     src: /tmp/IHS-Binaries/
     properties: user.ihs.allowNonRootSilentInstall=true,user.ihs.httpPort=8080
+- name: INSTALL WAS ND, IHS AND PLUGINS IN ONE IMCL RUN
+  ibm_imcl:
+    state: present
+    src: /tmp/WASND8.5/
+    dest: /opt/IBM/WebSphere/AppServer
+    path: /opt/IBM/InstallationManager/eclipse/tools/imcl
+    name:
+      - com.ibm.websphere.ND.v85_8.5.5012.20170627_1018
+      - com.ibm.websphere.IHS.v85_8.5.5012.20170627_1018
+      - com.ibm.websphere.PLG.v85_8.5.5012.20170627_1018
+    shared_resource: /opt/IBM/IMShared
+- name: UPDATE WAS ND TO THE LATEST FIXPACK IN THE REPOSITORY
+  ibm_imcl:
+    state: update
+    path: /opt/IBM/InstallationManager/eclipse/tools/imcl
+    src: /mnt/repos/WAS855
+    dest: /opt/IBM/WebSphere/AppServer
+    name: com.ibm.websphere.ND.v85
+    version: latest
+    shared_resource: /opt/IBM/IMShared
+- name: CAPTURE A GOLDEN IMAGE OF A VERIFIED WAS ND INSTALL
+  ibm_imcl:
+    state: capture
+    path: /opt/IBM/InstallationManager/eclipse/tools/imcl
+    dest: /opt/IBM/WebSphere/AppServer
+    shared_resource: /opt/IBM/IMShared
+    name: com.ibm.websphere.ND.v85_8.5.5013.20180112_1418
+    image: /mnt/images/was855013.tar.gz
+- name: BUILD WAS ND FROM THE GOLDEN IMAGE
+  ibm_imcl:
+    state: present
+    path: /opt/IBM/InstallationManager/eclipse/tools/imcl
+    dest: /opt/IBM/WebSphere/AppServer
+    shared_resource: /opt/IBM/IMShared
+    image: /mnt/images/was855013.tar.gz
+- name: REPORT AND PRUNE OLD FIXPACK ARTIFACTS FROM IMSHARED
+  ibm_imcl:
+    state: gc
+    path: /opt/IBM/InstallationManager/eclipse/tools/imcl
+    shared_resource: /opt/IBM/IMShared
+    rollback_depth: 1
 - name: ROLLBACK LATEST FIXPACK
   ibm_imcl:
     state: rollback
@@ -148,169 +290,257 @@ absent:
     type: str
 message:
     description: Successfully removed package: <package_name> from cell.
+image:
+    description: Manifest of the image captured or installed, with stats of the capture or extraction
+    type: dict
+shared:
+    description: With state gc, the artifacts reclaimed, retained (with the reason) and left unclassified, with bytes of each
+    type: dict
+packages:
+    description: Per package outcome. Either the action taken (installed, updated, removed, rolled back) or skipped.
+    type: dict
 '''
 
 
-def install_package_local(module):
-    """Function that takes care of installing new packages into the target environment."""
+def package_status(changed_pkgs, skipped_pkgs, action):
+    """Function that builds the per package result returned by the module.
+    Packages that were acted on get the action name, everything else is marked skipped.
+    """
+
+    status = dict((package, 'skipped') for package in skipped_pkgs)
+    status.update((package, action) for package in changed_pkgs)
+    return status
+
+
+def install_local_cmd(params, packages):
+    """Function that builds the imcl call installing packages from a local repository."""
+
+    lpackage_install_cmd = """{0} -acceptLicense -repositories {1} \
+-installationDirectory {2} -log /tmp/IBM-Install.log \
+-sharedResourcesDirectory {3} install {4}""".format(params['path'],
+            params['src'], params['dest'], params['shared_resource'],
+            ' '.join(packages))
+
+    if params['properties'] is not None:
+        lpackage_install_cmd += " -properties {0}".format(params['properties'])
+    return lpackage_install_cmd
+
+
+def install_remote_cmd(params, packages):
+    """Function that builds the imcl call installing packages from a remote ibm repo."""
+
+    rpackage_install_cmd = """{0} -repositories {1} -installationDirectory {2} \
+-log /tmp/IBM_install.log -sharedResourcesDirectory {3} \
+install {4} -secureStorageFile {5} -masterPasswordFile {6} \
+-acceptLicense""".format(params['path'], params['src'],
+            params['dest'], params['shared_resource'],
+            ' '.join(packages), params['secure_storage'],
+            params['password_file'])
+
+    if params['properties'] is not None:
+        rpackage_install_cmd += " -properties {0}".format(params['properties'])
+    return rpackage_install_cmd
+
+
+def update_local_cmd(params, packages):
+    """Function that builds the imcl call updating packages from a local repository."""
+
+    return """{0} -acceptLicense -sharedResourcesDirectory {1} \
+install {2} -repositories {3} -log /tmp/IBM-Update.log""".format(params['path'],
+                    params['shared_resource'], ' '.join(packages), params['src'])
+
+
+def update_remote_cmd(params, packages):
+    """Function that builds the imcl call updating packages from a remote ibm repo."""
 
-    if module.params['properties'] is None:
-        lpackage_install_cmd = """{0} -acceptLicense -repositories {1} \
-                -installationDirectory {2} -log /tmp/IBM-Install.log \
-                -sharedResourcesDirectory {3} install {4}""".format(module.params['path'],
-                        module.params['src'], module.params['dest'], module.params['shared_resource'],
-                        module.params['name'])
-        lpackage_install = module.run_command(lpackage_install_cmd, use_unsafe_shell=True)
+    return """{0} -acceptLicense -sharedResourcesDirectory {1} \
+install {2} -repositories {3} -log /tmp/IBM-Update.log \
+-secureStorageFile {4} -masterPasswordFile {5}""".format(params['path'],
+                    params['shared_resource'], ' '.join(packages), params['src'],
+                    params['secure_storage'], params['password_file'])
 
-    if module.params['properties'] is not None:
-        lpackage_install_cmd = """{0} -acceptLicense -repositories {1} \
-                -installationDirectory {2} -log /tmp/IBM-Install.log \
-                -sharedResourcesDirectory {3} install {4} -properties {5}""".format(module.params['path'],
-                        module.params['src'], module.params['dest'], module.params['shared_resource'],
-                        module.params['name'], module.params['properties'])
-        lpackage_install = module.run_command(lpackage_install_cmd, use_unsafe_shell=True)
+
+def rollback_cmd(params, packages):
+    """Function that builds the imcl call rolling packages back."""
+
+    return """{0} rollback {1}""".format(params['path'], ' '.join(packages))
+
+
+def uninstall_cmd(params, packages):
+    """Function that builds the imcl call uninstalling packages."""
+
+    return """{0} uninstall {1}""".format(params['path'], ' '.join(packages))
+
+
+def uninstall_all_cmd(params, packages):
+    """Function that builds the imcl call uninstalling everything."""
+
+    return """{0} uninstallAll""".format(params['path'])
+
+
+IMCL_COMMANDS = dict(
+    install_local=install_local_cmd,
+    install_remote=install_remote_cmd,
+    update_local=update_local_cmd,
+    update_remote=update_remote_cmd,
+    rollback=rollback_cmd,
+    uninstall=uninstall_cmd,
+    uninstall_all=uninstall_all_cmd
+)
+
+# Requests can share one imcl call only when all of these match.
+QUEUE_PARAMS = ('path', 'src', 'dest', 'shared_resource', 'properties', 'secure_storage', 'password_file')
+
+
+def run_imcl(module, kind, packages):
+    """Function that runs one imcl operation and returns (rc, stdout, stderr).
+    With queue, the operation goes through the on-host imcl queue, where it is merged
+    with compatible operations other plays queued at the same time.
+    """
+
+    if not module.params['queue']:
+        return module.run_command(IMCL_COMMANDS[kind](module.params, packages), use_unsafe_shell=True)
+
+    def execute(kind, params, packages):
+        return module.run_command(IMCL_COMMANDS[kind](params, packages), use_unsafe_shell=True)
+
+    params = dict((key, module.params[key]) for key in QUEUE_PARAMS)
+    try:
+        outcome = submit(queue_dir(im_data_location(module)), kind, params, packages, execute,
+                         module.params['queue_window'])
+    except (IOError, OSError) as err:
+        module.fail_json(msg="imcl queue failed: {0}".format(err), changed=False)
+    return outcome['rc'], outcome['stdout'], outcome['stderr']
+
+
+def install_package_local(module, packages, skipped):
+    """Function that takes care of installing new packages into the target environment.
+    All packages are handed to a single imcl install call, so IM only starts once
+    no matter how many packages are requested.
+    """
+
+    lpackage_install = run_imcl(module, 'install_local', packages)
 
     if lpackage_install[0] != 0:
         module.fail_json(
-            msg="Failed to install package: {0}. Please see log in /tmp for more details.".format(module.params['name']),
+            msg="Failed to install package(s): {0}. Please see log in /tmp for more details.".format(' '.join(packages)),
             changed=False,
-            stderr=lpackage_install[2]
+            stderr=lpackage_install[2],
+            packages=package_status([], skipped, 'installed')
         )
 
     module.exit_json(
-        msg="Succesfully installed package: {0}to location: {1}. For installation details please see log in /tmp/. ".format(module.params['name'],
+        msg="Succesfully installed package(s): {0} to location: {1}. For installation details please see log in /tmp/. ".format(' '.join(packages),
             module.params['dest']),
-        changed=True
+        changed=True,
+        packages=package_status(packages, skipped, 'installed')
     )
 
 
-def install_package_remote(module):
+def install_package_remote(module, packages, skipped):
     """
     Function that will install packages
-    from a remote ibm repo
+    from a remote ibm repo in a single imcl call
     """
 
-    if module.params['properties'] is None:
-        rpackage_install_cmd = """{0}/ -repositories {1} -installationDirectory {2} \
-                -log /tmp/IBM_install.log -sharedResourcesDirectory {3} \
-                install {4} -secureStorageFile {5} -masterPasswordFile {6} \
-                -acceptLicense""".format(module.params['path'],module.params['src'],
-                        module.params['dest'],module.params['shared_resources'],
-                        module.params['name'],module.params['secure_storage'],
-                        module.params['passwor_file'])
-        rpackage_install = module.run_command(rpackage_install_cmd, use_unsafe_shell=True)
-
-    if module.params['properties'] is not None:
-        rpackage_install_cmd = """{0}/ -repositories {1} -installationDirectory {2} \
-                -log /tmp/IBM_install.log -sharedResourcesDirectory {3} \
-                install {4} -secureStorageFile {5} -masterPasswordFile {6} \
-                -acceptLicense -properties {7}""".format(module.params['path'],module.params['src'],
-                        module.params['dest'],module.params['shared_resources'],
-                        module.params['name'],module.params['secure_storage'],
-                        module.params['password_file'],module.params['properties'])
-        rpackage_install = module.run_command(rpackage_install_cmd, use_unsafe_shell=True)
+    rpackage_install = run_imcl(module, 'install_remote', packages)
 
     if rpackage_install[0] != 0:
         module.fail_json(
-            msg="Failed to install package(s) {0}".format(module.params['name']),
+            msg="Failed to install package(s) {0}".format(' '.join(packages)),
             changed=False,
             stderr=rpackage_install[2],
-            stdout=rpackage_install[1]
+            stdout=rpackage_install[1],
+            packages=package_status([], skipped, 'installed')
         )
     module.exit_json(
-        msg="Successfully installed package(s) {0}".format(module.params['name']),
-        changed=True
+        msg="Successfully installed package(s) {0}".format(' '.join(packages)),
+        changed=True,
+        packages=package_status(packages, skipped, 'installed')
     )
 
 
-def update_package_local(module):
+def update_package_local(module, packages, skipped):
     """Function that updates packages for target environment."""
-    
-
-    lpackage_update_cmd = """{0} -acceptLicense -sharedResourcesDirectory {1} \
-install {2} -repositories {3} -log /tmp/IBM-Update.log""".format(module.params['path'],
-                    module.params['shared_resource'], module.params['name'], module.params['src'])
 
-    lpackage_update = module.run_command(lpackage_update_cmd, use_unsafe_shell=True)
+    lpackage_update = run_imcl(module, 'update_local', packages)
     if lpackage_update[0] != 0:
         module.fail_json(
-            msg="Failed to update package: {0}. Please see log in /tmp/ for more details.".format(module.params['name']),
+            msg="Failed to update package(s): {0}. Please see log in /tmp/ for more details.".format(' '.join(packages)),
             changed=False,
-            details=lpackage_update_cmd,
-            stderr=lpackage_update[2]
+            details=update_local_cmd(module.params, packages),
+            stderr=lpackage_update[2],
+            packages=package_status([], skipped, 'updated')
         )
     module.exit_json(
-        msg="Succesfully updated package: {0}".format(module.params['name']),
-        changed=True
+        msg="Succesfully updated package(s): {0}".format(' '.join(packages)),
+        changed=True,
+        packages=package_status(packages, skipped, 'updated')
     )
 
-def update_package_remote(module):
-    """Function that updates packages for target environment."""
 
-    rpackage_update_cmd = """{0} -acceptLicense -sharedResourcesDirectory {1} \
-            install {2} -repositories {3} -log /tmp/IBM-Update.log \
-            -secureStorageFile {4} -masterPasswordFile {5}""".format(module.params['path'],
-                    module.params['shared_resource'], module.params['name'], module.params['src'],
-                    module.params['secure_storage'], module.params['password_file'])
+def update_package_remote(module, packages, skipped):
+    """Function that updates packages for target environment."""
 
-    rpackage_update = module.run_command(rpackage_update_cmd, use_unsafe_shell=True)
+    rpackage_update = run_imcl(module, 'update_remote', packages)
 
     if rpackage_update[0] != 0:
         module.fail_json(
-            msg="Failed to update package: {0}. Please see log in /tmp/ for more details.".format(module.params['name']),
+            msg="Failed to update package(s): {0}. Please see log in /tmp/ for more details.".format(' '.join(packages)),
             changed=False,
-            stderr=rpackage_update[2]
+            stderr=rpackage_update[2],
+            packages=package_status([], skipped, 'updated')
         )
     module.exit_json(
-        msg="Succesfully updated package: {0}".format(module.params['name']),
-        changed=True
+        msg="Succesfully updated package(s): {0}".format(' '.join(packages)),
+        changed=True,
+        packages=package_status(packages, skipped, 'updated')
     )
 
-def rollback_package(module):
+
+def rollback_package(module, packages, skipped):
     """Function to rollback to a previous package version."""
 
-    rllbck_pckg_cmd = """{0} rollback {1}""".format(module.params['path'],
-            module.params['name'])
-    rllbck_pckg = module.run_command(rllbck_pckg_cmd, use_unsafe_shell=True)
+    rllbck_pckg = run_imcl(module, 'rollback', packages)
 
     if rllbck_pckg[0] != 0:
         module.fail_json(
-            msg="Failed to rollback package: {0} because the package was not previously installed".format(module.params['name']),
+            msg="Failed to rollback package(s): {0}".format(' '.join(packages)),
             changed=False,
-            stderr=rllbck_pckg[2]
+            stderr=rllbck_pckg[2],
+            packages=package_status([], skipped, 'rolled back')
         )
     module.exit_json(
-        msg="Successfully rolled back package: {0}".format(module.params['name']),
-        changed=True
+        msg="Successfully rolled back package(s): {0}".format(' '.join(packages)),
+        changed=True,
+        packages=package_status(packages, skipped, 'rolled back')
     )
 
 
-def uninstall(module):
-    """ Function that will uninstall all a package
+def uninstall(module, packages=None, skipped=None):
+    """ Function that will uninstall the given packages
     or if all: yes is specified will uninstall all
     packages in the given WAS cell
     """
 
     if (module.params['remove_all'] == 'no'):
-        uninstall_cmd = """{0} uninstall {1}""".format(module.params['path'],
-            module.params['name'])
-        uninstall = module.run_command(uninstall_cmd, use_unsafe_shell=True)
-    
+        uninstall = run_imcl(module, 'uninstall', packages)
+
         if uninstall[0] != 0:
             module.fail_json(
-                msg="Failed to uninstall package {0}".format(module.params['name']),
+                msg="Failed to uninstall package(s) {0}".format(' '.join(packages)),
                 changed=False,
-                stderr=uninstall[2]
+                stderr=uninstall[2],
+                packages=package_status([], skipped, 'removed')
             )
         module.exit_json(
-                msg="Succesfully uninstalled package {0}".format(module.params['name']),
-                changed=True
+                msg="Succesfully uninstalled package(s) {0}".format(' '.join(packages)),
+                changed=True,
+                packages=package_status(packages, skipped, 'removed')
         )
 
     if (module.params['remove_all'] == 'yes'):
-        uninstallAll_cmd = """{0} uninstallAll""".format(module.params['path'])
-
-        uninstallAll = module.run_command(uninstallAll_cmd, use_unsafe_shell=True)
+        uninstallAll = run_imcl(module, 'uninstall_all', [])
 
         if uninstallAll[0] != 0:
             module.fail_json(
@@ -326,23 +556,378 @@ def uninstall(module):
         )
 
 
+def im_data_location(module):
+    """Function that works out the IM agent data location, the directory holding installed.xml.
+    Uses data_location when given, otherwise cic.appDataLocation from the config.ini next to imcl,
+    and finally the IM defaults for admin and non-admin installs.
+    """
+
+    if module.params['data_location'] is not None:
+        return module.params['data_location']
+
+    config_ini = os.path.join(os.path.dirname(os.path.dirname(module.params['path'])),
+                              'configuration', 'config.ini')
+    try:
+        with open(config_ini) as f_obj:
+            for line in f_obj:
+                if line.startswith('cic.appDataLocation='):
+                    location = line.split('=', 1)[1].strip().replace('\\:', ':')
+                    return os.path.expanduser(location.replace('@user.home', '~'))
+    except IOError:
+        pass
+
+    if os.geteuid() == 0:
+        return '/var/ibm/InstallationManager'
+    return os.path.expanduser('~/var/ibm/InstallationManager')
+
+
+def parse_installed_packages(output):
+    """Function that parses imcl listInstalledPackages -long output into a package index.
+    Each line looks like: <install dir> : <package group> : <id>_<version> : <name> : <display version>
+    The index is keyed on the full <id>_<version> package name used everywhere else in this module.
+    """
+
+    index = {}
+    for line in output.splitlines():
+        fields = [field.strip() for field in line.split(' : ')]
+        if len(fields) < 3:
+            continue
+        offering = [field for field in fields[1:] if '_' in field and ' ' not in field]
+        if not offering:
+            continue
+        package_id, version = offering[0].split('_', 1)
+        rest = fields[fields.index(offering[0]) + 1:]
+        index[offering[0]] = dict(
+            id=package_id,
+            version=version,
+            location=fields[0],
+            name=rest[0] if len(rest) > 0 else None,
+            display_version=rest[1] if len(rest) > 1 else None,
+            install_date=rest[2] if len(rest) > 2 else None
+        )
+    return index
+
+
+def installed_packages(module):
+    """Function that returns the parsed installed package index for the target host.
+    The index is read straight from IM's installed.xml, so state checks never start
+    the IM JVM. Only when installed.xml can't be found does it fall back to one
+    imcl listInstalledPackages -long call. Either way the index is kept in the data
+    location's shared fact cache, keyed on the mtime of installed.xml.
+    """
+
+    data_location = im_data_location(module)
+    installed_xml = installed_xml_path(data_location)
+
+    def build():
+        if os.path.isfile(installed_xml):
+            try:
+                return read_installed_packages(installed_xml)
+            except (IOError, SyntaxError) as err:
+                module.warn("Could not read {0}, falling back to imcl: {1}".format(installed_xml, err))
+
+        check_package_cmd = """{0} listInstalledPackages -long""".format(module.params['path'])
+        check_package = module.run_command(check_package_cmd, use_unsafe_shell=True)
+
+        if check_package[0] != 0:
+            module.fail_json(
+                msg="Failed to list installed packages with {0}".format(module.params['path']),
+                changed=False,
+                stderr=check_package[2]
+            )
+        return parse_installed_packages(check_package[1])
+
+    cache = fact_cache(data_location)
+    return cache.get('ibm_imcl:{0}:{1}'.format(module.params['path'], installed_xml),
+                     [installed_xml], build)
+
+
 def package_check(module):
     """Function that will be checking target cell for package existance.
     This portion will be doing package lookups to ensure that the package being installed
     either exists in the cell, or doesn't for all module.params['state']
+    Returns a dict of package name to True/False for every requested package. A name
+    matches either a full <id>_<version> or a bare package id at any version.
+    """
+
+    index = installed_packages(module)
+    installed_ids = set(package['id'] for package in index.values())
+
+    return dict((package, package in index or package in installed_ids)
+                for package in module.params['name'])
+
+
+def nearest_existing(path):
+    """Function that returns path, or its closest parent that exists."""
+
+    path = os.path.abspath(path)
+    while not os.path.exists(path):
+        path = os.path.dirname(path)
+    return path
+
+
+def check_space(needs):
+    """Function that checks a list of (path, bytes required) against free space, summing what
+    lands on the same filesystem. Returns (path -> dict(path, required, free), description of
+    the filesystems that are short, empty when there is room).
+    """
+
+    devices, space = {}, {}
+    for path, required in needs:
+        existing = nearest_existing(path)
+        device = os.stat(existing).st_dev
+        if device not in devices:
+            stat = os.statvfs(existing)
+            devices[device] = dict(path=existing, required=0, free=stat.f_bavail * stat.f_frsize)
+        devices[device]['required'] += required
+        space[path] = devices[device]
+
+    short = [entry for entry in devices.values() if entry['free'] < entry['required']]
+    return space, ', '.join("{0} needs {1} MB, {2} MB free".format(entry['path'], entry['required'] // 1048576,
+                                                                 entry['free'] // 1048576) for entry in short)
+
+
+def preflight(module, packages):
+    """Function that checks an install or update can work before imcl is started.
+    Every package must be in a local repository in src, a bare offering id in any version,
+    and the filesystems of dest and shared_resource must have room for the estimated install,
+    summed when both are on the same filesystem. Fails straight away with the findings,
+    otherwise returns them.
     """
 
-    check_package_cmd = """{0} listInstalledPackages""".format(module.params['path'])
-    check_package = module.run_command(check_package_cmd, use_unsafe_shell=True)
+    start = time.time()
+    repos = module.params['src'].split(',') if module.params['src'] else []
+    result = dict(skipped=False, missing=[], space={})
+    if not repos or not all(is_local(repo) for repo in repos):
+        result.update(skipped=True, reason='remote repositories can not be checked')
+        return result
+
+    for repo in repos:
+        if not os.path.exists(repo[len('file:'):] if repo.startswith('file:') else repo):
+            module.fail_json(msg="Preflight failed, repository {0} does not exist".format(repo), changed=False)
+    try:
+        catalog = repository_catalog(repos)
+    except (IOError, OSError) as err:
+        module.fail_json(msg="Preflight failed, can not read repository {0}: {1}".format(module.params['src'], err),
+                         changed=False)
+
+    # A bare offering id is left for imcl to pick the latest version of, size that one.
+    located = []
+    for package in packages:
+        if '_' not in package and catalog['offerings'].get(package):
+            package = '{0}_{1}'.format(package, catalog['offerings'][package][-1])
+        located.append(package)
+    result['missing'] = [package for package in located if package not in catalog['location']]
+    if result['missing']:
+        module.fail_json(
+            msg="Preflight failed, package(s) {0} not found in {1}".format(' '.join(result['missing']),
+                                                                         module.params['src']),
+            changed=False,
+            available=dict((package.split('_', 1)[0], catalog['offerings'].get(package.split('_', 1)[0], []))
+                           for package in result['missing'])
+        )
 
-    name = module.params['name']
+    try:
+        payload = payload_size(catalog, located)
+    except (IOError, OSError) as err:
+        module.fail_json(msg="Preflight failed, can not size repository {0}: {1}".format(module.params['src'], err),
+                         changed=False)
+    result['space'], short = check_space([(module.params['dest'], int(payload * module.params['space_factor'])),
+                                          (module.params['shared_resource'], payload)])
+    result['elapsed'] = round(time.time() - start, 3)
+    if short:
+        module.fail_json(msg="Preflight failed, not enough space: {0}".format(short), changed=False,
+                         preflight=result)
+    return result
 
-    name = name.split()
-    for package in name:
-      if package in check_package[1]:
-          return 1
-      else:
-          return 0
+
+def image_roots(module):
+    """Function that maps the parts of a golden image to this host's paths."""
+
+    return dict(dest=module.params['dest'], shared=module.params['shared_resource'],
+                registry=im_data_location(module))
+
+
+def capture(module):
+    """Function that captures the install in dest as a golden image. Only installs IM has
+    recorded in its registry are captured, and every package in name must be among them.
+    The image is left alone when it already holds exactly the packages installed in dest.
+    """
+
+    dest = os.path.normpath(module.params['dest'])
+    index = installed_packages(module)
+    packages = sorted(name for name, package in index.items()
+                      if package['location'] and os.path.normpath(package['location']) == dest)
+    if not packages:
+        module.fail_json(msg="IM has nothing installed in {0} to capture".format(dest), changed=False)
+    installed_ids = set(index[package]['id'] for package in packages)
+    missing = [package for package in module.params['name'] or []
+               if package not in packages and package not in installed_ids]
+    if missing:
+        module.fail_json(msg="Package(s) {0} not installed in {1}, not capturing".format(' '.join(missing), dest),
+                         changed=False)
+
+    roots = image_roots(module)
+    agent = [package['version'] for package in index.values() if package['id'] == AGENT_ID]
+    info = dict(packages=packages, agent=agent[0] if agent else None, imcl=module.params['path'])
+    existing = read_manifest(module.params['image'])
+    if os.path.isfile(module.params['image']) and existing is not None and \
+            existing.get('packages') == packages and existing.get('roots') == roots:
+        module.exit_json(msg="Image {0} already holds {1}".format(module.params['image'], ' '.join(packages)),
+                         changed=False, image=existing)
+    if module.check_mode:
+        module.exit_json(msg="Image {0} will be captured from {1}".format(module.params['image'], dest),
+                         changed=True, image=dict(info, roots=roots))
+
+    try:
+        lock = queue_lock(queue_dir(roots['registry']))
+        try:
+            stats = capture_image([(label, roots[label]) for label in ('dest', 'shared', 'registry')],
+                                  module.params['image'], info, module.params['compression'], module.params['workers'])
+        finally:
+            lock.close()
+    except (IOError, OSError) as err:
+        module.fail_json(msg="Failed to capture image {0}: {1}".format(module.params['image'], err), changed=False)
+
+    module.exit_json(
+        msg="Captured {0} into {1}".format(' '.join(packages), module.params['image']),
+        changed=True,
+        image=dict(read_manifest(module.params['image']), stats=stats),
+        packages=package_status(packages, [], 'captured')
+    )
+
+
+def install_image(module):
+    """Function that installs dest from a golden image instead of running imcl.
+    Nothing is touched unless the image fits this host, see target_problems, and has
+    verified completely; the directories it replaces are kept aside until then.
+    """
+
+    image = module.params['image']
+    manifest = read_manifest(image)
+    if not os.path.isfile(image) or manifest is None:
+        module.fail_json(msg="{0} is not an IM image, its manifest {0}.json is missing".format(image), changed=False)
+
+    index = installed_packages(module)
+    packages = manifest['packages']
+    wanted = [package for package in module.params['name'] or []
+              if package not in packages and package not in set(name.split('_', 1)[0] for name in packages)]
+    if wanted:
+        module.fail_json(msg="Image {0} does not hold {1}".format(image, ' '.join(wanted)), changed=False,
+                         image=manifest)
+    if all(package in index for package in packages):
+        module.exit_json(msg="Package(s) {0} already present.".format(' '.join(packages)), changed=False,
+                         packages=package_status([], packages, 'installed'))
+
+    roots = image_roots(module)
+    problems = target_problems(manifest, roots, index, module.params['path'])
+    space, short = check_space([(roots[label], manifest['bytes'][label]) for label in ('dest', 'shared', 'registry')])
+    if short:
+        problems.append("not enough space: {0}".format(short))
+    if problems:
+        module.fail_json(msg="Image {0} can not be installed here: {1}".format(image, '; '.join(problems)),
+                         changed=False, image=manifest)
+    if module.check_mode:
+        module.exit_json(msg="Package(s) {0} will be installed from image {1}".format(' '.join(packages), image),
+                         changed=True, image=manifest, packages=package_status(packages, [], 'installed'))
+
+    try:
+        lock = queue_lock(queue_dir(roots['registry']))
+        try:
+            manifest, staging, stats = extract_image(image, roots)
+            previous = place_image(staging, roots)
+        finally:
+            lock.close()
+    except (IOError, OSError) as err:
+        module.fail_json(msg="Failed to install image {0}: {1}".format(image, err), changed=False)
+
+    left_behind = []
+    for label in ('dest', 'shared'):
+        if previous[label] is not None:
+            try:
+                os.rmdir(previous[label])
+            except OSError as err:
+                left_behind.append(previous[label])
+                module.warn("Could not remove the previous {0} {1}: {2}".format(label, previous[label], err.strerror))
+    del manifest['files']
+    module.exit_json(
+        msg="Succesfully installed package(s): {0} from image {1} to location: {2}".format(' '.join(packages),
+                                                                                         image, module.params['dest']),
+        changed=True,
+        image=dict(manifest, stats=stats, previous_registry=previous['registry'], left_behind=left_behind),
+        packages=package_status(packages, [], 'installed')
+    )
+
+
+def collect_shared(module):
+    """Function that prunes the artifacts in shared_resource that no installed offering, nor a
+    rollback within rollback_depth, needs any more. Queued imcl operations are held off while
+    shared_resource is scanned and pruned.
+    """
+
+    shared = module.params['shared_resource']
+    index = installed_packages(module)
+    try:
+        lock = queue_lock(queue_dir(im_data_location(module)))
+        try:
+            plan = plan_gc(scan_shared(shared), index, module.params['rollback_depth'])
+            if plan['reclaim'] and not module.check_mode:
+                plan['stats'] = purge([artifact['path'] for artifact in plan['reclaim']], module.params['workers'])
+        finally:
+            lock.close()
+    except (IOError, OSError) as err:
+        module.fail_json(msg="Failed to collect {0}: {1}".format(shared, err), changed=False)
+
+    if plan.get('stats', {}).get('errors'):
+        module.fail_json(msg="Failed to remove some artifacts from {0}".format(shared), changed=True, shared=plan)
+    if not plan['reclaim']:
+        module.exit_json(msg="Nothing to reclaim in {0}, {1} MB retained".format(shared, plan['retained_bytes'] // 1048576),
+                         changed=False, shared=plan)
+    module.exit_json(
+        msg="{0} {1} MB in {2} artifact(s) from {3}, {4} MB retained".format(
+            'Would reclaim' if module.check_mode else 'Reclaimed', plan['reclaim_bytes'] // 1048576,
+            len(plan['reclaim']), shared, plan['retained_bytes'] // 1048576),
+        changed=bool(plan['reclaim']),
+        shared=plan
+    )
+
+
+def resolve_packages(module):
+    """Function that turns bare offering ids in name into <id>_<version> using the version param.
+    present and update pick from the local repositories in src, absent and rollback from the
+    installed packages. Fails when an id has no version matching.
+    """
+
+    version = module.params['version']
+    bare = [package for package in module.params['name'] if '_' not in package]
+    if version is None or not bare:
+        return module.params['name']
+
+    if module.params['state'] in ('present', 'update'):
+        if not module.params['src']:
+            module.fail_json(msg="src is required to resolve version {0}".format(version), changed=False)
+        try:
+            index = repository_index(module.params['src'].split(','))
+        except (IOError, OSError) as err:
+            module.fail_json(msg="Failed to read repository {0}: {1}".format(module.params['src'], err),
+                             changed=False)
+    else:
+        index = {}
+        for package in installed_packages(module).values():
+            index.setdefault(package['id'], []).append(package['version'])
+
+    resolved = {}
+    for package in bare:
+        resolved[package] = resolve_offering(index, package, version)
+        if resolved[package] is None:
+            module.fail_json(
+                msg="No version of {0} matching {1} found{2}".format(
+                    package, version, ' in ' + module.params['src'] if module.params['state'] in ('present', 'update')
+                    else ' installed'),
+                changed=False,
+                available=sorted(index.get(package, []))
+            )
+    return [resolved.get(package, package) for package in module.params['name']]
 
 
 def main():
@@ -354,74 +939,98 @@ def main():
     module = AnsibleModule(
         argument_spec=dict(
             remove_all=dict(type='str', required=False, choices=['yes', 'no'], default='no'),
-            state=dict(type='str', required=True, choices=['present', 'absent', 'update', 'rollback']),
+            state=dict(type='str', required=True, choices=['present', 'absent', 'update', 'rollback', 'capture', 'gc']),
             src=dict(type='str', required=False),
             dest=dict(type='str', required=False),
             path=dict(type='str', required=True),
-            name=dict(type='str', required=False),
+            name=dict(type='list', required=False),
             shared_resource=dict(type='str', required=False),
             secure_storage=dict(type='str', required=False, default=None),
             password_file=dict(type='str', required=False, default=None),
-            properties=dict(type='str', required=False, default=None)
+            properties=dict(type='str', required=False, default=None),
+            data_location=dict(type='str', required=False, default=None),
+            version=dict(type='str', required=False, default=None),
+            preflight=dict(type='bool', required=False, default=True),
+            space_factor=dict(type='float', required=False, default=2.0),
+            queue=dict(type='bool', required=False, default=True),
+            queue_window=dict(type='float', required=False, default=2.0),
+            image=dict(type='str', required=False, default=None),
+            compression=dict(type='str', required=False, choices=['gzip', 'zstd'], default='gzip'),
+            workers=dict(type='int', required=False, default=4),
+            rollback_depth=dict(type='int', required=False, default=1)
         ),
         supports_check_mode = True,
         required_if=[
-            ["state","present", ["dest", "shared_resource"],
-            ["state","update", ["dest", "shared_resource"],
-            [["secure_storage", "!None", ["password_file"]]]]]]
+            ["state", "present", ["dest", "shared_resource"]],
+            ["state", "update", ["dest", "shared_resource"]],
+            ["state", "capture", ["dest", "shared_resource", "image"]],
+            ["state", "gc", ["shared_resource"]]
+        ],
+        required_together=[["secure_storage", "password_file"]]
     )
 
     remove_all = module.params['remove_all']
     state = module.params['state']
-    src = module.params['src']
     dest = module.params['dest']
-    path = module.params['path']
-    name = module.params['name']
-    shared_resource = module.params['shared_resource']
     secure_storage = module.params['secure_storage']
-    password_file =  module.params['password_file']
-    properties = module.params['properties']
 
     if remove_all == 'yes':
+        if module.check_mode:
+            module.exit_json(msg="All packages will be removed", changed=True)
         uninstall(module)
 
+    if module.params['name']:
+        module.params['name'] = [package for names in module.params['name'] for package in names.split()]
+    if state == 'capture':
+        capture(module)
+    if state == 'gc':
+        collect_shared(module)
+    if state == 'present' and module.params['image'] is not None:
+        install_image(module)
+
+    if not module.params['name']:
+        module.fail_json(msg="name is required unless remove_all is yes", changed=False)
+
+    module.params['name'] = resolve_packages(module)
+
     pckg_check = package_check(module)
 
+    present = [package for package in module.params['name'] if pckg_check[package]]
+    missing = [package for package in module.params['name'] if not pckg_check[package]]
 
-    if pckg_check != 1:
-        if (state == 'present') and not (module.check_mode):
-            install_package_local(module)
-        if (state == 'present') and (secure_storage is not None) and not (module.check_mode):
-            install_package_remote(module)
-        if (state == 'update') and (secure_storage is None) and not (module.check_mode):
-            update_package_local(module)
-        if (state == 'update') and (secure_storage is not None) and not (module.check_mode):
-            update_package_remote(module)
-        if (state == 'rollback') and not (module.check_mode):
-            rollback_package(module)
+    if state in ('present', 'update'):
+        action = 'installed' if state == 'present' else 'updated'
+        if not missing:
+            module.exit_json(msg="Package(s) {0} already present.".format(' '.join(present)),
+                changed=False,
+                packages=package_status([], present, action))
+        checks = preflight(module, missing) if module.params['preflight'] else None
         if module.check_mode:
-            if state == 'present':
-                module.exit_json(msg="Package: {0} will be installed to location {1}".format(name,dest),change=True)
-            if state == 'update':
-                module.exit_json(msg="Package: {0} will be updated".format(name),changed=True)
-            if state == 'absent':
-                module.exit_json(msg="Package: {0} is not present in cell. Nothing to remove.".format(name),changed=False)
-            if (state == 'rollback'):
-                module.exit_json(msg="Package {0} is not present to rollback".format(name),changed=False)
-    elif pckg_check != 0:
-        if (state == 'present'):
-            module.exit_json(msg="Package {0} is already present.".format(name),changed=False)
-        if (state == 'absent') and not (module.check_mode):
-            uninstall_package(module)
-        if (state == 'update') and not (module.check_mode):
-            module.exit_json(msg="Package {0} is already present.".format(name),changed=False)
-        if (state == 'rollback') and not (module.check_mode):
-            module.exit_json(msg="Package {0} not is not present to rollback.".format(name), changed=False)
+            module.exit_json(msg="Package(s) {0} will be {1} to location {2}".format(' '.join(missing), action, dest),
+                changed=True,
+                packages=package_status(missing, present, action),
+                preflight=checks)
+        if state == 'present' and secure_storage is None:
+            install_package_local(module, missing, present)
+        if state == 'present':
+            install_package_remote(module, missing, present)
+        if secure_storage is None:
+            update_package_local(module, missing, present)
+        update_package_remote(module, missing, present)
+
+    if state in ('absent', 'rollback'):
+        action = 'removed' if state == 'absent' else 'rolled back'
+        if not present:
+            module.exit_json(msg="Package(s) {0} not present in cell. Nothing to do.".format(' '.join(missing)),
+                changed=False,
+                packages=package_status([], missing, action))
         if module.check_mode:
-            if (state == 'absent'):
-                module.exit_json(msg="Package {0} will be removed.".format(name),changed=True)
-            if (state == 'rollback'):
-                module.exit_json(msg="Package {0} will be rolled back".format(name),changed=True)
+            module.exit_json(msg="Package(s) {0} will be {1}".format(' '.join(present), action),
+                changed=True,
+                packages=package_status(present, missing, action))
+        if state == 'absent':
+            uninstall(module, present, missing)
+        rollback_package(module, present, missing)
 
 
 if __name__ == '__main__':
@@ -1,8 +1,11 @@
 #!/usr/bin/python
 
 
-import os
 from ansible.module_utils.basic import *
+from ansible.module_utils.ibm_logwatch import log_offset, wait_for_ready
+from ansible.module_utils.ibm_process import jvm_status, server_status
+from ansible.module_utils.ibm_serverindex import query_endpoints
+import time
 
 
 ANSIBLE_METADATA = {
@@ -33,6 +36,7 @@ options:
         choices:
           - start
           - stop
+          - check
     path:
         description:
             - Path of IBM Install root. E.g /opt/WebSphere/AppServer.
@@ -41,6 +45,21 @@ options:
         description:
             - Name of IBM Profile that the node agent belongs to.
         required: true
+    start_mode:
+        description:
+            - How start decides the Deployment Manager is up.
+            - script waits for startManager.sh to return.
+            - log runs startManager.sh -nowait and tails SystemOut.log until WSVR0001I open for e-business is written.
+        required: false
+        default: script
+        choices:
+          - script
+          - log
+    start_timeout:
+        description:
+            - With start_mode log, seconds to wait for the Deployment Manager to report open for e-business.
+        required: false
+        default: 300
 
 
 author:
@@ -59,6 +78,12 @@ EXAMPLES = '''
     state: stop
     path: /opt/WebSphere/AppServer
     profile: DmgrProfile
+- name: Start Deployment Manager and wait for it to be open for e-business
+  ibm_manager:
+    state: start
+    path: /opt/WebSphere/AppServer
+    profile: Dmgr01
+    start_mode: log
 '''
 
 
@@ -72,24 +97,30 @@ message:
 '''
 
 
+def manager_running(path, profile):
+    """Function that checks whether the dmgr .pid file points at a live java process."""
+
+    return server_status(path+"/profiles/"+profile, 'dmgr')['state'] == 'running'
+
+
 def stop_manager(module,path,profile):
     """Function to send IBM Deployment Manager into a stopped state.
     This function is idempotent, meaning it will only stop the dmgr profile
     if it is up and running. Function will do a filesystem check for a .pid file
-    in the WAS_ROOT/profiles/logs/dmgr/ directory. If a .pid file exists, it is assumed
-    that the deployment manager is running.
+    in the WAS_ROOT/profiles/logs/dmgr/ directory. If the .pid file points at a live
+    java process, the deployment manager is running.
     """
 
-    if  os.path.exists(path+"/profiles/"+profile+"/logs/dmgr/dmgr.pid"):
+    if manager_running(path, profile):
         stop_dmgr  = module.run_command(path+'/profiles/'+profile+'/bin/stopManager.sh', use_unsafe_shell=True)
         if stop_dmgr[0] != 0:
             module.fail_json(
-                msg='Failed to send Deployment Manager into %s for profile %s' % (state, profile),
+                msg='Failed to send Deployment Manager into %s for profile %s' % ('stop', profile),
                 changed=False,
-                stderr=start_dmgr[2]
+                stderr=stop_dmgr[2]
             )
         module.exit_json(
-            msg='Succesfully sent Deployment Manager into % state for profile %s' % (state, profile),
+            msg='Succesfully sent Deployment Manager into %s state for profile %s' % ('stop', profile),
             changed=True
         )
     else:
@@ -101,19 +132,40 @@ def stop_manager(module,path,profile):
 def start_manager(module,path,profile):
     """Function that will send IBM Deployment Manager into a started state.
     This function is idempotent. Meaning that it will only start the deploymment manager if it is not running.
-    Function does a filesystem check to see if a .pid file exists. If file exits, module will return a OK run call.
+    Function checks whether the .pid file points at a live java process. If it does, module will return a OK run call.
     """
 
-    if not os.path.exists(path+"/profiles/"+profile+"/logs/dmgr/dmgr.pid"):
-        start_dmgr = module.run_command(path+'/profiles/'+profile+'/bin/startManager.sh', use_unsafe_shell=True)
+    if not manager_running(path, profile):
+        profile_root = path+'/profiles/'+profile
+        log_mode = module.params['start_mode'] == 'log'
+        offset = log_offset(profile_root+'/logs/dmgr/SystemOut.log')
+        started = time.time()
+        start_dmgr = module.run_command(profile_root+'/bin/startManager.sh'+(' -nowait' if log_mode else ''),
+                                        use_unsafe_shell=True)
         if start_dmgr[0] != 0:
             module.fail_json(
-                msg='Failed to send Deployment Manager %s for profile %s' % (state),
+                msg='Failed to send Deployment Manager %s for profile %s' % ('start', profile),
                 changed=False,
                 stderr=start_dmgr[2]
             )
+        if log_mode:
+            ready = wait_for_ready(profile_root+'/logs/dmgr/SystemOut.log', offset,
+                                   module.params['start_timeout'], started=started,
+                                   alive=lambda: server_status(profile_root, 'dmgr')['state'] != 'stale')
+            if ready['state'] != 'ready':
+                module.fail_json(
+                    msg='Deployment Manager was not open for e-business for profile %s (%s)' % (profile, ready['state']),
+                    changed=True,
+                    ready=ready
+                )
+            module.exit_json(
+                msg='Deployment Manager is open for e-business for profile %s' % (profile),
+                changed=True,
+                ready_seconds=ready['ready_seconds'],
+                first_error=ready['first_error']
+            )
         module.exit_json(
-            msg='Succesfully sent Deployment Manager into % state for profile %s' % (state),
+            msg='Succesfully sent Deployment Manager into %s state for profile %s' % ('start', profile),
             changed=True
         )
     else:
@@ -122,6 +174,25 @@ def start_manager(module,path,profile):
         )
 
 
+def check_manager(module,path,profile):
+    """Function that reports Deployment Manager state without starting a JVM.
+    The .pid file is verified through /proc and the dmgr SOAP port, looked up
+    in the cached serverindex.xml endpoint index, is probed.
+    """
+
+    profile_root = path+"/profiles/"+profile
+    endpoints = query_endpoints(profile_root, 'dmgr')
+    soap = endpoints.get('SOAP_CONNECTOR_ADDRESS', {})
+    status = jvm_status(profile_root, 'dmgr', soap.get('host'), soap.get('port'))
+
+    module.exit_json(
+        msg='Deployment Manager is %s for profile %s' % (status['state'], profile),
+        changed=False,
+        status=status,
+        endpoints=endpoints
+    )
+
+
 def main():
     """
 	Main Module logic.
@@ -130,9 +201,11 @@ def main():
 
     module = AnsibleModule(
         argument_spec=dict(
-            state=dict(type='str', required=True, choices=['start', 'stop']),
+            state=dict(type='str', required=True, choices=['check', 'start', 'stop']),
             profile=dict(type='str', required=True),
-            path=dict(type='str', required=True)
+            path=dict(type='str', required=True),
+            start_mode=dict(type='str', required=False, choices=['script', 'log'], default='script'),
+            start_timeout=dict(type='int', required=False, default=300)
         ),
         supports_check_mode = True
     )
@@ -142,6 +215,9 @@ def main():
     path = module.params['path']
 
 
+    if state == 'check':
+        check_manager(module, path, profile)
+
     if state == 'start' and not module.check_mode:
         start_manager(module, path, profile)
 
@@ -150,7 +226,7 @@ def main():
 
     if module.check_mode:
         if state == 'stop':
-            if  os.path.exists(path+"/profiles/"+profile+"/logs/dmgr/dmgr.pid"):
+            if manager_running(path, profile):
                 module.exit_json(
                     msg='Sending Deployment Manager into %s' % (state),
                     changed=True
@@ -161,7 +237,7 @@ def main():
                     changed=False
                 )
         if state == 'start':
-            if  os.path.exists(path+"/profiles/"+profile+"/logs/dmgr/dmgr.pid"):
+            if manager_running(path, profile):
                 module.exit_json(
                     msg='Deployment Manager already in a %s state ' %(state),
                     changed=False
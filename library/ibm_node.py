@@ -1,7 +1,10 @@
 #!/usr/bin/python
 
-import os
 from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils.ibm_logwatch import log_offset, wait_for_ready
+from ansible.module_utils.ibm_process import jvm_status, server_status
+from ansible.module_utils.ibm_serverindex import query_endpoints
+import time
 
 ANSIBLE_METADATA = {
     'metadata_version': '1.1',
@@ -29,6 +32,7 @@ options:
         choices: 
           - start
           - stop
+          - check
     path:
         description:
             - Path of IBM Install root. E.g /opt/WebSphere/AppServer.
@@ -37,6 +41,21 @@ options:
         description:
             - Name of IBM Profile that the node agent belongs to.
         required: true
+    start_mode:
+        description:
+            - How start decides the node agent is up.
+            - script waits for startNode.sh to return.
+            - log runs startNode.sh -nowait and tails SystemOut.log until WSVR0001I open for e-business is written.
+        required: false
+        default: script
+        choices:
+          - script
+          - log
+    start_timeout:
+        description:
+            - With start_mode log, seconds to wait for the node agent to report open for e-business.
+        required: false
+        default: 300
 
 
 author:
@@ -49,11 +68,23 @@ EXAMPLES = '''
     state: start
     path: /opt/WebSphere/AppServer
     profile: AppSrv01
+- name: Start Node Agent and wait for it to be open for e-business
+  ibm_node:
+    state: start
+    path: /opt/WebSphere/AppServer
+    profile: AppSrv01
+    start_mode: log
+    start_timeout: 120
 - name: Stop Node Agent
   ibm_node:
     state: stop
     path: /opt/WebSphere/AppServer
     profile: AppSrv01
+- name: Check Node Agent without starting a JVM
+  ibm_node:
+    state: check
+    path: /opt/WebSphere/AppServer
+    profile: AppSrv01
 '''
 
 RETURN = '''
@@ -65,14 +96,20 @@ message:
 
 '''
 
+def node_running(path, profile):
+    """Function that checks whether the node agent's .pid file points at a live java process."""
+
+    return server_status(path+'/profiles/'+profile, 'nodeagent')['state'] == 'running'
+
+
 def stop_node(module,state,path,profile):
     """Function that will stop IBM Node agent.
     Function is idempotent and will only stop if running.
-    To determine running state, we will check for the default .pid
-    location to determine state. Below are the return results:
+    To determine running state, we will check that the default .pid
+    location points at a live java process.
     """
 
-    if state == 'stop' and os.path.exists(path+'/profiles/'+profile+'/logs/nodeagent/nodeagent.pid'):
+    if state == 'stop' and node_running(path, profile):
         stop_node =  module.run_command(path+'/profiles/'+profile+'/bin/stopNode.sh', use_unsafe_shell=True)
 
         if stop_node[0] != 0:
@@ -94,20 +131,41 @@ def stop_node(module,state,path,profile):
 def start_node(module,state,path,profile):
     """Function that will start Node Agent if stopped.
     Function is idempotent and will only start if stopped.
-    To determine running state we will check for the default .pid
-    location to determine state.
+    To determine running state we will check that the default .pid
+    location points at a live java process.
     """
 
-    if not os.path.exists(path+'/profiles/'+profile+'/logs/nodeagent/nodeagent.pid'):
-        start_node = module.run_command(path+'/profiles/'+profile+'/bin/startNode.sh', use_unsafe_shell=True)
+    if not node_running(path, profile):
+        profile_root = path+'/profiles/'+profile
+        log_mode = module.params['start_mode'] == 'log'
+        offset = log_offset(profile_root+'/logs/nodeagent/SystemOut.log')
+        started = time.time()
+        start_node = module.run_command(profile_root+'/bin/startNode.sh'+(' -nowait' if log_mode else ''),
+                                        use_unsafe_shell=True)
         if start_node[0] != 0:
             module.fail_json(
                 msg='Failed to send node agent into %s for profile %s' % (state, profile),
                 changed=False,
                 stderr=start_node[2]
             )
+        if log_mode:
+            ready = wait_for_ready(profile_root+'/logs/nodeagent/SystemOut.log', offset,
+                                   module.params['start_timeout'], started=started,
+                                   alive=lambda: server_status(profile_root, 'nodeagent')['state'] != 'stale')
+            if ready['state'] != 'ready':
+                module.fail_json(
+                    msg='Node agent was not open for e-business for profile %s (%s)' % (profile, ready['state']),
+                    changed=True,
+                    ready=ready
+                )
+            module.exit_json(
+                msg='Node agent is open for e-business for profile %s' % (profile),
+                changed=True,
+                ready_seconds=ready['ready_seconds'],
+                first_error=ready['first_error']
+            )
         module.exit_json(
-            msg='Succesfully sent node agent into % state for profile %s' % (state, profile),
+            msg='Succesfully sent node agent into %s state for profile %s' % (state, profile),
             changed=True
         )
     else:
@@ -115,15 +173,35 @@ def start_node(module,state,path,profile):
             msg='>>>>>>>> Node agent is already running <<<<<<<<'
         )
 
+def check_node(module,path,profile):
+    """Function that reports node agent state without starting a JVM.
+    The .pid file is verified through /proc and the node agent's SOAP port,
+    looked up in the cached serverindex.xml endpoint index, is probed.
+    """
+
+    profile_root = path+'/profiles/'+profile
+    endpoints = query_endpoints(profile_root, 'nodeagent')
+    soap = endpoints.get('SOAP_CONNECTOR_ADDRESS', {})
+    status = jvm_status(profile_root, 'nodeagent', soap.get('host'), soap.get('port'))
+
+    module.exit_json(
+        msg='Node agent is %s for profile %s' % (status['state'], profile),
+        changed=False,
+        status=status,
+        endpoints=endpoints
+    )
+
 def main():
     """Main Function of the module.
     Function will import other modules into main body to run the main logic"""
 
     module = AnsibleModule(
         argument_spec=dict(
-            state=dict(type='str', required=True),
+            state=dict(type='str', required=True, choices=['check', 'start', 'stop']),
             path=dict(type='str', required=True),
-            profile=dict(type='str', required=True)
+            profile=dict(type='str', required=True),
+            start_mode=dict(type='str', required=False, choices=['script', 'log'], default='script'),
+            start_timeout=dict(type='int', required=False, default=300)
         ),
         supports_check_mode = True
     )
@@ -132,6 +210,9 @@ def main():
     path = module.params['path']
     profile = module.params['profile']
 
+    if state == 'check':
+        check_node(module,path,profile)
+
     if state == 'stop' and not module.check_mode:
         stop_node(module,state,path,profile)
 
@@ -140,7 +221,7 @@ def main():
 
     if module.check_mode:
         if state == 'stop':
-            if os.path.exists("%s/profiles/%s/logs/nodeagent/nodeagent.pid"):
+            if node_running(path, profile):
                 module.exit_json(
                     msg="Sending Nodeagent into %s state" % (state),
                     changed=True
@@ -152,7 +233,7 @@ def main():
                 )
 
         if state == 'start':
-            if not os.path.exists("%s/profiles/%s/logs/nodeagent/nodeagent.pid"):
+            if not node_running(path, profile):
                 module.exit_json(
                     msg="Sending node agent into %s state." % (state),
                     changed=True
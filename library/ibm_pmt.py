@@ -1,7 +1,15 @@
 #!/usr/bin/python
 
 import os
+import re
+import time
 from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils.ibm_backup import (ARCHIVE_SUFFIX, HAS_ZSTD, discard, extract_archive,
+                                              find_manifest, incremental_backup, restore_manifest,
+                                              staging_dir, swap_into_place, validate_archive,
+                                              write_archive)
+from ansible.module_utils.ibm_parallel import KeyedSemaphore, run_parallel, timed
+from ansible.module_utils.ibm_profiles import forget, get_profile, read_profile_registry
 
 
 ANSIBLE_METADATA = {
@@ -36,17 +44,64 @@ options:
             - Password to be used with admin account
         required: false
         required_if: security is true
+    archive:
+        description:
+            - Archive to restore with backup_mode archive, a backupConfig.sh zip or a .tar.gz/.tar.zst
+            - written by backup_mode archive. Defaults to the newest <dest>/<profile>_backup archive.
+        required: false
+    backup_mode:
+        description:
+            - How state backup and restore handle the profile configuration.
+            - full uses backupConfig.sh and restoreConfig.sh with a zip archive in dest.
+            - incremental hashes the files under <profile_path>/config and only stores changed
+            - files in a content addressed chunk store at dest, plus one small manifest per run.
+            - Any manifest can be restored on its own, see restore_point.
+            - archive streams <profile_path>/config into <dest>/<profile>_backup.tar.gz (or .tar.zst)
+            - compressed on workers threads, and reports throughput and compression ratio.
+            - With state restore, archive validates the whole archive (zip CRCs, or the recorded sha256
+            - of a tar archive) first, extracts it in parallel into a staging directory and then swaps
+            - the staging directory in for <profile_path>/config. restoreConfig.sh is not used.
+        required: false
+        default: full
+        choices:
+            - archive
+            - full
+            - incremental
+    compression:
+        description:
+            - Compression used by backup_mode archive. gzip compresses blocks in parallel as
+            - independent gzip members, zstd needs the zstandard python library on the target host.
+        required: false
+        default: gzip
+        choices:
+            - gzip
+            - zstd
+    compression_level:
+        description:
+            - Compression level for backup_mode archive. Defaults to 6 for gzip and 3 for zstd.
+        required: false
     dest:
         description:
             - Path to for location of profile backup.
             - If no module.params[path] is specified, defaults to
             - profile_module.params[path]/config/backups/ directory
+            - With backup_mode incremental this is the chunk store directory, which can be shared between profiles.
         required: false
         required_if: state is backup or restore
     dmgr_host:
         description:
             - HostName or IP Address of server where deployment manager resides
         required: false
+    dmgr_port:
+        description:
+            - SOAP port of the deployment manager used by addNode.sh when federating profiles.
+        required: false
+        default: 8879
+    federation_limit:
+        description:
+            - Number of profiles that may federate into the same deployment manager at once.
+        required: false
+        default: 1
     module.params[path]:
         description:
             - Path of IBM Install root. E.g /opt/IBM/WebSphere/AppServer.
@@ -54,11 +109,20 @@ options:
     profile:
         description:
             - The name of the profile that will be created
-        required: true
+            - Either profile or profiles is required.
+        required: false
+    profiles:
+        description:
+            - List of custom profiles to create on one host. Each entry is a profile name or a dict
+            - with profile and optional profile_path, dmgr_host, dmgr_port, admin_user and admin_password.
+            - Profiles are created concurrently, then federated through addNode.sh.
+            - Per profile status and timings are returned in profiles.
+        required: false
     profile_module.params[path]:
         description:
             - Path of newly created profile. E.g /opt/IBM/WebSphere/AppServer/profiles/Custom01
-        required: true
+            - For existing profiles this defaults to the path recorded in profileRegistry.xml.
+        required: false
     profile_type:
         description:
             - Type of profile to be created.
@@ -66,6 +130,18 @@ options:
         choices:
             - managment
             - custom
+    restore_point:
+        description:
+            - Manifest to restore with backup_mode incremental, e.g 20190301T020000.123, or
+            - 20190301T020000 for the latest manifest written in that second.
+            - Defaults to the latest manifest for the profile.
+        required: false
+    workers:
+        description:
+            - Number of profiles created at the same time when profiles is given.
+            - Also the number of compression, validation and extraction threads for backup_mode archive.
+        required: false
+        default: 4
 
 author:
     - Tom Davison (@tntdavison784)
@@ -93,6 +169,19 @@ EXAMPLES = '''
     profile: Custom01
     profile_type: custom
     dmgr_host: localhost
+- name: create several custom profiles in parallel
+  ibm_pmt:
+    state: present
+    admin_user: MyAdmin
+    admin_password: MyPassword
+    path: /opt/IBM/WebSphere/AppServer
+    dmgr_host: dmgr01.example.com
+    workers: 4
+    profiles:
+      - Custom01
+      - Custom02
+      - profile: Custom03
+        profile_path: /opt/IBM/profiles/Custom03
 - name: backup profile
   ibm_pmt:
     state: backup
@@ -100,6 +189,29 @@ EXAMPLES = '''
     admin_passwd: admin123
     profile_module.params[path]: /opt/WebSphere/AppServer/profiles/Custom01
     dest: /tmp/Custom01_backup.zip
+- name: incremental backup of a profile into a shared chunk store
+  ibm_pmt:
+    state: backup
+    backup_mode: incremental
+    profile: Custom01
+    path: /opt/WebSphere/AppServer
+    dest: /nfs/was_backups
+- name: archive backup compressed on 16 threads
+  ibm_pmt:
+    state: backup
+    backup_mode: archive
+    profile: Custom01
+    path: /opt/WebSphere/AppServer
+    dest: /nfs/was_backups
+    workers: 16
+- name: restore profile to an earlier point in time
+  ibm_pmt:
+    state: restore
+    backup_mode: incremental
+    profile: Custom01
+    path: /opt/WebSphere/AppServer
+    dest: /nfs/was_backups
+    restore_point: 20190301T020000
 - name: restore profile
   ibm_pmt:
     state: restore
@@ -153,6 +265,7 @@ def make_managerProfile(module):
             stderr=mngr_acct_create[2],
             stdout=mngr_acct_create[1]
         )
+    forget(module.params['path'])
     module.exit_json(
         msg="Succesfully created account {0}".format(module.params['profile']),
         changed=True
@@ -179,27 +292,190 @@ module.params['path'], module.params['profile'], module.params['dmgr_host'])
                 stderr=cstm_account_create[2],
                 stdout=cstm_account_create[1]
         )
+    forget(module.params['path'])
     module.exit_json(
             msg="Successfully created account {0}".format(module.params['profile']),
             changed=True
     )
 
 
+def list_profiles(module):
+    """
+    Function that returns the names of every profile registered
+    with the IBM WebSphere install. Names are read from profileRegistry.xml,
+    manageprofiles -listProfiles is only run when the registry can't be found.
+    """
+
+    try:
+        registry = read_profile_registry(module.params['path'])
+    except ValueError as err:
+        module.fail_json(msg=str(err), changed=False)
+    if registry is not None:
+        return set(registry)
+
+    list_profiles_cmd = "{0}/bin/manageprofiles.sh -listProfiles".format(module.params['path'])
+    profiles_list = module.run_command(list_profiles_cmd, use_unsafe_shell=True)
+
+    if profiles_list[0] != 0:
+        module.fail_json(
+                msg="Failed to list profiles under {0}".format(module.params['path']),
+                changed=False,
+                stderr=profiles_list[2],
+                stdout=profiles_list[1]
+        )
+
+    listed = [line for line in profiles_list[1].splitlines() if line.strip().startswith('[')]
+    if not listed:
+        return set()
+    return set(name.strip() for name in listed[-1].strip().strip('[]').split(',') if name.strip())
+
+
+def run_manageprofiles(module, cmd, retries=3):
+    """
+    Function that runs a manageprofiles command. Concurrent runs against
+    the same install can trip over the profile registry lock, in which
+    case the command is retried with a short back off.
+    """
+
+    for attempt in range(retries + 1):
+        result = module.run_command(cmd, use_unsafe_shell=True)
+        if result[0] == 0 or attempt == retries:
+            return result
+        if not re.search(r'lock', result[1] + result[2], re.IGNORECASE):
+            return result
+        time.sleep(5 * (attempt + 1))
+
+
+def create_custom_profile(module, definition, federation_lock):
+    """
+    Function that creates one custom profile and federates it into the cell.
+    Profiles are created with -federateLater so manageprofiles can run in
+    parallel, federation through addNode.sh is throttled per deployment manager.
+    Runs inside the worker pool, so the outcome is returned instead of exiting.
+    """
+
+    result = dict(profile=definition['profile'], profile_path=definition['profile_path'],
+                  dmgr_host=definition['dmgr_host'], changed=False, status='failed')
+    start = time.time()
+
+    create_profile_cmd = "{0}/bin/manageprofiles.sh -create \
+-templatePath {0}/profileTemplates/managed/ \
+-profileName {1} -profilePath {2} -federateLater true".format(module.params['path'],
+definition['profile'], definition['profile_path'])
+
+    cstm_account_create, result['create_seconds'] = timed(run_manageprofiles, module, create_profile_cmd)
+    if cstm_account_create[0] != 0:
+        result.update(msg="Failed to create account {0}".format(definition['profile']),
+                      stderr=cstm_account_create[2], stdout=cstm_account_create[1],
+                      elapsed=round(time.time() - start, 3))
+        return result
+    forget(module.params['path'])
+    result.update(changed=True, status='created')
+
+    if definition['dmgr_host'] is not None:
+        add_node_cmd = "{0}/bin/addNode.sh {1} {2}".format(definition['profile_path'],
+                definition['dmgr_host'], definition['dmgr_port'])
+        if definition['admin_user'] is not None:
+            add_node_cmd += " -username {0} -password {1}".format(definition['admin_user'],
+                    definition['admin_password'])
+
+        with federation_lock(definition['dmgr_host']):
+            add_node, result['federate_seconds'] = timed(module.run_command, add_node_cmd,
+                                                         use_unsafe_shell=True)
+        if add_node[0] != 0:
+            result.update(status='failed',
+                          msg="Created account {0} but failed to federate it to {1}".format(definition['profile'],
+                              definition['dmgr_host']),
+                          stderr=add_node[2], stdout=add_node[1])
+        else:
+            result['status'] = 'federated'
+
+    result['elapsed'] = round(time.time() - start, 3)
+    return result
+
+
+def make_customProfiles(module):
+    """
+    Function that creates a list of custom profiles on one host.
+    Profiles are created concurrently by a bounded worker pool, federation
+    calls against the same deployment manager are serialized.
+    """
+
+    definitions = []
+    for definition in module.params['profiles']:
+        if isinstance(definition, str):
+            definition = dict(profile=definition)
+        if not definition.get('profile'):
+            module.fail_json(msg="Every entry in profiles needs a profile name", changed=False)
+        definitions.append(dict(
+            profile=definition['profile'],
+            profile_path=definition.get('profile_path') or "{0}/profiles/{1}".format(module.params['path'],
+                definition['profile']),
+            dmgr_host=definition.get('dmgr_host', module.params['dmgr_host']),
+            dmgr_port=definition.get('dmgr_port', module.params['dmgr_port']),
+            admin_user=definition.get('admin_user', module.params['admin_user']),
+            admin_password=definition.get('admin_password', module.params['admin_password'])
+        ))
+
+    existing = list_profiles(module)
+    skipped = [dict(profile=definition['profile'], profile_path=definition['profile_path'],
+                    changed=False, status='exists')
+               for definition in definitions if definition['profile'] in existing]
+    todo = [definition for definition in definitions if definition['profile'] not in existing]
+
+    if not todo:
+        module.exit_json(
+            msg="Profiles {0} already exist in cell".format(', '.join(d['profile'] for d in definitions)),
+            changed=False,
+            profiles=skipped
+        )
+    if module.check_mode:
+        module.exit_json(
+            msg="Profiles {0} will be created on run".format(', '.join(d['profile'] for d in todo)),
+            changed=True,
+            profiles=skipped + [dict(profile=d['profile'], profile_path=d['profile_path'],
+                                     changed=True, status='created') for d in todo]
+        )
+
+    federation_lock = KeyedSemaphore(module.params['federation_limit'])
+    results, elapsed = timed(run_parallel,
+                             lambda definition: create_custom_profile(module, definition, federation_lock),
+                             todo, module.params['workers'])
+
+    failed = [result['profile'] for result in results if result['status'] == 'failed']
+    if failed:
+        module.fail_json(
+            msg="Failed to create profiles: {0}".format(', '.join(failed)),
+            changed=any(result['changed'] for result in results),
+            profiles=skipped + results,
+            elapsed=elapsed
+        )
+    module.exit_json(
+        msg="Successfully created profiles: {0}".format(', '.join(result['profile'] for result in results)),
+        changed=True,
+        profiles=skipped + results,
+        elapsed=elapsed
+    )
+
+
 def check_accountExistance(module):
     """
     Function that checks to see if specified profile
-    exists in current IBM WebSphere cell.
+    exists in current IBM WebSphere cell. Profile names
+    are matched exactly, so AppSrv0 doesn't match AppSrv01.
     """
 
-    check_profile_cmd = "{0}/bin/manageprofiles.sh -listProfiles".format(module.params['path'])
-    profile_check = module.run_command(check_profile_cmd, use_unsafe_shell=True)
+    if module.params['state'] not in ('present', 'absent'):
+        return
+
+    profile_exists = module.params['profile'] in list_profiles(module)
 
-    if module.params['profile'] in profile_check[1] and module.params['state'] == 'present':
+    if profile_exists and module.params['state'] == 'present':
         module.exit_json(
             msg = "Profile {0} already exists in cell".format(module.params['profile']),
         changed=False)
 
-    if module.params['profile'] not in profile_check[1] and module.params['state'] == 'absent':
+    if not profile_exists and module.params['state'] == 'absent':
         module.exit_json(
             msg = "Profile {0} does not exist in cell ".format(module.params['profile']),
             changed=False
@@ -223,6 +499,7 @@ module.params['profile'])
                 stderr=account_remove[2],
                 stdout=account_remove[1]
         )
+    forget(module.params['path'])
     module.exit_json(
             msg="Successfully deleted profile: {0} ".format(module.params['profile']),
             changed=True
@@ -255,6 +532,162 @@ module.params['profile'])
     )
 
 
+def backup_profile_incremental(module):
+    """
+    Function that backs up <profile_path>/config into a content
+    addressed chunk store under dest. Only files that changed since
+    the last backup are read and stored, each run writes a small manifest.
+    """
+
+    config_dir = os.path.join(module.params['profile_path'], 'config')
+    if not os.path.isdir(config_dir):
+        module.fail_json(
+                msg="Profile config directory {0} does not exist".format(config_dir),
+                changed=False
+        )
+
+    try:
+        manifest, stats = incremental_backup(config_dir, module.params['dest'], module.params['profile'])
+    except (IOError, OSError) as err:
+        module.fail_json(
+                msg="Failed to backup profile: {0}. {1}".format(module.params['profile'], err),
+                changed=False
+        )
+    module.exit_json(
+            msg="Successfully backed up profile: {0} to {1}".format(module.params['profile'], manifest),
+            changed=stats['changed'],
+            manifest=manifest,
+            stats=stats
+    )
+
+
+def backup_profile_archive(module):
+    """
+    Function that streams <profile_path>/config into a tar archive
+    compressed on several threads, <dest>/<profile>_backup.tar.gz
+    (or .tar.zst). Files are streamed, never held in memory whole.
+    """
+
+    config_dir = os.path.join(module.params['profile_path'], 'config')
+    if not os.path.isdir(config_dir):
+        module.fail_json(
+                msg="Profile config directory {0} does not exist".format(config_dir),
+                changed=False
+        )
+    if module.params['compression'] == 'zstd' and not HAS_ZSTD:
+        module.fail_json(
+                msg="compression zstd needs the zstandard python library on the target host",
+                changed=False
+        )
+
+    archive = os.path.join(module.params['dest'], "{0}_backup{1}".format(module.params['profile'],
+        ARCHIVE_SUFFIX[module.params['compression']]))
+    try:
+        stats = write_archive(config_dir, archive, compression=module.params['compression'],
+                              workers=module.params['workers'], level=module.params['compression_level'])
+    except (IOError, OSError) as err:
+        module.fail_json(
+                msg="Failed to backup profile: {0}. {1}".format(module.params['profile'], err),
+                changed=False
+        )
+    module.exit_json(
+            msg="Successfully backed up profile: {0} to {1} ({2} MB/s, ratio {3})".format(module.params['profile'],
+                archive, stats['mb_per_second'], stats['ratio']),
+            changed=True,
+            archive=archive,
+            stats=stats
+    )
+
+
+def restore_profile_archive(module):
+    """
+    Function that restores <profile_path>/config from an archive without
+    restoreConfig.sh. The whole archive is validated before anything is
+    touched, then extracted in parallel into a staging directory that is
+    swapped into place only once extraction completed.
+    """
+
+    archive = module.params['archive']
+    if archive is None:
+        candidates = [os.path.join(module.params['dest'], "{0}_backup{1}".format(module.params['profile'], suffix))
+                      for suffix in ('.tar.gz', '.tar.zst', '.zip')]
+        candidates = [candidate for candidate in candidates if os.path.isfile(candidate)]
+        if candidates:
+            archive = max(candidates, key=os.path.getmtime)
+    if archive is None or not os.path.isfile(archive):
+        module.fail_json(
+                msg="No backup archive found for profile {0} in {1}".format(module.params['profile'],
+                    module.params['dest']),
+                changed=False
+        )
+
+    config_dir = os.path.join(module.params['profile_path'], 'config')
+    staging = staging_dir(config_dir)
+    stats = dict(archive=archive)
+    try:
+        stats['entries'], stats['validate_seconds'] = timed(validate_archive, archive, module.params['workers'])
+    except (IOError, OSError) as err:
+        module.fail_json(
+                msg="Archive {0} failed validation, profile {1} was not touched. {2}".format(archive,
+                    module.params['profile'], err),
+                changed=False,
+                stats=stats
+        )
+    try:
+        extracted, stats['extract_seconds'] = timed(extract_archive, archive, staging, module.params['workers'])
+        stats['bytes'] = extracted['bytes']
+        previous = swap_into_place(staging, config_dir)
+    except (IOError, OSError) as err:
+        discard(staging)
+        module.fail_json(
+                msg="Failed to restore profile: {0}. {1}".format(module.params['profile'], err),
+                changed=False,
+                stats=stats
+        )
+    module.exit_json(
+            msg="Succesfully restored profile {0} from {1}".format(module.params['profile'], archive),
+            changed=True,
+            archive=archive,
+            previous_config=previous,
+            stats=stats
+    )
+
+
+def restore_profile_incremental(module):
+    """
+    Function that restores <profile_path>/config from a backup manifest.
+    The tree is reassembled in a staging directory first and only swapped
+    into place once every chunk has been verified.
+    """
+
+    manifest = find_manifest(module.params['dest'], module.params['profile'], module.params['restore_point'])
+    if manifest is None:
+        module.fail_json(
+                msg="No backup manifest {0} found for profile {1} in {2}".format(module.params['restore_point'] or '',
+                    module.params['profile'], module.params['dest']),
+                changed=False
+        )
+
+    config_dir = os.path.join(module.params['profile_path'], 'config')
+    staging = staging_dir(config_dir)
+    try:
+        stats = restore_manifest(module.params['dest'], manifest, staging)
+        previous = swap_into_place(staging, config_dir)
+    except (IOError, OSError, ValueError) as err:
+        discard(staging)
+        module.fail_json(
+                msg="Failed to restore profile: {0}. {1}".format(module.params['profile'], err),
+                changed=False
+        )
+    module.exit_json(
+            msg="Succesfully restored profile {0} from {1}".format(module.params['profile'], manifest),
+            changed=True,
+            manifest=manifest,
+            previous_config=previous,
+            stats=stats
+    )
+
+
 def restore_profile(module):
 
     """
@@ -284,19 +717,30 @@ def main():
     module = AnsibleModule(
             argument_spec=dict(
                 admin_user=dict(type='str', required=False),
+                archive=dict(type='str', required=False),
                 admin_password=dict(type='str', required=False),
+                backup_mode=dict(type='str', required=False, choices=['archive', 'full', 'incremental'], default='full'),
+                compression=dict(type='str', required=False, choices=['gzip', 'zstd'], default='gzip'),
+                compression_level=dict(type='int', required=False),
                 cell_name=dict(type='str', required=False, defaults=None),
                 dest=dict(type='str', required=False),
                 dmgr_host=dict(type='str', required=False),
                 path=dict(type='str', required=False),
-                profile=dict(type='str', required=True),
-                profile_path=dict(type='str', required=True),
+                dmgr_port=dict(type='str', required=False, default='8879'),
+                federation_limit=dict(type='int', required=False, default=1),
+                profile=dict(type='str', required=False),
+                profile_path=dict(type='str', required=False),
+                profiles=dict(type='list', required=False),
                 profile_type=dict(type='str', required=False, choices=['management', 'custom']),
+                restore_point=dict(type='str', required=False),
                 security=dict(type='str', required=False, choices=['enabled','disabled'], defaults='enabled'),
                 state=dict(type='str', required=True, choices=['absent', 'augment',
-                    'backup', 'present', 'restore'])
+                    'backup', 'present', 'restore']),
+                workers=dict(type='int', required=False, default=4)
             ),
             supports_check_mode = True,
+            required_one_of=[["profile", "profiles"]],
+            mutually_exclusive=[["profile", "profiles"]],
             required_if=[
                 ["security",True, ["admin_user", "admin_password"],
                 ["security",True, ["profile_type", "management"],
@@ -318,6 +762,18 @@ def main():
     security = module.params['security']
     state = module.params['state']
 
+    if module.params['profiles'] is not None:
+        if state != 'present':
+            module.fail_json(msg="profiles is only supported with state present", changed=False)
+        make_customProfiles(module)
+
+    if module.params['profile_path'] is None and path is not None:
+        try:
+            registered = get_profile(path, profile)
+        except ValueError as err:
+            module.fail_json(msg=str(err), changed=False)
+        if registered is not None:
+            module.params['profile_path'] = registered['path']
 
     if profile_type == 'management' and state == 'present' and not module.check_mode:
         check_accountExistance(module)  
@@ -330,9 +786,17 @@ def main():
         remove_account(module)
     if state == 'backup' and not module.check_mode:
         check_accountExistance(module)
+        if module.params['backup_mode'] == 'incremental':
+            backup_profile_incremental(module)
+        if module.params['backup_mode'] == 'archive':
+            backup_profile_archive(module)
         backup_profile(module)
     if state == 'restore' and not module.check_mode:
         check_accountExistance(module)
+        if module.params['backup_mode'] == 'incremental':
+            restore_profile_incremental(module)
+        if module.params['backup_mode'] == 'archive':
+            restore_profile_archive(module)
         restore_profile(module)
 
 
@@ -1,8 +1,12 @@
 #!/usr/bin/python
 
 from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils.ibm_logwatch import log_offset, wait_for_ready
+from ansible.module_utils.ibm_parallel import run_parallel, timed
+from ansible.module_utils.ibm_process import jvm_status, server_status
+from ansible.module_utils.ibm_serverindex import list_servers, server_endpoints
 import subprocess as sp
-import os
+import time
 
 
 ANSIBLE_METADATA = {
@@ -35,14 +39,62 @@ options:
     server_name:
         description:
             - Name of server in WAS cell to be started, stopped, or have status check
+            - Accepts a list of servers, or all for every application server defined
+            - on the profile's node under profiles/<profile>/config
             - Required: True
 
+    parallel:
+        description:
+            - Number of servers sent into state at the same time
+            - Required: False
+            - Default: 4
+
     state:
         description:
             - Determines the state to send the Application server
-            - Choices: ['check', 'start', 'stop']
+            - Choices: ['check', 'restart', 'start', 'stop']
             - Required: True
 
+    status_engine:
+        description:
+            - How state check works out server state
+            - native reads the server's .pid file, verifies the process through /proc and
+            - probes probe_endpoint, returning STARTED, STOPPED, STALE_PID or HUNG in milliseconds
+            - script runs serverStatus.sh and returns its output
+            - Choices: ['native', 'script']
+            - Default: native
+
+    probe:
+        description:
+            - With status_engine native, TCP connect to probe_endpoint of a running server
+            - A live process that doesn't accept the connection is reported as HUNG
+            - Default: True
+
+    probe_endpoint:
+        description:
+            - Endpoint from serverindex.xml to probe, e.g WC_defaulthost or BOOTSTRAP_ADDRESS
+            - Default: SOAP_CONNECTOR_ADDRESS
+
+    probe_timeout:
+        description:
+            - Seconds to wait for the probe connection
+            - Default: 1.0
+
+    start_mode:
+        description:
+            - How start and restart decide a server is up
+            - script waits for startServer.sh to return
+            - log runs startServer.sh -nowait and tails SystemOut.log until the server
+            - reports WSVR0001I open for e-business, returning ready_seconds and first_error
+            - Choices: ['script', 'log']
+            - Default: script
+
+    start_timeout:
+        description:
+            - With start_mode log, seconds to wait for a server to report open for e-business
+            - A server that isn't ready in time, or whose process dies, fails the task
+            - Default: 300
+
     was_root:
         description:
             - The current used WAS installation root. Ie. /opt/WebSphere/AppServer
@@ -73,6 +125,29 @@ EXAMPLES='''
     server_name: Server01
     was_root: /opt/WebSphere/AppServer
 
+#restart every application server on the node, three at a time
+---
+-
+  name: RESTART ALL SERVERS
+  server:
+    state: restart
+    profile_name: AppSrv01
+    server_name: all
+    parallel: 3
+    was_root: /opt/WebSphere/AppServer
+
+#restart and wait for open for e-business in SystemOut.log
+---
+-
+  name: RESTART SERVER
+  server:
+    state: restart
+    profile_name: AppSrv01
+    server_name: Server01
+    start_mode: log
+    start_timeout: 180
+    was_root: /opt/WebSphere/AppServer
+
 #check server status
 ---
 -
@@ -86,114 +161,205 @@ EXAMPLES='''
 '''
 
 
+def run_script(profile_root, script, server_name, options=''):
+    """Function that runs one of the profile's bin scripts for a server.
+    Returns (returncode, stdout, stderr).
+    """
+
+    child = sp.Popen(
+        [
+            profile_root + '/bin/' + script + ' ' + server_name + options
+        ],
+        shell=True,
+        stdout=sp.PIPE,
+        stderr=sp.PIPE
+    )
+    stdout_value, stderr_value = child.communicate()
+    return child.returncode, stdout_value, stderr_value
+
+
+def check_server(module, profile_root, server_name):
+    """Function that works out a server's state natively: pid file, /proc and, with
+    probe, a short TCP connect to probe_endpoint from serverindex.xml.
+    Returns STARTED, STOPPED, STALE_PID or HUNG in the server's result.
+    """
+
+    start = time.time()
+    host = port = None
+    if module.params['probe']:
+        endpoint = server_endpoints(profile_root, server_name).get(module.params['probe_endpoint'])
+        if endpoint is not None:
+            host, port = endpoint['host'], endpoint['port']
+    result = jvm_status(profile_root, server_name, host, port, module.params['probe_timeout'])
+    result.update(changed=False, failed=False, msg='Server is ' + result['state'],
+                  log=profile_root + '/logs/' + server_name + '/SystemOut.log')
+    result['elapsed'] = round(time.time() - start, 3)
+    return result
+
+
+def wait_for_server(profile_root, server_name, offset, started, timeout):
+    """Function that waits for a server launched with -nowait to report open for
+    e-business in its SystemOut.log. A pid file left without a live process ends
+    the wait early.
+    """
+
+    def alive():
+        return server_status(profile_root, server_name)['state'] != 'stale'
+
+    return wait_for_ready(profile_root + '/logs/' + server_name + '/SystemOut.log', offset, timeout,
+                          started=started, alive=alive)
+
+
+def control_server(profile_root, server_name, state, start_mode='script', start_timeout=300):
+    """Function that sends one server into state (start, stop, restart or check).
+    Runs inside the worker pool, so the outcome is returned instead of exiting.
+    """
+
+    start = time.time()
+    log_dir = profile_root + '/logs/' + server_name
+    result = dict(server=server_name, changed=False, failed=False)
+    status = server_status(profile_root, server_name)
+
+    if state in ('stop', 'restart'):
+        if status['state'] == 'running':
+            rc, stdout_value, stderr_value = run_script(profile_root, 'stopServer.sh', server_name)
+            if rc != 0:
+                result.update(failed=True, msg='Failed to stop server', log=log_dir + '/stopServer.log',
+                              stderr=stderr_value)
+                result['elapsed'] = round(time.time() - start, 3)
+                return result
+            result.update(changed=True, msg='Succesfully stopped server', log=log_dir + '/stopServer.log',
+                          stop_seconds=round(time.time() - start, 3))
+        elif state == 'stop':
+            result.update(msg='Server is not started')
+
+    if state in ('start', 'restart'):
+        if state == 'start' and status['state'] == 'running':
+            result.update(msg='Server is already running')
+        else:
+            start_time = time.time()
+            offset = log_offset(log_dir + '/SystemOut.log')
+            rc, stdout_value, stderr_value = run_script(profile_root, 'startServer.sh', server_name,
+                                                        ' -nowait' if start_mode == 'log' else '')
+            result['log'] = log_dir + '/startServer.log'
+            if rc != 0:
+                result.update(failed=True, msg='Failed to start server', stderr=stderr_value)
+            elif start_mode == 'log':
+                ready = wait_for_server(profile_root, server_name, offset, start_time, start_timeout)
+                result.update(changed=True, log=ready['log'], ready_seconds=ready['ready_seconds'],
+                              first_error=ready['first_error'])
+                if ready['state'] == 'ready':
+                    result['msg'] = 'Server is open for e-business'
+                elif ready['state'] == 'exited':
+                    result.update(failed=True, msg='Server process exited before it was ready')
+                else:
+                    result.update(failed=True, msg='Server was not open for e-business within ' +
+                                  str(start_timeout) + ' seconds')
+            else:
+                result.update(changed=True, msg='Succesfully started server')
+            result['start_seconds'] = round(time.time() - start_time, 3)
+
+    if state == 'check':
+        rc, stdout_value, stderr_value = run_script(profile_root, 'serverStatus.sh', server_name)
+        result.update(stdout=stdout_value, stderr=stderr_value, log=log_dir + '/serverStatus.log')
+        if rc != 0:
+            result.update(failed=True, msg='Failed to check server status')
+
+    result['elapsed'] = round(time.time() - start, 3)
+    return result
+
+
 def run_server():
     """Function that will control all JMX IBM Application server calls
-    Function will stop, start and check server status
+    Function will stop, start, restart and check server status for one or
+    more servers, running up to parallel servers at the same time
     """
 
     module_args=dict(
         profile_name=dict(type='str', required=True),
-        state=dict(type='str', required=True, choices=['check', 'start', 'stop']),
-        server_name=dict(type='str', required=True),
-        was_root=dict(type='str', required=True)
+        state=dict(type='str', required=True, choices=['check', 'restart', 'start', 'stop']),
+        server_name=dict(type='list', required=True),
+        was_root=dict(type='str', required=True),
+        parallel=dict(type='int', required=False, default=4),
+        status_engine=dict(type='str', required=False, choices=['native', 'script'], default='native'),
+        probe=dict(type='bool', required=False, default=True),
+        probe_endpoint=dict(type='str', required=False, default='SOAP_CONNECTOR_ADDRESS'),
+        probe_timeout=dict(type='float', required=False, default=1.0),
+        start_mode=dict(type='str', required=False, choices=['script', 'log'], default='script'),
+        start_timeout=dict(type='int', required=False, default=300)
     )
 
     module = AnsibleModule(
-        argument_spec=module_args
+        argument_spec=module_args,
+        supports_check_mode=True
     )
 
     profile_name = module.params['profile_name']
     state = module.params['state']
     server_name = module.params['server_name']
     was_root = module.params['was_root']
+    profile_root = was_root + '/profiles/' + profile_name
 
-
-    if state == 'start':
-        if os.path.exists(was_root + '/profiles/' + profile_name +
-        '/logs/' + server_name + '/' + server_name + '.pid'):
-            module.exit_json(
-                msg='Server is already running',
-                changed=False
-            )
-        else:
-            child = sp.Popen(
-                [
-                    was_root + '/profiles/' + profile_name +
-                    '/bin/startServer.sh ' + server_name 
-                ],
-                shell=True,
-                stdout=sp.PIPE,
-                stderr=sp.PIPE
-            )
-            stdout_value, stderr_value = child.communicate()
-
-            if child.returncode != 0:
-                module.fail_json(
-                    msg='Failed to start server. See log for details ---> ' +
-                    was_root + '/profiles/' + profile_name + '/logs/' + server_name +
-                    '/startServer.log',
-                    changed=False
-                )
-            module.exit_json(
-                msg='Succesfully started server ' + server_name,
+    if server_name == ['all']:
+        server_name = list_servers(profile_root)
+        if not server_name:
+            module.fail_json(
+                msg='No application servers found under ' + profile_root + '/config',
                 changed=False
             )
 
-    if state == 'stop':
-        if os.path.exists(was_root + '/profiles/' + profile_name +
-        '/logs/' + server_name + '/' + server_name + '.pid') == False:
-            module.exit_json(
-                msg='Server is not started',
-                changed=False
-            )
-        else:
-            child =  sp.Popen(
-                [
-                    was_root + '/profiles/' +  profile_name +
-                    '/bin/stopServer.sh ' + server_name 
-                ],
-                shell=True,
-                stdout=sp.PIPE,
-                stderr=sp.PIPE
-            )
-            stdout_value, stderr_value =  child.communicate()
-
-            if child.returncode != 0:
-                module.fail_json(
-                    msg='Failed to stop server. See log for details ---> ' + 
-                    was_root + '/profiles/' + profile_name + '/logs/' + server_name +
-                    '/stopServer.log',
-                     changed=False,
-                 )
-            module.exit_json(
-                msg='Succesfully stopped server',
-                changed=True
-             )
+    if module.check_mode and state != 'check':
+        servers = []
+        for name in server_name:
+            status = server_status(profile_root, name)
+            running = status['state'] == 'running'
+            changed = (state == 'restart' or (state == 'start' and not running) or
+                       (state == 'stop' and running))
+            servers.append(dict(server=name, changed=changed, pid_state=status['state']))
+        module.exit_json(
+            changed=any(server['changed'] for server in servers),
+            servers=servers
+        )
 
-    if state == 'check':
-        child = sp.Popen(
-            [
-                was_root + '/profiles/' + profile_name +
-                '/bin/serverStatus.sh ' + server_name
-            ],
-            shell=True,
-            stdout=sp.PIPE,
-            stderr=sp.PIPE
+    if state == 'check' and module.params['status_engine'] == 'native':
+        servers, elapsed = timed(run_parallel, lambda name: check_server(module, profile_root, name),
+                                 server_name, module.params['parallel'])
+        module.exit_json(
+            msg=', '.join(server['server'] + ': ' + server['state'] for server in servers),
+            changed=False,
+            state=servers[0]['state'] if len(servers) == 1 else None,
+            servers=servers,
+            elapsed=elapsed
         )
-        stdout_value, stderr_value = child.communicate()
 
-        if child.returncode != 0:
-            module.fail_json(
-                msg='Failed to check server status. See log for details ---> ' +
-                was_root + '/profiles/' + profile_name + '/logs/' + server_name +
-                '/serverStatus.log',
-                changed=False
-            )
+    servers, elapsed = timed(run_parallel,
+                             lambda name: control_server(profile_root, name, state, module.params['start_mode'],
+                                                         module.params['start_timeout']),
+                             server_name, module.params['parallel'])
+    failed = [server['server'] for server in servers if server['failed']]
+
+    if failed:
+        module.fail_json(
+            msg='Failed to ' + state + ' server(s) ' + ', '.join(failed) + '. See log for details ---> ' +
+            ', '.join(server['log'] for server in servers if server['failed']),
+            changed=any(server['changed'] for server in servers),
+            servers=servers,
+            elapsed=elapsed
+        )
+    if state == 'check' and len(servers) == 1:
         module.exit_json(
             changed=False,
-            stdout =  stdout_value,
-            stderr =  stderr_value
+            stdout=servers[0]['stdout'],
+            stderr=servers[0]['stderr'],
+            servers=servers,
+            elapsed=elapsed
         )
+    module.exit_json(
+        msg=', '.join(server['server'] + ': ' + server.get('msg', 'checked') for server in servers),
+        changed=any(server['changed'] for server in servers),
+        servers=servers,
+        elapsed=elapsed
+    )
 
 def main():
     run_server()
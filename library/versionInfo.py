@@ -1,30 +1,185 @@
 #!/usr/bin/python
+import os
 import subprocess as sp
 from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils.ibm_cache import fact_cache
 from lxml import etree
 
+
+DOCUMENTATION = '''
+---
+module: versionInfo
+
+short_description: Module that reports installed IBM product versions.
+
+description:
+    - Module that reads the version files under <was_root>/properties/version.
+    - With mode product, the version of a single product is returned.
+    - With mode inventory, every *.product, *.component and *.efix file is parsed in one
+    - pass and a structured inventory of products, components and installed ifixes is returned.
+    - Both modes read from the install's shared fact cache, <was_root>/.ansible_ibm_facts.json,
+    - which is refreshed when the version directory or a product or ifix file changes.
+
+options:
+    was_root:
+        description:
+            - Install root of the product, e.g /opt/WebSphere/AppServer.
+        required: true
+    product:
+        description:
+            - Product file to read in product mode.
+        required: false
+        choices:
+          - IHS
+          - WAS
+          - BPM
+    mode:
+        description:
+            - product or inventory.
+        required: false
+        default: product
+
+author:
+    - Tom Davison (@tntdavison784)
+'''
+
+EXAMPLES = '''
+- name: Version of WAS
+  versionInfo:
+    was_root: /opt/WebSphere/AppServer
+    product: WAS
+- name: Patch compliance inventory
+  versionInfo:
+    was_root: /opt/WebSphere/AppServer
+    mode: inventory
+  register: was_inventory
+'''
+
+RETURN = '''
+inventory:
+    description:
+        - products as a list of dict(id, name, version, build_level, build_date, file)
+        - components as component name -> spec version
+        - ifixes as a list of dict(id, description, build_date, file)
+    type: dict
+'''
+
+
+VERSION_SUFFIXES = ('.product', '.component', '.efix')
+
+
+def version_dir(was_root):
+    """Function that returns the directory holding the version files of an install."""
+
+    return os.path.join(was_root, 'properties', 'version')
+
+
+def read_product(root, path):
+    """Function that returns the fields of a parsed *.product file."""
+
+    build_info = root.find('build-info')
+    return dict(
+        id=root.findtext('id'),
+        name=root.get('name'),
+        version=root.findtext('version'),
+        build_level=build_info.get('level') if build_info is not None else None,
+        build_date=build_info.get('date') if build_info is not None else None,
+        file=os.path.basename(path)
+    )
+
+
+def read_efix(root, path):
+    """Function that returns the fields of a parsed *.efix file."""
+
+    build_info = root.find('build-info')
+    return dict(
+        id=root.get('id') or root.findtext('id') or os.path.basename(path)[:-len('.efix')],
+        description=root.get('short-description') or root.findtext('short-description'),
+        build_date=build_info.get('date') if build_info is not None else root.findtext('build-date'),
+        file=os.path.basename(path)
+    )
+
+
+def scan_version_dir(directory):
+    """Function that parses every version file of a directory in one pass, reusing a
+    single parser, and returns dict(products, components, ifixes, errors).
+    """
+
+    parser = etree.XMLParser(remove_blank_text=True, resolve_entities=False, no_network=True)
+    inventory = dict(products=[], components={}, ifixes=[], errors=[])
+
+    for entry in sorted(os.listdir(directory)):
+        if not entry.endswith(VERSION_SUFFIXES):
+            continue
+        path = os.path.join(directory, entry)
+        try:
+            root = etree.parse(path, parser).getroot()
+        except (IOError, etree.XMLSyntaxError) as err:
+            inventory['errors'].append('{0}: {1}'.format(entry, err))
+            continue
+
+        if entry.endswith('.product'):
+            inventory['products'].append(read_product(root, path))
+        elif entry.endswith('.component'):
+            inventory['components'][root.get('name') or entry[:-len('.component')]] = root.get('spec-version')
+        else:
+            inventory['ifixes'].append(read_efix(root, path))
+    return inventory
+
+
+def version_inventory(was_root, cache=None):
+    """Function that returns the version inventory of an install, kept in the install's
+    shared fact cache until the version directory, or a product or ifix file in it, changes.
+    """
+
+    directory = version_dir(was_root)
+    sources = [directory] + [os.path.join(directory, entry) for entry in sorted(os.listdir(directory))
+                             if entry.endswith(('.product', '.efix'))]
+    return (cache or fact_cache(was_root)).get('versionInfo:{0}'.format(directory), sources,
+                                               lambda: scan_version_dir(directory))
+
+
 def get_versionInfo():
 
     module = AnsibleModule(
         argument_spec=dict(
             was_root=dict(type='str', required=True),
-            product=dict(type='str', required=True, choices=['IHS', 'WAS', 'BPM'])
-        )
+            product=dict(type='str', required=False, choices=['IHS', 'WAS', 'BPM']),
+            mode=dict(type='str', required=False, choices=['product', 'inventory'], default='product')
+        ),
+        required_if=[['mode', 'product', ['product']]],
+        supports_check_mode=True
     )
 
     was_root = module.params['was_root']
     product = module.params['product']
 
-    if was_root:
+    if module.params['mode'] == 'inventory':
         try:
-            properties = etree.parse(was_root+'/properties/version/'+product+'.product')
-            version = properties.find('version')
-        except IOError:
+            inventory = version_inventory(was_root)
+        except OSError:
             module.fail_json(
-                msg=was_root+'/properties/version/'+product+'.product does not exist. This may mean that '+ product + ' is not installed'
+                msg=version_dir(was_root)+' does not exist. This may mean that nothing is installed in '+was_root
             )
+        module.exit_json(
+            msg='Found '+str(len(inventory['products']))+' product(s) and '+str(len(inventory['ifixes']))+
+                ' ifix(es) in '+was_root,
+            changed=False,
+            inventory=inventory
+        )
+
+    try:
+        products = version_inventory(was_root)['products']
+    except OSError:
+        products = []
+    version = [entry['version'] for entry in products if entry['file'] == product+'.product']
+    if not version:
+        module.fail_json(
+            msg=was_root+'/properties/version/'+product+'.product does not exist. This may mean that '+ product + ' is not installed'
+        )
+    # A product file without <version> reports None instead of failing.
     module.exit_json(
-        msg='Current version of '+ product + ' is: '+ version.text
+        msg='Current version of '+ product + ' is: '+ str(version[0])
     )
 
 
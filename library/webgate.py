@@ -4,7 +4,7 @@
 import os
 import subprocess as sp
 from ansible.module_utils.basic import AnsibleModule
-import time
+from ansible.module_utils.ibm_httpd_conf import find_directives, load_config
 
 
 def set_params():
@@ -15,10 +15,16 @@ def set_params():
     global module 
     global ora_inst
     global response_loc
+    global ihs_root
+    global webgate_instance
+    global oracle_home
 
     module_args=dict(
         ora_inst=dict(type='str', required=True),
-        response_loc=dict(type='str', required=True)
+        response_loc=dict(type='str', required=True),
+        ihs_root=dict(type='str', required=False, default='/opt/WebSphere/HTTPServer'),
+        webgate_instance=dict(type='str', required=False, default='/opt/OAM/oracle/Middleware/Oracle_OAMWebGate1'),
+        oracle_home=dict(type='str', required=False, default='/opt/OAM/oracle/product/11.1.1/as_1')
     )
 
     module=AnsibleModule(
@@ -27,6 +33,9 @@ def set_params():
 
     ora_inst = module.params['ora_inst']
     response_loc = module.params['response_loc']
+    ihs_root = module.params['ihs_root']
+    webgate_instance = module.params['webgate_instance']
+    oracle_home = module.params['oracle_home']
 
     
 def check_for_ofm():
@@ -53,7 +62,7 @@ def check_for_webgate():
         return False
     """
 
-    http_conf_ORIG='/opt/WebSphere/HTTPServer/conf/httpd.conf.ORIG'
+    http_conf_ORIG=ihs_root + '/conf/httpd.conf.ORIG'
 
     if not os.path.exists(http_conf_ORIG):
         return False
@@ -100,8 +109,8 @@ def create_webgate():
     global t1
     t1 = sp.Popen(
         [
-            '/opt/OAM/oracle/product/11.1.1/as_1/webgate/ihs/tools/deployWebGate/deployWebGateInstance.sh -w ' +
-            '/opt/OAM/oracle/Middleware/Oracle_OAMWebGate1 -oh /opt/OAM/oracle/product/11.1.1/as_1/ -ws ihs'
+            oracle_home + '/webgate/ihs/tools/deployWebGate/deployWebGateInstance.sh -w ' +
+            webgate_instance + ' -oh ' + oracle_home + '/ -ws ihs'
         ],
         shell=True,
         stdout=sp.PIPE,
@@ -115,13 +124,29 @@ def create_webgate():
         return True
 
 
+def webgate_included():
+    """Function to check IHS httpd.conf, or any file it includes,
+    already includes a config of the webgate instance
+    """
+
+    tree = load_config(os.path.join(ihs_root, 'conf', 'httpd.conf'), ihs_root)
+    return any(node['args'] and node['args'][0].startswith(webgate_instance)
+               for node in find_directives(tree, 'Include'))
+
+
 def edit_httpdConf():
     """Function to edit IHS httpd.conf file
-    To insert 11g apache modules
+    To insert 11g apache modules. EditHttpConf also generates the instance
+    webgate.conf, it is only run when httpd.conf doesn't include the instance yet.
     """
+
+    if webgate_included():
+        return True
+
     t2 = sp.Popen(
         [
-            '/opt/OAM/oracle/product/11.1.1/as_1/webgate/ihs/tools/setup/InstallTools/EditHttpConf -f /opt/WebSphere/HTTPServer/conf/httpd.conf -w /opt/OAM/oracle/Middleware/Oracle_OAMWebGate1 -oh /opt/OAM/oracle/product/11.1.1/as_1/ -ws ihs'
+            oracle_home + '/webgate/ihs/tools/setup/InstallTools/EditHttpConf -f ' + ihs_root +
+            '/conf/httpd.conf -w ' + webgate_instance + ' -oh ' + oracle_home + '/ -ws ihs'
         ],
         shell=True,
         stdout=sp.PIPE,
@@ -129,6 +154,7 @@ def edit_httpdConf():
     )
     stdout_value, stderr_value = t2.communicate()
 
+    return t2.returncode == 0
 
 
 def main():
@@ -148,10 +174,16 @@ def main():
         )
 
     if install_webgate():
-        if create_webgate():
+        if not create_webgate():
+            module.fail_json(msg='Failed to create Webgate instance',changed=False)
+        try:
+            edited = edit_httpdConf()
+        except (IOError, OSError, ValueError) as err:
+            module.fail_json(msg='Failed to read IHS httpd.conf: {0}'.format(err),changed=True)
+        if edited:
             module.exit_json(msg='Succesfully created IHS Oracle Webgate instance',changed=True)
         else:
-            module.fail_json(msg='Failed to create Webgate instance',changed=False)
+            module.fail_json(msg='Failed to add the Webgate instance to IHS httpd.conf',changed=True)
     else:
         module.fail_json(msg='Failed to install Oracle WebGate',changed=False)
 
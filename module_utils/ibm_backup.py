@@ -0,0 +1,631 @@
+"""Native backup and restore of WebSphere profile configuration.
+
+Incremental backups keep a content addressed chunk store next to a series of
+small JSON manifests:
+
+    <store>/objects/ab/cdef0123...    zlib compressed chunk, named by its sha256
+    <store>/manifests/<profile>/<timestamp>.<milliseconds>.json
+
+A manifest lists every file under <profile>/config with its mode, mtime, size
+and the chunks it is made of. Files whose size and mtime match the previous
+manifest are not read again, and chunks that are already in the store are
+never written twice, so a backup of an unchanged profile only costs a tree walk
+and a new manifest. Any manifest can be restored on its own.
+
+Archive backups stream the same tree through tarfile into a compressor that
+runs on several threads: zstd when the zstandard library is installed, or
+parallel gzip, which compresses fixed size blocks as independent gzip members
+(readable by gzip, tar and tarfile). Only a bounded number of blocks is ever in
+flight, so memory use doesn't depend on the size of the profile.
+
+Archive restores validate first and extract second. backupConfig.sh zips are
+checked by reading every entry against its CRC and then extracted on a thread
+pool, tar archives are checked by decompressing the stream and comparing the
+sha256 recorded next to them. Either way the tree lands in a staging directory
+that is only swapped in for config once it is complete.
+
+author: Tom Davison (@tntdavison784)
+"""
+
+import collections
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import tarfile
+import tempfile
+import time
+import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import zstandard
+    HAS_ZSTD = True
+except ImportError:
+    HAS_ZSTD = False
+
+
+CHUNK_SIZE = 4 * 1024 * 1024
+GZIP_BLOCK_SIZE = 1024 * 1024
+ARCHIVE_SUFFIX = {'gzip': '.tar.gz', 'zstd': '.tar.zst'}
+
+
+def walk_tree(root):
+    """Function that yields (relative path, os.lstat result) for everything under root,
+    directories before their contents, in a stable order.
+    """
+
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for name in dirnames + sorted(filenames):
+            path = os.path.join(dirpath, name)
+            yield os.path.relpath(path, root), os.lstat(path)
+
+
+class ChunkStore(object):
+    """Content addressed store of zlib compressed chunks named by their sha256."""
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        self.objects_dir = os.path.join(store_dir, 'objects')
+
+    def object_path(self, digest):
+        return os.path.join(self.objects_dir, digest[:2], digest[2:])
+
+    def has(self, digest):
+        return os.path.exists(self.object_path(digest))
+
+    def put(self, data):
+        """Function that stores a chunk if it isn't already present.
+        Returns (digest, number of bytes written to the store).
+        """
+
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.object_path(digest)
+        if os.path.exists(path):
+            return digest, 0
+
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        compressed = zlib.compress(data, 6)
+        fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.chunk')
+        with os.fdopen(fd, 'wb') as f_obj:
+            f_obj.write(compressed)
+        os.rename(tmp_file, path)
+        return digest, len(compressed)
+
+    def get(self, digest):
+        """Function that returns the content of a chunk, verified against its digest."""
+
+        with open(self.object_path(digest), 'rb') as f_obj:
+            try:
+                data = zlib.decompress(f_obj.read())
+            except zlib.error:
+                raise IOError("Chunk {0} in {1} is corrupt".format(digest, self.store_dir))
+        if hashlib.sha256(data).hexdigest() != digest:
+            raise IOError("Chunk {0} in {1} is corrupt".format(digest, self.store_dir))
+        return data
+
+
+def manifest_dir(store_dir, name):
+    return os.path.join(store_dir, 'manifests', name)
+
+
+def list_manifests(store_dir, name):
+    """Function that returns the manifest paths for a profile, oldest first."""
+
+    directory = manifest_dir(store_dir, name)
+    if not os.path.isdir(directory):
+        return []
+    return [os.path.join(directory, manifest) for manifest in sorted(os.listdir(directory))
+            if manifest.endswith('.json')]
+
+
+def load_manifest(path):
+    with open(path) as f_obj:
+        return json.load(f_obj)
+
+
+def find_manifest(store_dir, name, restore_point=None):
+    """Function that returns the manifest for restore_point (a manifest file name or
+    timestamp), or the latest manifest when no restore point is given. A timestamp
+    without milliseconds picks the latest manifest written in that second.
+    """
+
+    manifests = list_manifests(store_dir, name)
+    if restore_point is None:
+        return manifests[-1] if manifests else None
+    found = None
+    for path in manifests:
+        manifest = os.path.basename(path)
+        if manifest in (restore_point, restore_point + '.json') or manifest.startswith(restore_point + '.'):
+            found = path
+    return found
+
+
+def incremental_backup(source_dir, store_dir, name):
+    """Function that backs up source_dir into the chunk store and writes a new manifest.
+    Returns (manifest path, stats). stats['changed'] is False when the tree is
+    identical to the previous manifest.
+    """
+
+    start = time.time()
+    store = ChunkStore(store_dir)
+    previous_manifest = find_manifest(store_dir, name)
+    previous = load_manifest(previous_manifest)['entries'] if previous_manifest else {}
+
+    entries = {}
+    stats = dict(files=0, bytes=0, read_files=0, new_chunks=0, stored_bytes=0)
+    for relpath, st in walk_tree(source_dir):
+        entry = dict(mode=st.st_mode & 0o7777, mtime=st.st_mtime)
+        if os.path.islink(os.path.join(source_dir, relpath)):
+            entry.update(type='link', target=os.readlink(os.path.join(source_dir, relpath)))
+        elif os.path.isdir(os.path.join(source_dir, relpath)):
+            entry.update(type='dir')
+        else:
+            entry.update(type='file', size=st.st_size)
+            stats['files'] += 1
+            stats['bytes'] += st.st_size
+            old = previous.get(relpath)
+            if (old is not None and old.get('type') == 'file' and old['size'] == st.st_size and
+                    old['mtime'] == st.st_mtime and all(store.has(chunk) for chunk in old['chunks'])):
+                entry['chunks'] = old['chunks']
+            else:
+                entry['chunks'] = []
+                stats['read_files'] += 1
+                with open(os.path.join(source_dir, relpath), 'rb') as f_obj:
+                    for data in iter(lambda: f_obj.read(CHUNK_SIZE), b''):
+                        digest, written = store.put(data)
+                        entry['chunks'].append(digest)
+                        if written:
+                            stats['new_chunks'] += 1
+                            stats['stored_bytes'] += written
+        entries[relpath] = entry
+
+    stats['changed'] = entries != previous
+    manifest = dict(version=1, name=name, source=source_dir, created=time.time(), entries=entries)
+
+    directory = manifest_dir(store_dir, name)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    # Fixed width names, so they sort in the order they were written.
+    stamp, milliseconds = time.strftime('%Y%m%dT%H%M%S', time.localtime(start)), int(start * 1000) % 1000
+    manifest_path = os.path.join(directory, '{0}.{1:03d}.json'.format(stamp, milliseconds))
+    while os.path.exists(manifest_path) and milliseconds < 999:
+        milliseconds += 1
+        manifest_path = os.path.join(directory, '{0}.{1:03d}.json'.format(stamp, milliseconds))
+    fd, tmp_file = tempfile.mkstemp(dir=directory, prefix='.manifest')
+    with os.fdopen(fd, 'w') as f_obj:
+        json.dump(manifest, f_obj, sort_keys=True)
+    os.rename(tmp_file, manifest_path)
+
+    stats['elapsed'] = round(time.time() - start, 3)
+    return manifest_path, stats
+
+
+def restore_manifest(store_dir, manifest_path, target_dir):
+    """Function that reassembles the tree recorded in a manifest into target_dir,
+    which must not exist yet. Every chunk is verified against its digest.
+    Returns stats for the restore.
+    """
+
+    start = time.time()
+    store = ChunkStore(store_dir)
+    entries = load_manifest(manifest_path)['entries']
+    stats = dict(files=0, bytes=0)
+
+    os.makedirs(target_dir)
+    dirs = []
+    for relpath in sorted(entries):
+        entry = entries[relpath]
+        path = os.path.join(target_dir, relpath)
+        if entry['type'] == 'dir':
+            os.mkdir(path)
+            dirs.append((path, entry))
+        elif entry['type'] == 'link':
+            os.symlink(entry['target'], path)
+        else:
+            with open(path, 'wb') as f_obj:
+                for digest in entry['chunks']:
+                    f_obj.write(store.get(digest))
+            os.chmod(path, entry['mode'])
+            os.utime(path, (entry['mtime'], entry['mtime']))
+            stats['files'] += 1
+            stats['bytes'] += entry['size']
+
+    for path, entry in reversed(dirs):
+        os.chmod(path, entry['mode'])
+        os.utime(path, (entry['mtime'], entry['mtime']))
+
+    stats['elapsed'] = round(time.time() - start, 3)
+    return stats
+
+
+class HashingWriter(object):
+    """File wrapper that counts and sha256 hashes everything written through it."""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.bytes = 0
+        self.sha256 = hashlib.sha256()
+
+    def write(self, data):
+        self.fileobj.write(data)
+        self.bytes += len(data)
+        self.sha256.update(data)
+        return len(data)
+
+    def flush(self):
+        self.fileobj.flush()
+
+
+class ParallelGzipWriter(object):
+    """Write-only stream that compresses fixed size blocks on a thread pool.
+    Every block becomes its own gzip member and members are written in order,
+    at most two blocks per worker are held in memory at any time.
+    """
+
+    def __init__(self, fileobj, workers, level=6, block_size=GZIP_BLOCK_SIZE):
+        self.fileobj = fileobj
+        self.level = level
+        self.block_size = block_size
+        self.max_pending = 2 * max(1, workers)
+        self.bytes = 0
+        self._buffer = []
+        self._buffered = 0
+        self._pending = collections.deque()
+        self._executor = ThreadPoolExecutor(max_workers=max(1, workers))
+
+    def write(self, data):
+        self._buffer.append(data)
+        self._buffered += len(data)
+        self.bytes += len(data)
+        if self._buffered >= self.block_size:
+            block = b''.join(self._buffer)
+            while len(block) >= self.block_size:
+                self._submit(block[:self.block_size])
+                block = block[self.block_size:]
+            self._buffer = [block]
+            self._buffered = len(block)
+        return len(data)
+
+    def _submit(self, block):
+        self._pending.append(self._executor.submit(gzip.compress, block, self.level))
+        while len(self._pending) > self.max_pending:
+            self.fileobj.write(self._pending.popleft().result())
+
+    def close(self):
+        if self._buffered:
+            self._submit(b''.join(self._buffer))
+            self._buffer = []
+            self._buffered = 0
+        while self._pending:
+            self.fileobj.write(self._pending.popleft().result())
+        self._executor.shutdown()
+
+
+class ZstdWriter(object):
+    """Write-only stream backed by zstandard's multi-threaded compressor."""
+
+    def __init__(self, fileobj, workers, level=3):
+        self.bytes = 0
+        compressor = zstandard.ZstdCompressor(level=level, threads=max(1, workers))
+        self._writer = compressor.stream_writer(fileobj, closefd=False)
+
+    def write(self, data):
+        self.bytes += len(data)
+        return self._writer.write(data)
+
+    def close(self):
+        self._writer.close()
+
+
+def write_archive(source_dir, archive_path, arcname='config', compression='gzip', workers=4, level=None):
+    """Function that streams source_dir into a compressed tar archive at archive_path.
+    The archive is written to a temporary file and renamed into place when complete,
+    and its sha256 is recorded in <archive_path>.sha256 for later validation.
+    Returns stats with bytes in and out, compression ratio and throughput.
+    """
+
+    if compression == 'zstd' and not HAS_ZSTD:
+        raise IOError("zstd compression needs the zstandard python library on the target host")
+
+    start = time.time()
+    directory = os.path.dirname(os.path.abspath(archive_path))
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    fd, tmp_file = tempfile.mkstemp(dir=directory, prefix='.archive')
+    try:
+        with os.fdopen(fd, 'wb') as f_obj:
+            output = HashingWriter(f_obj)
+            if compression == 'zstd':
+                stream = ZstdWriter(output, workers, 3 if level is None else level)
+            else:
+                stream = ParallelGzipWriter(output, workers, 6 if level is None else level)
+            tar = tarfile.open(fileobj=stream, mode='w|', format=tarfile.PAX_FORMAT)
+            tar.add(source_dir, arcname=arcname)
+            tar.close()
+            stream.close()
+        os.rename(tmp_file, archive_path)
+    except BaseException:
+        os.unlink(tmp_file)
+        raise
+
+    with open(archive_path + '.sha256', 'w') as f_obj:
+        f_obj.write('{0}  {1}\n'.format(output.sha256.hexdigest(), os.path.basename(archive_path)))
+
+    elapsed = max(time.time() - start, 0.001)
+    return dict(
+        archive=archive_path,
+        compression=compression,
+        bytes_in=stream.bytes,
+        bytes_out=output.bytes,
+        ratio=round(float(stream.bytes) / max(output.bytes, 1), 2),
+        mb_per_second=round(stream.bytes / 1048576.0 / elapsed, 1),
+        sha256=output.sha256.hexdigest(),
+        elapsed=round(elapsed, 3)
+    )
+
+
+def archive_format(path):
+    """Function that returns zip, gzip or zstd for an archive path, based on its suffix."""
+
+    if path.endswith('.zip'):
+        return 'zip'
+    if path.endswith('.zst'):
+        return 'zstd'
+    return 'gzip'
+
+
+def recorded_sha256(path):
+    """Function that returns the sha256 recorded in <path>.sha256, or None."""
+
+    try:
+        with open(path + '.sha256') as f_obj:
+            return f_obj.read().split()[0]
+    except (IOError, OSError, IndexError):
+        return None
+
+
+class HashingReader(object):
+    """File wrapper that sha256 hashes everything read through it."""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.sha256 = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.sha256.update(data)
+        return data
+
+    def drain(self):
+        for data in iter(lambda: self.read(CHUNK_SIZE), b''):
+            pass
+        return self.sha256.hexdigest()
+
+
+# What reading a corrupt compressed tar stream raises, zstandard's errors not being OSErrors.
+STREAM_ERRORS = (tarfile.TarError, zlib.error, EOFError) + ((zstandard.ZstdError,) if HAS_ZSTD else ())
+
+
+def open_tar_stream(fileobj, compression):
+    """Function that opens a gzip or zstd compressed tar stream for reading front to back."""
+
+    if compression == 'zstd':
+        if not HAS_ZSTD:
+            raise IOError("zstd archives need the zstandard python library on the target host")
+        return tarfile.open(fileobj=zstandard.ZstdDecompressor().stream_reader(fileobj), mode='r|')
+    # GzipFile rather than tarfile's own r|gz, which stops after the first gzip member.
+    return tarfile.open(fileobj=gzip.GzipFile(fileobj=fileobj, mode='rb'), mode='r|')
+
+
+def _member_path(target_dir, name, strip):
+    """Function that maps an archive entry to a path under target_dir, refusing
+    absolute paths and entries that would land outside of target_dir.
+    """
+
+    if strip and (name == strip.rstrip('/') or name.startswith(strip)):
+        name = name[len(strip):]
+    path = os.path.normpath(os.path.join(target_dir, name))
+    if os.path.isabs(name) or not (path == target_dir or path.startswith(target_dir + os.sep)):
+        raise IOError("Archive entry {0} points outside of the restore directory".format(name))
+    return path
+
+
+def contained_path(base, path):
+    """Function that refuses path when it resolves outside of base, also through
+    symlinks already extracted under base, e.g. an entry x -> / followed by x/etc/passwd.
+    """
+
+    real_base = os.path.realpath(base)
+    real = os.path.realpath(path)
+    if not (real == real_base or real.startswith(real_base + os.sep)):
+        raise IOError("Archive entry {0} resolves outside of {1}".format(path, base))
+    return path
+
+
+def _common_prefix(names):
+    """Function that returns 'config/' when every entry sits under a top level config
+    directory, as in archives written by write_archive, so it can be stripped.
+    """
+
+    names = [name for name in names if name.strip('/')]
+    if names and all(name.rstrip('/') == 'config' or name.startswith('config/') for name in names):
+        return 'config/'
+    return ''
+
+
+def _split(items, parts):
+    buckets = [[] for _ in range(max(1, parts))]
+    for index, item in enumerate(items):
+        buckets[index % len(buckets)].append(item)
+    return [bucket for bucket in buckets if bucket]
+
+
+def validate_archive(path, workers=4):
+    """Function that checks an archive end to end before anything is restored from it.
+    Zip entries are all read back against their CRC on a thread pool, tar archives are
+    fully decompressed and compared to the sha256 recorded next to them when present.
+    Raises IOError describing the first problem found. Returns the number of entries.
+    """
+
+    compression = archive_format(path)
+    if compression == 'zip':
+        try:
+            with zipfile.ZipFile(path) as archive:
+                infos = sorted(archive.infolist(), key=lambda info: -info.file_size)
+        except (zipfile.BadZipfile, zipfile.LargeZipFile) as err:
+            raise IOError("{0} is not a valid zip archive: {1}".format(path, err))
+
+        def check(bucket):
+            with zipfile.ZipFile(path) as archive:
+                for info in bucket:
+                    try:
+                        with archive.open(info) as member:
+                            for data in iter(lambda: member.read(CHUNK_SIZE), b''):
+                                pass
+                    except (zipfile.BadZipfile, zlib.error, EOFError) as err:
+                        return "{0}: {1}".format(info.filename, err)
+            return None
+
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            errors = [error for error in executor.map(check, _split(infos, workers)) if error]
+        if errors:
+            raise IOError("Corrupt entries in {0}: {1}".format(path, '; '.join(errors)))
+        expected = recorded_sha256(path)
+        if expected is not None:
+            with open(path, 'rb') as f_obj:
+                if HashingReader(f_obj).drain() != expected:
+                    raise IOError("{0} does not match its recorded sha256".format(path))
+        return len(infos)
+
+    entries = 0
+    with open(path, 'rb') as f_obj:
+        reader = HashingReader(f_obj)
+        try:
+            tar = open_tar_stream(reader, compression)
+            for member in tar:
+                entries += 1
+                if member.isfile():
+                    data = tar.extractfile(member)
+                    for chunk in iter(lambda: data.read(CHUNK_SIZE), b''):
+                        pass
+            tar.close()
+        except STREAM_ERRORS + (OSError,) as err:
+            raise IOError("{0} is not a valid archive: {1}".format(path, err))
+        digest = reader.drain()
+    expected = recorded_sha256(path)
+    if expected is not None and digest != expected:
+        raise IOError("{0} does not match its recorded sha256".format(path))
+    return entries
+
+
+def extract_archive(path, target_dir, workers=4):
+    """Function that extracts a validated archive into target_dir, which must not exist yet.
+    Zip entries are extracted in parallel, each worker with its own handle on the archive.
+    Tar streams can only be read front to back, so they are extracted in one pass.
+    Entries that would land outside of target_dir, directly or through a symlink,
+    and symlinks pointing outside of it are refused. Returns stats for the extraction.
+    """
+
+    start = time.time()
+    stats = dict(entries=0, bytes=0)
+    os.makedirs(target_dir)
+
+    if archive_format(path) == 'zip':
+        with zipfile.ZipFile(path) as archive:
+            infos = archive.infolist()
+        strip = _common_prefix([info.filename for info in infos])
+        for info in infos:
+            if info.filename.endswith('/'):
+                directory = _member_path(target_dir, info.filename, strip)
+                if not os.path.isdir(directory):
+                    os.makedirs(directory)
+        files = sorted([info for info in infos if not info.filename.endswith('/')],
+                       key=lambda info: -info.file_size)
+
+        def extract(bucket):
+            with zipfile.ZipFile(path) as archive:
+                for info in bucket:
+                    target = _member_path(target_dir, info.filename, strip)
+                    if not os.path.isdir(os.path.dirname(target)):
+                        try:
+                            os.makedirs(os.path.dirname(target))
+                        except OSError:
+                            if not os.path.isdir(os.path.dirname(target)):
+                                raise
+                    with archive.open(info) as member:
+                        with open(target, 'wb') as f_obj:
+                            shutil.copyfileobj(member, f_obj, CHUNK_SIZE)
+                    mode = (info.external_attr >> 16) & 0o7777
+                    if mode:
+                        os.chmod(target, mode)
+            return len(bucket)
+
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            list(executor.map(extract, _split(files, workers)))
+        stats['entries'] = len(infos)
+        stats['bytes'] = sum(info.file_size for info in files)
+    else:
+        with open(path, 'rb') as f_obj:
+            try:
+                tar = open_tar_stream(f_obj, archive_format(path))
+                for member in tar:
+                    strip = 'config/' if member.name == 'config' or member.name.startswith('config/') else ''
+                    if not member.name.strip('/') or member.name.rstrip('/') == strip.rstrip('/'):
+                        continue
+                    target = contained_path(target_dir, _member_path(target_dir, member.name, strip))
+                    member.name = os.path.relpath(target, target_dir)
+                    if member.islnk():
+                        member.linkname = os.path.relpath(_member_path(target_dir, member.linkname, strip),
+                                                          target_dir)
+                    elif member.issym():
+                        contained_path(target_dir, os.path.join(os.path.dirname(target), member.linkname))
+                    tar.extract(member, target_dir)
+                    stats['entries'] += 1
+                    stats['bytes'] += member.size if member.isfile() else 0
+                tar.close()
+            except STREAM_ERRORS as err:
+                raise IOError("{0} is not a valid archive: {1}".format(path, err))
+
+    stats['elapsed'] = round(time.time() - start, 3)
+    return stats
+
+
+def staging_dir(target_dir, label='restore'):
+    """Function that returns a fresh staging path next to target_dir on the same filesystem."""
+
+    path = '{0}.{1}-{2}'.format(target_dir.rstrip('/'), label, time.strftime('%Y%m%dT%H%M%S'))
+    candidate, count = path, 0
+    while os.path.lexists(candidate):
+        count += 1
+        candidate = '{0}.{1}'.format(path, count)
+    return candidate
+
+
+def swap_into_place(staging, target_dir):
+    """Function that swaps a fully populated staging directory into target_dir.
+    The current target_dir is renamed aside first and put back if the swap fails.
+    Returns the path the previous target_dir was moved to, or None if there was none.
+    """
+
+    previous = None
+    if os.path.exists(target_dir):
+        previous = staging_dir(target_dir, 'prev')
+        os.rename(target_dir, previous)
+    try:
+        os.rename(staging, target_dir)
+    except OSError:
+        if previous is not None:
+            os.rename(previous, target_dir)
+        raise
+    return previous
+
+
+def discard(path):
+    """Function that removes a staging directory left behind by a failed run."""
+
+    shutil.rmtree(path, ignore_errors=True)
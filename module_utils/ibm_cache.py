@@ -0,0 +1,138 @@
+"""Small on-host cache for facts the ibm_* modules discover.
+
+Entries are stored in a JSON file and stamped with the mtime and size of the
+files they were built from. An entry is only handed back while every source
+file still carries the same stamp, so the cache never has to be cleared by hand.
+
+fact_cache() keeps the facts of an install next to it, in
+<root>/.ansible_ibm_facts.json, so every module and every user working on that
+install shares one cache: installed packages, profiles, product versions,
+serverindex endpoints and httpd configuration. Whether a process is alive is
+never cached, pid liveness is always checked again. Writes take an flock on
+<cache file>.lock and merge with what is on disk, so modules running at the
+same time don't drop each other's entries.
+
+author: Tom Davison (@tntdavison784)
+"""
+
+import fcntl
+import json
+import os
+import tempfile
+
+
+DEFAULT_CACHE_FILE = os.path.expanduser('~/.ansible/cache/ibm_facts.json')
+FACT_CACHE_NAME = '.ansible_ibm_facts.json'
+
+
+def source_stamp(paths):
+    """Function that returns the stamp (path, mtime, size) for each source file.
+    Returns None if any of the sources is missing, meaning the result can't be cached.
+    """
+
+    stamp = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        stamp.append([path, st.st_mtime, st.st_size])
+    return stamp
+
+
+class FileCache(object):
+    """JSON backed cache keyed on the stamps of the files an entry was built from."""
+
+    def __init__(self, cache_file=None):
+        self.cache_file = cache_file or DEFAULT_CACHE_FILE
+        self._data = None
+
+    def _read(self):
+        try:
+            with open(self.cache_file) as f_obj:
+                return json.load(f_obj)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def _load(self):
+        if self._data is None:
+            self._data = self._read()
+        return self._data
+
+    def _save(self, key):
+        """Function that writes key's entry (or its removal) into the cache file, merged
+        with the entries other processes wrote since it was loaded.
+        """
+
+        cache_dir = os.path.dirname(self.cache_file)
+        try:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            with open(self.cache_file + '.lock', 'a') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                data = self._read()
+                if key in self._data:
+                    data[key] = self._data[key]
+                else:
+                    data.pop(key, None)
+                fd, tmp_file = tempfile.mkstemp(dir=cache_dir, prefix='.ibm_cache')
+                with os.fdopen(fd, 'w') as f_obj:
+                    json.dump(data, f_obj)
+                os.chmod(tmp_file, 0o644)
+                os.rename(tmp_file, self.cache_file)
+                self._data = data
+        except (IOError, OSError):
+            # A cache that can't be written is only a missed speed up.
+            pass
+
+    def get(self, key, sources, build):
+        """Function that returns the cached value for key if its sources are unchanged.
+        Otherwise build() is called, and its result is stored against the current stamp.
+        """
+
+        stamp = source_stamp(sources)
+        entry = self._load().get(key)
+        if stamp is not None and entry is not None and entry.get('stamp') == stamp:
+            return entry['value']
+
+        value = build()
+        if stamp is not None:
+            self._data[key] = dict(stamp=stamp, value=value)
+            self._save(key)
+        return value
+
+    def get_tracked(self, key, build):
+        """Function that returns the cached value for key while the files it was built from
+        are unchanged, for values whose sources are only known once built, e.g. a config
+        file and everything it includes. build() returns (value, sources).
+        """
+
+        entry = self._load().get(key)
+        if entry is not None and entry.get('stamp'):
+            if source_stamp([source[0] for source in entry['stamp']]) == entry['stamp']:
+                return entry['value']
+
+        value, sources = build()
+        stamp = source_stamp(sources)
+        if stamp is not None:
+            self._data[key] = dict(stamp=stamp, value=value)
+            self._save(key)
+        return value
+
+    def invalidate(self, key):
+        """Function that drops a single entry from the cache."""
+
+        if self._load().pop(key, None) is not None:
+            self._save(key)
+
+
+def fact_cache(root):
+    """Function that returns the shared fact cache of an install root, e.g. the WAS root,
+    a profile or the IM data location. Falls back to the per user cache when the
+    root's cache can be neither read nor written by this user.
+    """
+
+    cache_file = os.path.join(root, FACT_CACHE_NAME)
+    if os.access(root, os.W_OK) or os.access(cache_file, os.R_OK):
+        return FileCache(cache_file)
+    return FileCache()
@@ -0,0 +1,300 @@
+"""Parser and editor for IHS (Apache httpd) configuration files.
+
+A config file is parsed into a tree of plain dicts, so it can be cached as JSON:
+
+    dict(type='directive', name='LoadModule', args=['ssl_module', 'modules/mod_ssl.so'],
+         file='/opt/IBM/HTTPServer/conf/httpd.conf', line=120, end=120)
+    dict(type='section', name='VirtualHost', args=['*:443'], file=..., line=300, end=340,
+         children=[...])
+    dict(type='include', name='Include', args=['conf.d/*.conf'], file=..., line=500, end=500,
+         files=[...], children=[...])
+
+Include and IncludeOptional are expanded in place, globs and directories relative
+to ServerRoot like httpd does. The parsed tree is kept in the ServerRoot's shared
+fact cache (see ibm_cache) and stamped on every file it was read from, plus the directories of wildcard
+includes, so adding a file to conf.d is noticed as well.
+
+Edits are planned against the tree and returned as new file contents with a
+unified diff, so callers can report the change (and honour check mode) before
+anything is written. Planning is idempotent: a directive already present with the
+same arguments, in the main file or any included one, is left alone.
+
+author: Tom Davison (@tntdavison784)
+"""
+
+import difflib
+import glob
+import os
+import re
+
+from ansible.module_utils.ibm_cache import fact_cache
+
+
+INCLUDE_DIRECTIVES = ('include', 'includeoptional')
+ARG_PATTERN = re.compile(r'"((?:[^"\\]|\\.)*)"|(\S+)')
+VARIABLE_PATTERN = re.compile(r'\$\{(\w+)\}')
+
+
+def split_args(text):
+    """Function that splits a directive's arguments, honouring double quotes."""
+
+    return [quoted if quoted or bare == '' else bare
+            for quoted, bare in ARG_PATTERN.findall(text)]
+
+
+def _logical_lines(path):
+    """Function that yields (line number, end line number, text) for every non comment
+    line of a file, with backslash continued lines joined.
+    """
+
+    with open(path) as f_obj:
+        lines = f_obj.read().split('\n')
+
+    index = 0
+    while index < len(lines):
+        start = index
+        text = lines[index].rstrip()
+        while text.endswith('\\') and index + 1 < len(lines):
+            index += 1
+            text = text[:-1] + ' ' + lines[index].strip()
+        index += 1
+        text = text.strip()
+        if text and not text.startswith('#'):
+            yield start + 1, index, text
+
+
+class _Parser(object):
+
+    def __init__(self, server_root):
+        self.server_root = server_root
+        self.defines = {}
+        self.files = []
+        self.sources = []
+
+    def expand(self, text):
+        return VARIABLE_PATTERN.sub(lambda match: self.defines.get(match.group(1),
+                                                                   os.environ.get(match.group(1), match.group(0))),
+                                    text)
+
+    def include_files(self, pattern):
+        if not os.path.isabs(pattern):
+            pattern = os.path.join(self.server_root, pattern)
+        if os.path.isdir(pattern):
+            self.sources.append(pattern)
+            pattern = os.path.join(pattern, '*')
+        elif glob.has_magic(pattern):
+            directory = os.path.dirname(pattern)
+            if os.path.isdir(directory):
+                self.sources.append(directory)
+        return sorted(path for path in glob.glob(pattern) if os.path.isfile(path)) or \
+            ([] if glob.has_magic(pattern) else [pattern])
+
+    def parse_file(self, path, stack=()):
+        if path in stack:
+            raise ValueError('Include loop through {0}'.format(path))
+        self.files.append(path)
+        self.sources.append(path)
+
+        root = dict(children=[])
+        open_sections = [root]
+        for line, end, text in _logical_lines(path):
+            text = self.expand(text)
+            if text.startswith('</'):
+                if len(open_sections) > 1:
+                    open_sections.pop()['end'] = end
+                continue
+
+            if text.startswith('<'):
+                words = text.strip('<>').split(None, 1)
+                node = dict(type='section', name=words[0], args=split_args(words[1] if len(words) > 1 else ''),
+                            file=path, line=line, end=end, children=[])
+                open_sections[-1]['children'].append(node)
+                open_sections.append(node)
+                continue
+
+            words = text.split(None, 1)
+            node = dict(type='directive', name=words[0], args=split_args(words[1] if len(words) > 1 else ''),
+                        file=path, line=line, end=end)
+            lowered = node['name'].lower()
+            if lowered == 'serverroot' and node['args']:
+                self.server_root = node['args'][0]
+            elif lowered == 'define' and node['args']:
+                self.defines[node['args'][0]] = node['args'][1] if len(node['args']) > 1 else ''
+            elif lowered in INCLUDE_DIRECTIVES and node['args']:
+                node.update(type='include', files=[], children=[])
+                for included in self.include_files(node['args'][0]):
+                    if not os.path.isfile(included):
+                        node['missing'] = included
+                        continue
+                    node['files'].append(included)
+                    node['children'].extend(self.parse_file(included, stack + (path,)))
+            open_sections[-1]['children'].append(node)
+        return root['children']
+
+
+def parse_config(conf, server_root=None):
+    """Function that parses conf and everything it includes.
+    Returns dict(conf, server_root, files, nodes), and the list of files and
+    directories the result was built from.
+    """
+
+    parser = _Parser(server_root or os.path.dirname(os.path.dirname(os.path.abspath(conf))))
+    nodes = parser.parse_file(conf)
+    tree = dict(conf=conf, server_root=parser.server_root, files=parser.files, nodes=nodes)
+    return tree, sorted(set(parser.sources))
+
+
+def load_config(conf, server_root=None, cache=None):
+    """Function that returns the parsed tree of conf, cached until any file it was
+    read from (or a wildcard include directory) changes.
+    """
+
+    root = server_root or os.path.dirname(os.path.dirname(os.path.abspath(conf)))
+    return (cache or fact_cache(root)).get_tracked('ibm_httpd_conf:{0}:{1}'.format(conf, server_root),
+                                                   lambda: parse_config(conf, server_root))
+
+
+def iter_nodes(nodes, sections=()):
+    """Function that walks a tree depth first, yielding (node, enclosing sections)
+    for every directive and section, through includes as well.
+    """
+
+    for node in nodes:
+        yield node, sections
+        if node['type'] != 'directive':
+            inner = sections + (node,) if node['type'] == 'section' else sections
+            for found in iter_nodes(node['children'], inner):
+                yield found
+
+
+def _section_matches(section, spec):
+    words = spec.split(None, 1)
+    return section['name'].lower() == words[0].lower() and \
+        (len(words) == 1 or section['args'] == split_args(words[1]))
+
+
+def find_directives(tree, name, args=None, section=None):
+    """Function that returns the directives called name (case insensitive, like httpd),
+    only those with exactly args when given, and only inside a section matching
+    section, e.g. 'VirtualHost *:443', when given.
+    """
+
+    found = []
+    for node, sections in iter_nodes(tree['nodes']):
+        if node['type'] == 'section' or node['name'].lower() != name.lower():
+            continue
+        if args is not None and node['args'] != list(args):
+            continue
+        if section is not None and not any(_section_matches(outer, section) for outer in sections):
+            continue
+        found.append(node)
+    return found
+
+
+def find_sections(tree, section):
+    """Function that returns the sections matching section, e.g. 'VirtualHost *:443'."""
+
+    return [node for node, _ in iter_nodes(tree['nodes'])
+            if node['type'] == 'section' and _section_matches(node, section)]
+
+
+def loaded_modules(tree):
+    """Function that returns the LoadModule directives as a dict of module -> shared object."""
+
+    return dict((node['args'][0], node['args'][1]) for node in find_directives(tree, 'LoadModule')
+                if len(node['args']) > 1)
+
+
+def virtual_hosts(tree):
+    """Function that returns a summary of every VirtualHost section."""
+
+    hosts = []
+    for section in find_sections(tree, 'VirtualHost'):
+        values = dict((node['name'].lower(), node['args']) for node, _ in iter_nodes(section['children'])
+                      if node['type'] == 'directive')
+        hosts.append(dict(
+            addresses=section['args'],
+            server_name=(values.get('servername') or [None])[0],
+            aliases=values.get('serveralias', []),
+            document_root=(values.get('documentroot') or [None])[0],
+            file=section['file'],
+            line=section['line']
+        ))
+    return hosts
+
+
+def format_directive(name, args):
+    """Function that renders a directive line, quoting arguments that need it."""
+
+    return ' '.join([name] + ['"{0}"'.format(arg) if not arg or re.search(r'\s', arg) else arg
+                              for arg in args])
+
+
+def _read_lines(path, contents):
+    if path not in contents:
+        with open(path) as f_obj:
+            contents[path] = f_obj.read().split('\n')
+    return contents[path]
+
+
+def plan_directive(tree, name, args, state='present', section=None):
+    """Function that works out the edit that puts a directive into state.
+    present adds the directive after the last directive of the same name in the
+    main file (or section), or at its end, unless it is already there. absent
+    removes every matching directive, from whichever file holds it.
+    Returns dict(changed, files={path: new content}, diff).
+    """
+
+    args = list(args or [])
+    matches = find_directives(tree, name, args, section)
+    contents = {}
+
+    if state == 'present' and not matches:
+        if section is not None:
+            targets = find_sections(tree, section)
+            if not targets:
+                raise ValueError('No section {0} found in {1}'.format(section, tree['conf']))
+            target = targets[0]
+            siblings = [node for node in target['children']
+                        if node['type'] != 'section' and node['name'].lower() == name.lower()]
+            path, indent = target['file'], '    '
+            position = siblings[-1]['end'] if siblings and siblings[-1]['file'] == path else target['end'] - 1
+        else:
+            siblings = [node for node in tree['nodes']
+                        if node['type'] != 'section' and node['name'].lower() == name.lower()]
+            path, indent = tree['conf'], ''
+            lines = _read_lines(path, contents)
+            position = siblings[-1]['end'] if siblings else len(lines) - (1 if lines and lines[-1] == '' else 0)
+        _read_lines(path, contents).insert(position, indent + format_directive(name, args))
+
+    if state == 'absent':
+        # Remove from the bottom up so earlier line numbers stay valid.
+        for node in sorted(matches, key=lambda node: node['line'], reverse=True):
+            del _read_lines(node['file'], contents)[node['line'] - 1:node['end']]
+
+    diff, files = [], {}
+    for path in sorted(contents):
+        with open(path) as f_obj:
+            before = f_obj.read()
+        after = '\n'.join(contents[path])
+        if after != before:
+            files[path] = after
+            diff.extend(difflib.unified_diff(before.splitlines(True), after.splitlines(True),
+                                             fromfile=path, tofile=path))
+    return dict(changed=bool(files), files=files, diff=''.join(diff))
+
+
+def write_files(files, backup_suffix=None):
+    """Function that writes the planned contents, keeping a copy of each original
+    under backup_suffix when given and no such copy exists yet.
+    """
+
+    for path, content in files.items():
+        if backup_suffix and not os.path.exists(path + backup_suffix):
+            with open(path) as f_obj, open(path + backup_suffix, 'w') as backup:
+                backup.write(f_obj.read())
+        tmp_file = path + '.ansible-tmp'
+        with open(tmp_file, 'w') as f_obj:
+            f_obj.write(content)
+        os.chmod(tmp_file, os.stat(path).st_mode & 0o7777)
+        os.rename(tmp_file, path)
@@ -0,0 +1,304 @@
+"""Golden images of IBM Installation Manager installs.
+
+An image is a compressed tar of everything one imcl install leaves on a host,
+so identical hosts can be built by extracting it instead of running imcl:
+
+    dest/...        the install root, e.g /opt/IBM/WebSphere/AppServer
+    shared/...      the shared resources directory, e.g /opt/IBM/IMShared
+    registry/...    the IM agent data location holding installed.xml
+    image.json      manifest: roots, packages, IM agent version and the
+                    sha256 of every file in the image
+
+The manifest is written last, as the file hashes are taken while the trees are
+streamed into the archive, so every file is read exactly once. A copy of it
+without the file hashes is kept next to the image as <image>.json for planning,
+and the sha256 of the whole image as <image>.sha256, like ibm_backup's archives.
+
+IM's registry records absolute paths, so an image can only be installed at the
+paths it was captured from, with the same IM agent version, on a host whose
+registry has nothing else installed yet. The registry then matches the trees
+it describes and later updates and rollbacks through imcl keep working.
+
+Installing streams the image once into staging directories next to each root,
+checking every file against the manifest on the way. Permissions, ownership
+(when run as root), symlinks and hardlinks are kept. Nothing is written through
+a symlink, and symlinks may only point into the roots of the image. Only when everything
+verifies are the staging directories swapped into place.
+
+author: Tom Davison (@tntdavison784)
+"""
+
+import io
+import json
+import os
+import tarfile
+import tempfile
+import time
+
+from ansible.module_utils.ibm_backup import (CHUNK_SIZE, STREAM_ERRORS, HashingReader, HashingWriter,
+                                             ParallelGzipWriter, ZstdWriter, HAS_ZSTD, archive_format,
+                                             contained_path, discard, open_tar_stream, recorded_sha256,
+                                             staging_dir, swap_into_place, walk_tree)
+from ansible.module_utils.ibm_cache import FACT_CACHE_NAME
+from ansible.module_utils.ibm_imcl_queue import QUEUE_DIR_NAME
+
+
+MANIFEST_NAME = 'image.json'
+AGENT_ID = 'com.ibm.cic.agent'
+IMAGE_ROOTS = ('dest', 'shared', 'registry')
+# Host specific state that must not travel with an image.
+SKIP_NAMES = (FACT_CACHE_NAME, FACT_CACHE_NAME + '.lock', QUEUE_DIR_NAME)
+SKIP_REGISTRY = ('logs',)
+
+
+def read_manifest(image_path):
+    """Function that returns the manifest kept next to an image, or None."""
+
+    try:
+        with open(image_path + '.json') as f_obj:
+            return json.load(f_obj)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def _skipped(label, rel):
+    first = rel.split(os.sep, 1)[0]
+    return first in SKIP_NAMES or (label == 'registry' and first in SKIP_REGISTRY)
+
+
+def capture_image(roots, image_path, info, compression='gzip', workers=4, level=None):
+    """Function that streams the trees in roots, a list of (label, path), into an image
+    at image_path. info is merged into the manifest (packages, agent, imcl).
+    Returns stats with bytes in and out, files and throughput.
+    """
+
+    if compression == 'zstd' and not HAS_ZSTD:
+        raise IOError("zstd compression needs the zstandard python library on the target host")
+
+    start = time.time()
+    directory = os.path.dirname(os.path.abspath(image_path))
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    files, sizes = {}, dict((label, 0) for label, _ in roots)
+    fd, tmp_file = tempfile.mkstemp(dir=directory, prefix='.image')
+    try:
+        with os.fdopen(fd, 'wb') as f_obj:
+            output = HashingWriter(f_obj)
+            if compression == 'zstd':
+                stream = ZstdWriter(output, workers, 3 if level is None else level)
+            else:
+                stream = ParallelGzipWriter(output, workers, 6 if level is None else level)
+            tar = tarfile.open(fileobj=stream, mode='w|', format=tarfile.PAX_FORMAT, copybufsize=CHUNK_SIZE)
+            for label, root in roots:
+                tar.addfile(tar.gettarinfo(root, label))
+                for rel, _ in walk_tree(root):
+                    if _skipped(label, rel):
+                        continue
+                    member = tar.gettarinfo(os.path.join(root, rel), '{0}/{1}'.format(label, rel))
+                    if member.isreg():
+                        with open(os.path.join(root, rel), 'rb') as source:
+                            reader = HashingReader(source)
+                            tar.addfile(member, reader)
+                        files[member.name] = reader.sha256.hexdigest()
+                        sizes[label] += member.size
+                    else:
+                        tar.addfile(member)
+
+            manifest = dict(info, roots=dict(roots), bytes=sizes, created=int(time.time()))
+            data = json.dumps(dict(manifest, files=files), sort_keys=True).encode('utf-8')
+            member = tarfile.TarInfo(MANIFEST_NAME)
+            member.size, member.mtime = len(data), time.time()
+            tar.addfile(member, io.BytesIO(data))
+            tar.close()
+            stream.close()
+        os.rename(tmp_file, image_path)
+    except BaseException:
+        os.unlink(tmp_file)
+        raise
+
+    with open(image_path + '.sha256', 'w') as f_obj:
+        f_obj.write('{0}  {1}\n'.format(output.sha256.hexdigest(), os.path.basename(image_path)))
+    with open(image_path + '.json', 'w') as f_obj:
+        json.dump(dict(manifest, file_count=len(files)), f_obj, sort_keys=True)
+
+    elapsed = max(time.time() - start, 0.001)
+    return dict(
+        image=image_path,
+        files=len(files),
+        bytes_in=stream.bytes,
+        bytes_out=output.bytes,
+        ratio=round(float(stream.bytes) / max(output.bytes, 1), 2),
+        mb_per_second=round(stream.bytes / 1048576.0 / elapsed, 1),
+        sha256=output.sha256.hexdigest(),
+        elapsed=round(elapsed, 3)
+    )
+
+
+def _is_empty(path):
+    return not os.path.exists(path) or (os.path.isdir(path) and not os.listdir(path))
+
+
+def target_problems(manifest, roots, installed, imcl):
+    """Function that lists why an image can't be installed on this host, empty when it can.
+    roots maps dest, shared and registry to this host's paths, installed is the
+    package index of this host's IM registry and imcl the path of this host's imcl.
+    """
+
+    problems = []
+    for label in IMAGE_ROOTS:
+        if os.path.normpath(manifest['roots'][label]) != os.path.normpath(roots[label]):
+            problems.append("image {0} is {1}, not {2}".format(label, manifest['roots'][label], roots[label]))
+    if manifest.get('imcl') != imcl:
+        problems.append("image was captured with imcl {0}, not {1}".format(manifest.get('imcl'), imcl))
+    for label in ('dest', 'shared'):
+        if not _is_empty(roots[label]):
+            problems.append("{0} is not empty".format(roots[label]))
+
+    agent = [package['version'] for package in installed.values() if package['id'] == AGENT_ID]
+    if manifest.get('agent') not in agent:
+        problems.append("image needs IM agent {0}, this host has {1}".format(
+            manifest.get('agent'), agent[0] if agent else 'none'))
+    others = sorted(name for name, package in installed.items() if package['id'] != AGENT_ID)
+    if others:
+        problems.append("IM registry already has {0}".format(' '.join(others)))
+    return problems
+
+
+def _target(base, rel):
+    path = os.path.normpath(os.path.join(base, rel))
+    if os.path.isabs(rel) or not (path == base or path.startswith(base + os.sep)):
+        raise IOError("Image entry {0} points outside of {1}".format(rel, base))
+    return path
+
+
+def _apply_attributes(tar, member, path):
+    if os.geteuid() == 0:
+        tar.chown(member, path, False)
+    if not member.issym():
+        os.chmod(path, member.mode)
+        os.utime(path, (member.mtime, member.mtime))
+
+
+def _check_symlink(roots, label, rel, linkname):
+    """Function that refuses a symlink that, once in place, points outside of the image roots."""
+
+    link = os.path.normpath(os.path.join(roots[label], rel))
+    target = os.path.normpath(os.path.join(os.path.dirname(link), linkname))
+    for root in roots.values():
+        root = os.path.normpath(root)
+        if target == root or target.startswith(root + os.sep):
+            return
+    raise IOError("Image symlink {0}/{1} points outside of the image roots: {2}".format(label, rel, linkname))
+
+
+def _extract_members(tar, staging, roots, directories, seen, stats):
+    """Function that writes every entry of an image stream under the staging directories,
+    hashing regular files into seen and leaving directory attributes for later.
+    Returns the manifest found in the stream, or None.
+    """
+
+    manifest = None
+    for member in tar:
+        if member.name == MANIFEST_NAME:
+            manifest = json.loads(tar.extractfile(member).read().decode('utf-8'))
+            continue
+        label, _, rel = member.name.partition('/')
+        if label not in staging:
+            raise IOError("Unexpected entry {0}".format(member.name))
+        path = contained_path(staging[label], _target(staging[label], rel))
+        stats['entries'] += 1
+        if member.isdir():
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            directories.append((path, member))
+            continue
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        if member.isreg():
+            source = HashingReader(tar.extractfile(member))
+            with open(path, 'wb') as target:
+                for data in iter(lambda: source.read(CHUNK_SIZE), b''):
+                    target.write(data)
+            seen[member.name] = source.sha256.hexdigest()
+            stats['bytes'] += member.size
+        elif member.issym():
+            _check_symlink(roots, label, rel, member.linkname)
+            os.symlink(member.linkname, path)
+        elif member.islnk():
+            link_label, _, link_rel = member.linkname.partition('/')
+            if link_label not in staging:
+                raise IOError("Unexpected link {0}".format(member.linkname))
+            os.link(contained_path(staging[link_label], _target(staging[link_label], link_rel)), path,
+                    follow_symlinks=False)
+        else:
+            continue
+        _apply_attributes(tar, member, path)
+    return manifest
+
+
+def extract_image(image_path, roots):
+    """Function that streams an image into staging directories next to this host's roots,
+    verifying every file and the image itself on the way. Raises IOError, leaving nothing
+    behind, when anything doesn't match. Returns (manifest, {label: staging dir}, stats).
+    """
+
+    start = time.time()
+    staging, directories, seen = {}, [], {}
+    stats = dict(entries=0, bytes=0)
+    try:
+        for label in IMAGE_ROOTS:
+            parent = os.path.dirname(os.path.abspath(roots[label]))
+            if not os.path.isdir(parent):
+                os.makedirs(parent)
+            staging[label] = staging_dir(os.path.abspath(roots[label]), 'image')
+            os.makedirs(staging[label])
+
+        with open(image_path, 'rb') as f_obj:
+            reader = HashingReader(f_obj)
+            try:
+                tar = open_tar_stream(reader, archive_format(image_path))
+                manifest = _extract_members(tar, staging, roots, directories, seen, stats)
+                tar.close()
+            except STREAM_ERRORS as err:
+                raise IOError("{0} is not a valid image: {1}".format(image_path, err))
+            digest = reader.drain()
+
+        if manifest is None:
+            raise IOError("{0} has no {1}, it is not an IM image".format(image_path, MANIFEST_NAME))
+        expected = recorded_sha256(image_path)
+        if expected is not None and digest != expected:
+            raise IOError("{0} does not match its recorded sha256".format(image_path))
+        mismatched = sorted(name for name in set(manifest['files']) | set(seen)
+                            if manifest['files'].get(name) != seen.get(name))
+        if mismatched:
+            raise IOError("{0} file(s) in {1} do not match the manifest: {2}".format(
+                len(mismatched), image_path, ' '.join(mismatched[:5])))
+        # Directories last, so read-only ones don't stop their contents being written.
+        for path, member in reversed(directories):
+            _apply_attributes(tar, member, path)
+    except BaseException:
+        for path in staging.values():
+            discard(path)
+        raise
+
+    stats['files'] = len(seen)
+    stats['elapsed'] = round(time.time() - start, 3)
+    return manifest, staging, stats
+
+
+def place_image(staging, roots):
+    """Function that swaps extracted staging directories in for this host's roots, all or
+    none. Returns {label: path the previous directory was moved to, or None}.
+    """
+
+    previous = {}
+    try:
+        for label in IMAGE_ROOTS:
+            previous[label] = swap_into_place(staging[label], roots[label])
+    except OSError:
+        for label, moved in reversed(list(previous.items())):
+            os.rename(roots[label], staging[label])
+            if moved is not None:
+                os.rename(moved, roots[label])
+        raise
+    return previous
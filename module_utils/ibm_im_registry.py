@@ -0,0 +1,78 @@
+"""Reader for IBM Installation Manager's on-disk registry.
+
+IM records everything it has installed in installed.xml under its agent data
+location, e.g. /var/ibm/InstallationManager/installed.xml:
+
+    <installInfo>
+      <location id='IBM WebSphere Application Server V8.5' kind='product'
+                path='/opt/IBM/WebSphere/AppServer'>
+        <property name='cic.selector.nl' value='en'/>
+        <package id='com.ibm.websphere.ND.v85' version='8.5.5013.20180112_1418' .../>
+      </location>
+    </installInfo>
+
+Hosts with years of fixpack history carry registries of several MB, so the
+file is streamed with iterparse and every location is dropped from memory as
+soon as its packages have been read. Only used for state detection, all
+changes still go through imcl.
+
+author: Tom Davison (@tntdavison784)
+"""
+
+import os
+
+try:
+    from xml.etree import cElementTree as etree
+except ImportError:
+    from xml.etree import ElementTree as etree
+
+
+def installed_xml_path(data_location):
+    """Function that returns the path of installed.xml for an IM agent data location."""
+
+    return os.path.join(data_location, 'installed.xml')
+
+
+def iter_installed_packages(installed_xml):
+    """Function that streams installed.xml and yields one dict per installed package
+    with the package id, version, install location and display name.
+    """
+
+    location = None
+    root = None
+    for event, elem in etree.iterparse(installed_xml, events=('start', 'end')):
+        if root is None:
+            root = elem
+        if event == 'start':
+            if elem.tag == 'location':
+                location = elem.get('path')
+            continue
+
+        if elem.tag == 'package' and location is not None and elem.get('id'):
+            yield dict(
+                id=elem.get('id'),
+                version=elem.get('version'),
+                location=location,
+                name=elem.get('name')
+            )
+        elif elem.tag == 'location':
+            location = None
+            root.clear()
+
+
+def read_installed_packages(installed_xml):
+    """Function that returns the installed package index read straight from installed.xml.
+    The index is keyed on <id>_<version>, the same form imcl takes and prints.
+    """
+
+    index = {}
+    for package in iter_installed_packages(installed_xml):
+        index['{0}_{1}'.format(package['id'], package['version'])] = dict(
+            id=package['id'],
+            version=package['version'],
+            location=package['location'],
+            name=package['name'],
+            display_version=None,
+            install_date=None
+        )
+    return index
@@ -0,0 +1,272 @@
+"""Offering index of local IBM Installation Manager repositories.
+
+A repository is a directory (or a zip of one) with a repository.config at its
+root. A composite repository only lists its children there:
+
+    LayoutPolicy=Composite
+    LayoutPolicyVersion=0.0.0.1
+    repository.url.1=./WAS
+    repository.url.2=/mnt/repos/IHS
+
+Every other repository names its offerings twice, in repository.xml and in the
+file names under Offerings/:
+
+    <offering id='com.ibm.websphere.ND.v85' version='8.5.5013.20180112_1418' .../>
+    Offerings/com.ibm.websphere.ND.v85_8.5.5013.20180112_1418.jar
+
+Both are read, so a bare offering id plus latest or a version range can be
+resolved to the full <id>_<version> imcl needs without imcl
+listAvailablePackages. The repository holding each offering is recorded too,
+so ibm_imcl's disk space preflight can size the repositories it installs
+from, each one once however many of its offerings are installed. The index
+and the repository sizes are cached per user and stamped on the repository
+files, remote (http) repositories are not indexed.
+
+author: Tom Davison (@tntdavison784)
+"""
+
+import os
+import re
+import zipfile
+
+from ansible.module_utils.ibm_cache import FileCache
+
+try:
+    from xml.etree import cElementTree as etree
+except ImportError:
+    from xml.etree import ElementTree as etree
+
+
+OFFERING_JAR = re.compile(r'(?:^|/)Offerings/([^/]+?)_(\d[^/_]*(?:_\d+)?)\.jar$')
+RANGE_PATTERN = re.compile(r'^([\[(])\s*([^,]*?)\s*,\s*([^,]*?)\s*([\])])$')
+
+
+def is_local(repo):
+    """Function that checks a repository is on this host rather than behind a URL."""
+
+    return '://' not in repo or repo.startswith('file:')
+
+
+def _local_path(repo):
+    if repo.startswith('file:'):
+        repo = '/' + repo[len('file:'):].lstrip('/')
+    # imcl also takes the path of the repository.config itself.
+    if os.path.basename(repo) == 'repository.config':
+        repo = os.path.dirname(repo)
+    return repo
+
+
+def read_config(text):
+    """Function that parses repository.config into a dict of property -> value."""
+
+    properties = {}
+    for line in text.splitlines():
+        line = line.strip()
+        if line and not line.startswith('#') and '=' in line:
+            name, value = line.split('=', 1)
+            properties[name.strip()] = value.strip()
+    return properties
+
+
+def _add(index, offering_id, version):
+    versions = index.setdefault(offering_id, [])
+    if version not in versions:
+        versions.append(version)
+
+
+def _read_repository_xml(data, found):
+    try:
+        root = etree.fromstring(data)
+    except SyntaxError:
+        return
+    for elem in root.iter('offering'):
+        if elem.get('id') and elem.get('version'):
+            found.add((elem.get('id'), elem.get('version')))
+
+
+def _tree_size(path, skip=()):
+    """Function that returns the bytes of every file under path, leaving out the
+    directories in skip (composite children, which are sized on their own).
+    """
+
+    total = 0
+    stack = [path]
+    while stack:
+        for entry in os.scandir(stack.pop()):
+            if entry.is_dir(follow_symlinks=False):
+                if entry.path not in skip:
+                    stack.append(entry.path)
+            elif entry.is_file(follow_symlinks=False):
+                total += entry.stat(follow_symlinks=False).st_size
+    return total
+
+
+def _read_directory(path, catalog, sources, seen):
+    config = os.path.join(path, 'repository.config')
+    with open(config) as f_obj:
+        properties = read_config(f_obj.read())
+    own = [config]
+
+    children = []
+    for name, child in sorted(properties.items()):
+        if name.startswith('repository.url.') and is_local(child):
+            child = _local_path(child)
+            children.append(child if os.path.isabs(child) else os.path.normpath(os.path.join(path, child)))
+    for child in children:
+        _read_repository(child, catalog, sources, seen)
+
+    found = set()
+    repository_xml = os.path.join(path, 'repository.xml')
+    if os.path.isfile(repository_xml):
+        own.append(repository_xml)
+        with open(repository_xml, 'rb') as f_obj:
+            _read_repository_xml(f_obj.read(), found)
+
+    offerings = os.path.join(path, 'Offerings')
+    if os.path.isdir(offerings):
+        own.append(offerings)
+        for entry in os.listdir(offerings):
+            match = OFFERING_JAR.search('Offerings/' + entry)
+            if match:
+                found.add(match.groups())
+
+    sources.extend(own)
+    if found:
+        catalog['children'][path] = children
+        catalog['sources'][path] = own
+        for offering_id, version in found:
+            _add(catalog['offerings'], offering_id, version)
+            catalog['location']['{0}_{1}'.format(offering_id, version)] = path
+
+
+def _read_zip(path, catalog, sources):
+    sources.append(path)
+    found = set()
+    with zipfile.ZipFile(path) as archive:
+        size = 0
+        for info in archive.infolist():
+            size += info.file_size
+            match = OFFERING_JAR.search(info.filename)
+            if match:
+                found.add(match.groups())
+            elif info.filename.rsplit('/', 1)[-1] == 'repository.xml':
+                _read_repository_xml(archive.read(info.filename), found)
+    catalog['sizes'][path] = size
+    for offering_id, version in found:
+        _add(catalog['offerings'], offering_id, version)
+        catalog['location']['{0}_{1}'.format(offering_id, version)] = path
+
+
+def _read_repository(repo, catalog, sources, seen):
+    if repo in seen:
+        return
+    seen.add(repo)
+    if os.path.isfile(repo) and zipfile.is_zipfile(repo):
+        _read_zip(repo, catalog, sources)
+    else:
+        _read_directory(repo, catalog, sources, seen)
+
+
+def read_repository(repo):
+    """Function that catalogs a local repository, following composite children.
+    Returns (dict(offerings={offering id: [versions]}, location={<id>_<version>: repository
+    (or zip) it was found in}, children={repository: composite children}, sizes={zip: bytes},
+    sources={repository: its own files the catalog was built from}), [files the catalog was
+    built from]). Directory repositories are only sized when asked, see payload_size.
+    Raises IOError when repo isn't a readable repository.
+    """
+
+    catalog, sources = dict(offerings={}, location={}, children={}, sizes={}, sources={}), []
+    _read_repository(_local_path(repo), catalog, sources, set())
+    for versions in catalog['offerings'].values():
+        versions.sort(key=version_key)
+    return catalog, sources
+
+
+def repository_catalog(repos, cache=None):
+    """Function that returns the merged catalog of the local repositories in repos as
+    dict(offerings, location, children, sizes, sources, remote), remote listing the
+    repositories that were skipped.
+    Each repository's catalog is cached until one of its files changes.
+    """
+
+    cache = cache or FileCache()
+    merged = dict(offerings={}, location={}, children={}, sizes={}, sources={}, remote=[])
+    for repo in repos:
+        if not is_local(repo):
+            merged['remote'].append(repo)
+            continue
+        catalog = cache.get_tracked('ibm_im_repository_catalog:{0}'.format(os.path.abspath(_local_path(repo))),
+                                    lambda: read_repository(repo))
+        for offering_id, versions in catalog['offerings'].items():
+            for version in versions:
+                _add(merged['offerings'], offering_id, version)
+        for key in ('location', 'children', 'sizes', 'sources'):
+            merged[key].update(catalog[key])
+    for versions in merged['offerings'].values():
+        versions.sort(key=version_key)
+    return merged
+
+
+def payload_size(catalog, packages, cache=None):
+    """Function that returns the bytes of the repositories in catalog holding packages,
+    counting every repository once. The size of a directory repository, without its
+    composite children, is cached until its repository.config, repository.xml or
+    Offerings change, the files its catalog entry was built from.
+    """
+
+    cache = cache or FileCache()
+    total = 0
+    for path in set(catalog['location'][package] for package in packages):
+        if path not in catalog['sizes']:
+            catalog['sizes'][path] = cache.get(
+                'ibm_im_repository_size:{0}'.format(os.path.abspath(path)),
+                catalog['sources'][path],
+                lambda: _tree_size(path, set(catalog['children'].get(path, []))))
+        total += catalog['sizes'][path]
+    return total
+
+
+def repository_index(repos, cache=None):
+    """Function that returns the merged offering index, offering id -> [versions], of the
+    local repositories in repos. Remote repositories are skipped.
+    """
+
+    return repository_catalog(repos, cache)['offerings']
+
+
+def version_key(version):
+    """Function that turns an IM version, e.g 8.5.5013.20180112_1418, into a sortable key."""
+
+    return [(0, int(part), '') if part.isdigit() else (1, 0, part) for part in re.split(r'[._-]', version)]
+
+
+def version_matches(version, spec):
+    """Function that checks a version against spec: latest (anything), an exact version,
+    a prefix such as 8.5.5013, or a range such as [8.5.5000,8.5.6000).
+    """
+
+    if spec in (None, 'latest'):
+        return True
+    match = RANGE_PATTERN.match(spec)
+    if match is None:
+        return version == spec or version.startswith(spec + '.') or version.startswith(spec + '_')
+
+    opening, low, high, closing = match.groups()
+    key = version_key(version)
+    if low and (key < version_key(low) or (opening == '(' and key == version_key(low))):
+        return False
+    if high and (key > version_key(high) or (closing == ')' and key >= version_key(high))):
+        return False
+    return True
+
+
+def resolve_offering(index, offering_id, spec='latest'):
+    """Function that returns <id>_<version> for the highest version of offering_id in
+    index matching spec, or None when nothing matches.
+    """
+
+    versions = [version for version in index.get(offering_id, []) if version_matches(version, spec)]
+    if not versions:
+        return None
+    return '{0}_{1}'.format(offering_id, max(versions, key=version_key))
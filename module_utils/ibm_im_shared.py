@@ -0,0 +1,119 @@
+"""Size accounting and garbage collection of IBM Installation Manager's shared resources.
+
+IM keeps what it needs for rollbacks in the shared resources directory
+(IMShared), next to the plugins and features it shares between installs:
+
+    <IMShared>/native/com.ibm.websphere.ND.v85_8.5.5013.20180112_1418.zip
+    <IMShared>/plugins/com.ibm.ws.runtime_8.5.5013.20180112_1418.jar
+    <IMShared>/.metadata/...
+
+Every entry of the first level directories is one artifact, named
+<id>_<version> plus an optional extension. Artifacts whose id is an installed
+offering are classified against the registry: the installed versions are kept,
+and so are the rollback_depth versions right below each installed one, the
+versions imcl rollback can still go back to from any install of the offering.
+Older versions are reclaimable. Anything else, component plugins whose versions
+don't follow the offering's, fixes, metadata, is unclassified and never touched.
+
+author: Tom Davison (@tntdavison784)
+"""
+
+import os
+import re
+
+from ansible.module_utils.ibm_im_repository import version_key
+
+
+ARTIFACT_PATTERN = re.compile(r'^(.+?)_(\d+\.\d+\.\d+(?:[._-]\w+)*?)(\.[A-Za-z]+)?$')
+
+
+def parse_artifact(name):
+    """Function that splits an artifact name into (id, version), or returns None
+    when the name doesn't carry a version.
+    """
+
+    match = ARTIFACT_PATTERN.match(name)
+    if match is None:
+        return None
+    return match.group(1), match.group(2)
+
+
+def _size(path):
+    if not os.path.isdir(path) or os.path.islink(path):
+        return os.lstat(path).st_size
+    total = 0
+    stack = [path]
+    while stack:
+        for entry in os.scandir(stack.pop()):
+            if entry.is_dir(follow_symlinks=False):
+                stack.append(entry.path)
+            else:
+                total += entry.stat(follow_symlinks=False).st_size
+    return total
+
+
+def scan_shared(shared):
+    """Function that lists every artifact in the first level directories of shared as
+    dict(path, id, version, bytes), id and version being None for unversioned names.
+    Hidden directories such as .metadata are left out.
+    """
+
+    artifacts = []
+    for directory in sorted(os.listdir(shared)):
+        top = os.path.join(shared, directory)
+        if directory.startswith('.') or not os.path.isdir(top) or os.path.islink(top):
+            continue
+        for name in sorted(os.listdir(top)):
+            parsed = parse_artifact(name)
+            artifacts.append(dict(
+                path=os.path.join(top, name),
+                id=parsed[0] if parsed else None,
+                version=parsed[1] if parsed else None,
+                bytes=_size(os.path.join(top, name))
+            ))
+    return artifacts
+
+
+def plan_gc(artifacts, installed, rollback_depth=1):
+    """Function that classifies artifacts against the installed package index.
+    Returns dict(reclaim, retained, unclassified) with the artifacts of each kind, and
+    the bytes of each plus the total. retained lists why each artifact is kept.
+    """
+
+    installed_versions = {}
+    for package in installed.values():
+        installed_versions.setdefault(package['id'], set()).add(package['version'])
+
+    by_id = {}
+    for artifact in artifacts:
+        if artifact['id'] in installed_versions:
+            by_id.setdefault(artifact['id'], set()).add(artifact['version'])
+
+    keep = {}
+    for offering_id, versions in by_id.items():
+        current = installed_versions[offering_id]
+        highest = max(current, key=version_key)
+        keep[offering_id] = dict((version, 'installed') for version in current)
+        for installed_version in current:
+            previous = sorted((version for version in versions
+                               if version not in current and version_key(version) < version_key(installed_version)),
+                              key=version_key)
+            for version in previous[max(0, len(previous) - rollback_depth):] if rollback_depth > 0 else []:
+                keep[offering_id][version] = 'rollback'
+        for version in versions:
+            if version not in keep[offering_id] and version_key(version) > version_key(highest):
+                keep[offering_id][version] = 'newer than installed'
+
+    plan = dict(reclaim=[], retained=[], unclassified=[])
+    for artifact in artifacts:
+        if artifact['id'] not in keep:
+            plan['unclassified'].append(artifact)
+        elif artifact['version'] in keep[artifact['id']]:
+            plan['retained'].append(dict(artifact, reason=keep[artifact['id']][artifact['version']]))
+        else:
+            plan['reclaim'].append(artifact)
+
+    for kind in ('reclaim', 'retained', 'unclassified'):
+        plan[kind + '_bytes'] = sum(artifact['bytes'] for artifact in plan[kind])
+    plan['total_bytes'] = plan['reclaim_bytes'] + plan['retained_bytes'] + plan['unclassified_bytes']
+    return plan
@@ -0,0 +1,230 @@
+"""On-host queue that merges concurrent imcl operations into one IM session.
+
+Installation Manager takes an agent lock for every imcl run, so two plays
+installing on the same host at the same time either fail on the lock or wait
+on each other blindly. Instead every request is written to a spool directory
+next to IM's data location:
+
+    <data_location>/.ansible_imcl_queue/<request id>.req   what to run
+    <data_location>/.ansible_imcl_queue/<request id>.res   its outcome
+
+Whoever gets an flock on the spool's leader.lock runs the queue. When other
+requests are already waiting, the leader holds off a short window for more to
+arrive, a lone request runs at once. It then groups pending requests that only
+differ in their packages (same operation, imcl, repositories, dest, shared
+resources, properties and credentials), and runs one imcl call per group with
+all of their packages. Each request gets its own .res file. A merged call that
+fails is retried request by request, so a bad package only fails the play that
+asked for it. Everyone else waits for their .res file, and takes over as leader
+if the leader goes away before it got to them. Requests whose caller has died,
+e.g. killed on an async timeout, are dropped unrun.
+
+author: Tom Davison (@tntdavison784)
+"""
+
+import errno
+import fcntl
+import json
+import os
+import tempfile
+import time
+import uuid
+
+from ansible.module_utils.ibm_process import pid_alive
+
+
+QUEUE_DIR_NAME = '.ansible_imcl_queue'
+TIMEOUT = 2 * 3600
+# Nobody waits on a request longer than TIMEOUT, older ones are dropped.
+MAX_AGE = TIMEOUT
+
+
+def queue_dir(data_location):
+    """Function that returns the spool directory for an IM data location, falling back
+    to one under the user's home when the data location isn't writable.
+    """
+
+    if os.access(data_location, os.W_OK):
+        return os.path.join(data_location, QUEUE_DIR_NAME)
+    return os.path.expanduser(os.path.join('~/.ansible', QUEUE_DIR_NAME))
+
+
+def _write_json(path, data):
+    directory = os.path.dirname(path)
+    fd, tmp_file = tempfile.mkstemp(dir=directory, prefix='.tmp')
+    with os.fdopen(fd, 'w') as f_obj:
+        json.dump(data, f_obj)
+    os.rename(tmp_file, path)
+
+
+def _read_json(path):
+    try:
+        with open(path) as f_obj:
+            return json.load(f_obj)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def _remove(*paths):
+    for path in paths:
+        try:
+            os.unlink(path)
+        except OSError as err:
+            if err.errno != errno.ENOENT:
+                raise
+
+
+def merge_key(request):
+    """Function that returns what must match for two requests to share one imcl call."""
+
+    return json.dumps([request['kind'], request['params']], sort_keys=True)
+
+
+def pending_requests(spool):
+    """Function that returns the requests in the spool that have no outcome yet, oldest first.
+    Requests whose caller is no longer running, or older than MAX_AGE, are dropped.
+    """
+
+    requests = []
+    now = time.time()
+    for entry in os.listdir(spool):
+        path = os.path.join(spool, entry)
+        if entry.endswith('.res'):
+            # Served callers remove their own .res, it may be gone already.
+            try:
+                if now - os.path.getmtime(path) > MAX_AGE:
+                    _remove(path)
+            except OSError:
+                pass
+            continue
+        if not entry.endswith('.req') or os.path.exists(path[:-len('.req')] + '.res'):
+            continue
+        request = _read_json(path)
+        if request is None:
+            continue
+        if now - request['created'] > MAX_AGE or not pid_alive(request['pid']):
+            _remove(path)
+            continue
+        requests.append(request)
+    return sorted(requests, key=lambda request: request['created'])
+
+
+def group_requests(requests):
+    """Function that groups requests by merge_key, keeping the order they arrived in."""
+
+    groups = []
+    by_key = {}
+    for request in requests:
+        key = merge_key(request)
+        if key not in by_key:
+            by_key[key] = []
+            groups.append(by_key[key])
+        by_key[key].append(request)
+    return groups
+
+
+def _run_group(spool, group, execute):
+    packages = []
+    for request in group:
+        packages.extend(package for package in request['packages'] if package not in packages)
+
+    start = time.time()
+    rc, stdout, stderr = execute(group[0]['kind'], group[0]['params'], packages)
+    if rc != 0 and len(group) > 1:
+        for request in group:
+            _run_group(spool, [request], execute)
+        return
+
+    for request in group:
+        _write_json(os.path.join(spool, request['id'] + '.res'), dict(
+            rc=rc, stdout=stdout, stderr=stderr, packages=packages, merged=len(group),
+            elapsed=round(time.time() - start, 3)
+        ))
+
+
+def drain(spool, execute, window):
+    """Function that runs every pending request, as the leader, until the queue is empty.
+    When other requests than the leader's own are waiting, it first gives more a window
+    to arrive. execute(kind, params, packages) runs one imcl call and returns
+    (rc, stdout, stderr).
+    """
+
+    if len(pending_requests(spool)) > 1:
+        time.sleep(window)
+    while True:
+        requests = pending_requests(spool)
+        if not requests:
+            return
+        for group in group_requests(requests):
+            _run_group(spool, group, execute)
+
+
+def queue_lock(spool, timeout=TIMEOUT, poll=0.5):
+    """Function that takes the leader lock of a spool, so no queued imcl operation runs
+    while the caller holds it. Returns the open lock file, closing it releases the lock.
+    """
+
+    if not os.path.isdir(spool):
+        try:
+            os.makedirs(spool, 0o700)
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise
+    deadline = time.time() + timeout
+    lock = open(os.path.join(spool, 'leader.lock'), 'a')
+    while True:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return lock
+        except (IOError, OSError) as err:
+            if err.errno not in (errno.EAGAIN, errno.EACCES):
+                lock.close()
+                raise
+        if time.time() > deadline:
+            lock.close()
+            raise OSError(errno.ETIMEDOUT, 'Timed out waiting for the imcl queue in ' + spool)
+        time.sleep(poll)
+
+
+def submit(spool, kind, params, packages, execute, window=2.0, timeout=TIMEOUT, poll=0.5):
+    """Function that queues one imcl operation and returns its outcome as
+    dict(rc, stdout, stderr, packages, merged, elapsed), packages being everything the
+    imcl call that served it installed and merged the number of requests it served.
+    Whichever caller holds the leader lock runs the queue through execute.
+    """
+
+    if not os.path.isdir(spool):
+        try:
+            os.makedirs(spool, 0o700)
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise
+
+    request = dict(id='{0}-{1}'.format(int(time.time() * 1000), uuid.uuid4().hex[:8]), kind=kind,
+                   params=params, packages=list(packages), created=time.time(), pid=os.getpid())
+    request_file = os.path.join(spool, request['id'] + '.req')
+    result_file = os.path.join(spool, request['id'] + '.res')
+    _write_json(request_file, request)
+
+    deadline = time.time() + timeout
+    with open(os.path.join(spool, 'leader.lock'), 'a') as lock:
+        try:
+            while True:
+                outcome = _read_json(result_file)
+                if outcome is not None:
+                    return outcome
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except (IOError, OSError) as err:
+                    if err.errno not in (errno.EAGAIN, errno.EACCES):
+                        raise
+                    if time.time() > deadline:
+                        raise OSError(errno.ETIMEDOUT, 'Timed out waiting for the imcl queue in ' + spool)
+                    time.sleep(poll)
+                    continue
+                try:
+                    drain(spool, execute, window)
+                finally:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+        finally:
+            _remove(request_file, result_file)
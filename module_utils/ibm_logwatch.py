@@ -0,0 +1,188 @@
+"""Readiness watch for WebSphere JVM logs.
+
+start*.sh blocks until its own coarse status polling gives up or succeeds. With
+-nowait the script returns as soon as the JVM is launched, and readiness is
+instead read from the server's SystemOut.log:
+
+    [10/18/26 9:14:03:127 CDT] 00000001 WsServerImpl  A   WSVR0001I: Server server1 open for e-business
+
+The log is tailed from the offset it had before launch, so earlier runs are
+never matched. New data is waited for with inotify on the log directory, called
+through ctypes, and with short sleeps where inotify isn't available. The first
+error message (a message code ending in E, e.g. WSVR0009E) is kept so a failed
+or slow start can be explained without opening the log.
+
+author: Tom Davison (@tntdavison784)
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import re
+import select
+import time
+
+
+READY_MARKERS = ('WSVR0001I', 'open for e-business')
+ERROR_PATTERN = re.compile(r'\b[A-Z]{4,5}\d{4}E:')
+
+IN_MODIFY = 0x00000002
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+
+def log_offset(path):
+    """Function that returns the current size of a log, 0 when it doesn't exist yet.
+    Taken before launching a JVM so only lines written by this start are read.
+    """
+
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+class LogTail(object):
+    """Incremental reader of a log, returning complete new lines on every read.
+    Follows the log when it is rotated (replaced or truncated) while being read.
+    """
+
+    def __init__(self, path, offset=0):
+        self.path = path
+        self.offset = offset
+        self._file = None
+        self._partial = b''
+
+    def _open(self, offset):
+        try:
+            self._file = open(self.path, 'rb')
+        except (IOError, OSError):
+            return False
+        if os.fstat(self._file.fileno()).st_size < offset:
+            offset = 0
+        self._file.seek(offset)
+        return True
+
+    def _drain(self):
+        data = self._partial + self._file.read()
+        lines = data.split(b'\n')
+        self._partial = lines.pop()
+        return [line.decode('utf-8', 'replace') for line in lines]
+
+    def read_lines(self):
+        """Function that returns the lines appended to the log since the last read."""
+
+        if self._file is None and not self._open(self.offset):
+            return []
+        lines = self._drain()
+
+        try:
+            current = os.stat(self.path)
+        except OSError:
+            return lines
+        if current.st_ino != os.fstat(self._file.fileno()).st_ino or current.st_size < self._file.tell():
+            self._file.close()
+            self._partial = b''
+            if self._open(0):
+                lines.extend(self._drain())
+        return lines
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class _Inotify(object):
+    """inotify watch on a directory through libc, raises OSError where it isn't available."""
+
+    kind = 'inotify'
+
+    def __init__(self, directory):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        try:
+            self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        except AttributeError:
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        if libc.inotify_add_watch(self.fd, directory.encode(), IN_MODIFY | IN_CREATE | IN_MOVED_TO) < 0:
+            err = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(err, 'inotify_add_watch failed for {0}'.format(directory))
+
+    def wait(self, timeout):
+        if select.select([self.fd], [], [], timeout)[0]:
+            try:
+                while os.read(self.fd, 4096):
+                    pass
+            except OSError as err:
+                if err.errno != errno.EAGAIN:
+                    raise
+
+    def close(self):
+        os.close(self.fd)
+
+
+class _Poll(object):
+    """Fallback waiter that sleeps between reads."""
+
+    kind = 'poll'
+
+    def __init__(self, interval):
+        self.interval = interval
+
+    def wait(self, timeout):
+        time.sleep(min(timeout, self.interval))
+
+    def close(self):
+        pass
+
+
+def _waiter(directory, poll_interval):
+    try:
+        return _Inotify(directory)
+    except OSError:
+        return _Poll(poll_interval)
+
+
+def wait_for_ready(log_path, offset, timeout, started=None, alive=None, markers=READY_MARKERS,
+                   poll_interval=0.5):
+    """Function that tails log_path from offset until a ready marker is written.
+    alive, when given, is called between reads and a False answer ends the wait early.
+    Returns dict(state, ready_seconds, ready_line, first_error, log, watch) where state
+    is ready, exited (alive said the process is gone) or timeout. ready_seconds is
+    counted from started, the time the JVM was launched, which defaults to now.
+    """
+
+    started = started or time.time()
+    deadline = started + timeout
+    tail = LogTail(log_path, offset)
+    waiter = _waiter(os.path.dirname(log_path), poll_interval)
+    result = dict(state='timeout', ready_seconds=None, ready_line=None, first_error=None,
+                  log=log_path, watch=waiter.kind)
+
+    try:
+        while True:
+            # Checked before reading, so the lines of a process that just died are still scanned.
+            dead = alive is not None and not alive()
+            for line in tail.read_lines():
+                if result['first_error'] is None and ERROR_PATTERN.search(line):
+                    result['first_error'] = line.strip()
+                if any(marker in line for marker in markers):
+                    result.update(state='ready', ready_line=line.strip(),
+                                  ready_seconds=round(time.time() - started, 3))
+                    return result
+            if dead:
+                result['state'] = 'exited'
+                return result
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return result
+            waiter.wait(min(1.0, remaining))
+    finally:
+        waiter.close()
+        tail.close()
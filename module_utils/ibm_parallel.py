@@ -0,0 +1,54 @@
+"""Bounded worker pool helpers shared by the ibm_* modules.
+
+Modules hand run_parallel a function and a list of items, e.g. profiles,
+servers or IHS instances, and get back one result per item in the same order.
+Worker functions must return their outcome instead of calling
+module.exit_json/fail_json, which can only be done once from the main thread.
+
+author: Tom Davison (@tntdavison784)
+"""
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+def run_parallel(func, items, workers):
+    """Function that runs func over items with at most workers running at once.
+    Returns the results in the same order as items.
+    """
+
+    items = list(items)
+    if not items:
+        return []
+    workers = max(1, min(int(workers), len(items)))
+    if workers == 1:
+        return [func(item) for item in items]
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(func, items))
+
+
+def timed(func, *args, **kwargs):
+    """Function that calls func and returns (result, elapsed seconds)."""
+
+    start = time.time()
+    result = func(*args, **kwargs)
+    return result, round(time.time() - start, 3)
+
+
+class KeyedSemaphore(object):
+    """Hands out one bounded semaphore per key, e.g. per deployment manager host,
+    so work against the same target is throttled while other targets run freely.
+    """
+
+    def __init__(self, limit=1):
+        self.limit = max(1, int(limit))
+        self._lock = threading.Lock()
+        self._semaphores = {}
+
+    def __call__(self, key):
+        with self._lock:
+            if key not in self._semaphores:
+                self._semaphores[key] = threading.BoundedSemaphore(self.limit)
+            return self._semaphores[key]
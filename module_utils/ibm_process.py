@@ -0,0 +1,185 @@
+"""PID file index for WebSphere JVMs.
+
+Every WebSphere process writes its pid to a known place under its profile,
+<profile_root>/logs/<server>/<server>.pid, and removes it on a clean stop. The
+helpers here only ever look at those locations instead of searching the profile
+tree, and don't trust a pid file on its own: the pid has to belong to a live
+process, checked through /proc/<pid>/cmdline, before a server counts as running.
+A pid file left behind by a crashed JVM, or whose pid was since reused by
+another program, is reported as stale.
+
+jvm_status() builds on that to answer "is this server up" in milliseconds,
+without serverStatus.sh: pid file, /proc, and optionally a short TCP connect to
+one of the server's ports. child_pids() lists the live children of a process, which
+ibm_ihs uses to watch httpd worker generations roll over.
+
+author: Tom Davison (@tntdavison784)
+"""
+
+import errno
+import os
+import socket
+
+
+def read_pid(pid_file):
+    """Function that returns the pid stored in pid_file, or None if there is no usable pid."""
+
+    try:
+        with open(pid_file) as f_obj:
+            return int(f_obj.read().strip().split()[0])
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
+
+def process_cmdline(pid):
+    """Function that returns the argv of a running process, or None if it isn't running.
+    Falls back to a signal 0 probe, with an empty argv, where there is no /proc.
+    """
+
+    try:
+        with open('/proc/{0}/cmdline'.format(pid), 'rb') as f_obj:
+            cmdline = f_obj.read()
+    except (IOError, OSError):
+        if os.path.isdir('/proc/self'):
+            return None
+        try:
+            os.kill(pid, 0)
+        except OSError as err:
+            if err.errno != errno.EPERM:
+                return None
+        return []
+
+    # Zombies and kernel threads have an empty cmdline.
+    if not cmdline:
+        return None
+    return [arg.decode('utf-8', 'replace') for arg in cmdline.split(b'\0') if arg]
+
+
+def pid_alive(pid, match=None):
+    """Function that checks pid belongs to a live process.
+    When match is given, one of the process arguments must contain it as well,
+    e.g. 'java', so a recycled pid isn't mistaken for the original process.
+    """
+
+    if pid is None:
+        return False
+    argv = process_cmdline(pid)
+    if argv is None:
+        return False
+    if match is None or argv == []:
+        return True
+    return any(match in arg for arg in argv)
+
+
+def server_pid_file(profile_root, server):
+    """Function that returns the pid file location of a server in a profile."""
+
+    return os.path.join(profile_root, 'logs', server, server + '.pid')
+
+
+def server_status(profile_root, server, match='java'):
+    """Function that returns the pid file state of one server as a dict with
+    server, pid_file, pid and state, where state is running, stale or stopped.
+    """
+
+    pid_file = server_pid_file(profile_root, server)
+    pid = read_pid(pid_file)
+    if pid is None and not os.path.exists(pid_file):
+        state = 'stopped'
+    elif pid_alive(pid, match):
+        state = 'running'
+    else:
+        state = 'stale'
+    return dict(server=server, pid_file=pid_file, pid=pid, state=state)
+
+
+def scan_pid_files(profile_root, match='java'):
+    """Function that returns server_status for every server with a pid file in the profile.
+    Only logs/<server>/<server>.pid is looked at, never the rest of the profile tree.
+    """
+
+    logs = os.path.join(profile_root, 'logs')
+    try:
+        servers = sorted(os.listdir(logs))
+    except OSError:
+        return []
+    return [server_status(profile_root, server, match) for server in servers
+            if os.path.exists(server_pid_file(profile_root, server))]
+
+
+def running_servers(profile_root, match='java'):
+    """Function that returns server_status for every server in the profile that is running."""
+
+    return [status for status in scan_pid_files(profile_root, match) if status['state'] == 'running']
+
+
+def port_open(host, port, timeout=1.0):
+    """Function that checks whether something accepts TCP connections on host:port."""
+
+    try:
+        connection = socket.create_connection((host, int(port)), timeout)
+    except (socket.error, socket.timeout, ValueError):
+        return False
+    connection.close()
+    return True
+
+
+def jvm_status(profile_root, server, host=None, port=None, timeout=1.0):
+    """Function that returns the state of a server's JVM without starting another JVM:
+        STOPPED   no pid file
+        STALE_PID pid file left behind, no live java process behind it
+        HUNG      the java process is alive but port doesn't accept connections
+        STARTED   the java process is alive (and port accepts connections when given)
+    """
+
+    status = server_status(profile_root, server)
+    result = dict(server=server, pid=status['pid'], pid_file=status['pid_file'])
+    if status['state'] == 'stopped':
+        result['state'] = 'STOPPED'
+    elif status['state'] == 'stale':
+        result['state'] = 'STALE_PID'
+    elif port is not None:
+        result.update(host=host, port=port)
+        result['state'] = 'STARTED' if port_open(host, port, timeout) else 'HUNG'
+    else:
+        result['state'] = 'STARTED'
+    return result
+
+
+def _read_stat(pid):
+    """Function that returns (command name, fields after it) from /proc/<pid>/stat, or None."""
+
+    try:
+        with open('/proc/{0}/stat'.format(pid)) as f_obj:
+            # The command name may hold spaces and parentheses, the fields after it don't.
+            head, tail = f_obj.read().rsplit(')', 1)
+    except (IOError, OSError, ValueError):
+        return None
+    return head.split('(', 1)[-1], tail.split()
+
+
+def child_pids(pid, same_command=False):
+    """Function that returns the pids of the live children of pid, read from /proc/<pid>/stat.
+    With same_command, only children running the parent's command are returned, e.g. the
+    httpd workers but not piped loggers or other helpers httpd started.
+    Returns an empty list where there is no /proc.
+    """
+
+    children = []
+    try:
+        entries = os.listdir('/proc')
+    except OSError:
+        return children
+    parent = _read_stat(pid) if same_command else None
+    if same_command and parent is None:
+        return children
+    for entry in entries:
+        if not entry.isdigit():
+            continue
+        stat = _read_stat(entry)
+        if stat is None or len(stat[1]) < 2:
+            continue
+        command, fields = stat
+        if fields[1] == str(pid) and fields[0] != 'Z' and (parent is None or command == parent[0]):
+            children.append(int(entry))
+    return sorted(children)
@@ -0,0 +1,85 @@
+"""Reader for the WebSphere profile registry.
+
+Every profile created by manageprofiles is recorded in
+<WAS_ROOT>/properties/profileRegistry.xml:
+
+    <profiles>
+      <profile isAWSProfile="true" isDefault="true" name="AppSrv01"
+               path="/opt/IBM/WebSphere/AppServer/profiles/AppSrv01"
+               template="/opt/IBM/WebSphere/AppServer/profileTemplates/default">
+        <augmentor template="..."/>
+      </profile>
+    </profiles>
+
+Reading it directly answers "does this profile exist" without starting the
+manageprofiles JVM. The parsed registry is kept in the install's shared fact
+cache, stamped on profileRegistry.xml, and memoized for the module run; callers
+that create or delete profiles call forget() afterwards.
+
+author: Tom Davison (@tntdavison784)
+"""
+
+import os
+
+from ansible.module_utils.ibm_cache import fact_cache
+
+try:
+    from xml.etree import cElementTree as etree
+except ImportError:
+    from xml.etree import ElementTree as etree
+
+
+_REGISTRY = {}
+
+
+def profile_registry_path(was_root):
+    """Function that returns the path of profileRegistry.xml for a WAS install root."""
+
+    return os.path.join(was_root, 'properties', 'profileRegistry.xml')
+
+
+def read_profile_registry(was_root):
+    """Function that returns the profile records of a WAS install as a dict of
+    profile name -> dict(name, path, template, is_default, augmentors).
+    Returns None when the install has no profile registry to read.
+    Raises ValueError when profileRegistry.xml can't be parsed, e.g. when it is truncated.
+    """
+
+    if was_root in _REGISTRY:
+        return _REGISTRY[was_root]
+
+    registry = profile_registry_path(was_root)
+    if not os.path.isfile(registry):
+        return None
+
+    def build():
+        profiles = {}
+        try:
+            root = etree.parse(registry).getroot()
+        except SyntaxError as err:
+            raise ValueError("Can not parse {0}: {1}".format(registry, err))
+        for profile in root.iter('profile'):
+            profiles[profile.get('name')] = dict(
+                name=profile.get('name'),
+                path=profile.get('path'),
+                template=profile.get('template'),
+                is_default=profile.get('isDefault', 'false').lower() == 'true',
+                augmentors=[augmentor.get('template') for augmentor in profile.findall('augmentor')]
+            )
+        return profiles
+
+    profiles = fact_cache(was_root).get('ibm_profiles:{0}'.format(registry), [registry], build)
+    _REGISTRY[was_root] = profiles
+    return profiles
+
+
+def get_profile(was_root, name):
+    """Function that returns the record of the profile with exactly this name, or None."""
+
+    return (read_profile_registry(was_root) or {}).get(name)
+
+
+def forget(was_root):
+    """Function that drops the memoized registry so the next lookup re-reads it."""
+
+    _REGISTRY.pop(was_root, None)
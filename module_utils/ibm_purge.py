@@ -0,0 +1,131 @@
+"""Parallel deletion engine for large directory trees.
+
+Directories are first renamed to a tombstone next to where they lived, which is
+a single metadata operation, so whatever uses the original path can carry on
+straight away. The tombstone is then walked with os.scandir and its files are
+unlinked across a bounded thread pool, directories are removed bottom up once
+they are empty.
+
+author: Tom Davison (@tntdavison784)
+"""
+
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+TOMBSTONE_MARKER = '.ansible-tombstone-'
+
+
+def tombstone(path):
+    """Function that renames path to a tombstone next to it and returns the tombstone path.
+    Returns None if path doesn't exist.
+    """
+
+    if not os.path.lexists(path):
+        return None
+    parent, name = os.path.split(path.rstrip('/'))
+    grave = os.path.join(parent, '{0}{1}{2}'.format(name, TOMBSTONE_MARKER, int(time.time() * 1000)))
+    os.rename(path, grave)
+    return grave
+
+
+def find_tombstones(parent):
+    """Function that returns tombstones left in parent by runs that didn't finish purging."""
+
+    try:
+        return [os.path.join(parent, name) for name in os.listdir(parent) if TOMBSTONE_MARKER in name]
+    except OSError:
+        return []
+
+
+def _scan(path, files, dirs, errors):
+    """Function that collects every file (with its size) and directory under path, bottom up.
+    Directories that can't be read are added to errors, and left for their rmdir to report.
+    """
+
+    stack = [path]
+    while stack:
+        directory = stack.pop()
+        dirs.append(directory)
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    else:
+                        try:
+                            size = entry.stat(follow_symlinks=False).st_size
+                        except OSError:
+                            size = 0
+                        files.append((entry.path, size))
+        except OSError as err:
+            errors.append('{0}: {1}'.format(directory, err.strerror))
+
+
+def _unlink_batch(batch):
+    removed, reclaimed, errors = 0, 0, []
+    for path, size in batch:
+        try:
+            os.unlink(path)
+            removed += 1
+            reclaimed += size
+        except OSError as err:
+            errors.append('{0}: {1}'.format(path, err.strerror))
+    return removed, reclaimed, errors
+
+
+def purge(paths, workers=8, batch_size=512):
+    """Function that deletes every tree in paths with a bounded worker pool.
+    Returns stats with files and bytes reclaimed, the elapsed time and any errors.
+    """
+
+    start = time.time()
+    stats = dict(files=0, bytes=0, dirs=0, errors=[])
+    files, dirs = [], []
+    for path in paths:
+        if os.path.isdir(path) and not os.path.islink(path):
+            _scan(path, files, dirs, stats['errors'])
+        elif os.path.lexists(path):
+            files.append((path, os.lstat(path).st_size))
+
+    batches = [files[index:index + batch_size] for index in range(0, len(files), batch_size)]
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        for removed, reclaimed, errors in executor.map(_unlink_batch, batches):
+            stats['files'] += removed
+            stats['bytes'] += reclaimed
+            stats['errors'].extend(errors)
+
+    # Deeper directories were scanned later, so removing in reverse empties children first.
+    for directory in reversed(dirs):
+        try:
+            os.rmdir(directory)
+            stats['dirs'] += 1
+        except OSError as err:
+            stats['errors'].append('{0}: {1}'.format(directory, err.strerror))
+
+    stats['errors'] = stats['errors'][:20]
+    stats['elapsed'] = round(time.time() - start, 3)
+    return stats
+
+
+def purge_in_background(paths, workers=8):
+    """Function that forks a detached process to purge paths and returns straight away.
+    The child is double forked so it outlives the module and is never left as a zombie.
+    """
+
+    pid = os.fork()
+    if pid:
+        os.waitpid(pid, 0)
+        return
+
+    try:
+        os.setsid()
+        if os.fork():
+            os._exit(0)
+        devnull = os.open(os.devnull, os.O_RDWR)
+        for fd in (0, 1, 2):
+            os.dup2(devnull, fd)
+        purge(paths, workers)
+    finally:
+        os._exit(0)
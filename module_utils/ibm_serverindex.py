@@ -0,0 +1,162 @@
+"""Endpoint index built from a profile's serverindex.xml files.
+
+Every node in a cell has config/cells/<cell>/nodes/<node>/serverindex.xml listing
+the servers defined on it, their type and their endpoints:
+
+    <serverindex:ServerIndex hostName="was01.example.com" ...>
+      <serverEntries serverName="server1" serverType="APPLICATION_SERVER" ...>
+        <specialEndpoints endPointName="SOAP_CONNECTOR_ADDRESS">
+          <endPoint host="was01.example.com" port="8880"/>
+        </specialEndpoints>
+      </serverEntries>
+    </serverindex:ServerIndex>
+
+All serverindex.xml files of a profile are stream parsed into one index of
+node -> server -> endpoint, which is cached on the host and stamped with the
+mtime of every file it was built from in the profile's shared fact cache, so port lookups for readiness checks and
+probes cost a stat per node until the configuration changes. A federated
+profile carries copies of every node's configuration, the local node is taken
+from the profile's bin/setupCmdLine.sh.
+
+author: Tom Davison (@tntdavison784)
+"""
+
+import glob
+import os
+
+from ansible.module_utils.ibm_cache import fact_cache
+
+try:
+    from lxml import etree
+    HAS_LXML = True
+except ImportError:
+    from xml.etree import ElementTree as etree
+    HAS_LXML = False
+
+
+_INDEX = {}
+
+
+def profile_identity(profile_root):
+    """Function that returns (cell, node) of a profile from its bin/setupCmdLine.sh.
+    Either value is None when it can't be found.
+    """
+
+    identity = dict(WAS_CELL=None, WAS_NODE=None)
+    try:
+        with open(os.path.join(profile_root, 'bin', 'setupCmdLine.sh')) as f_obj:
+            for line in f_obj:
+                name, _, value = line.strip().partition('=')
+                if name in identity and value:
+                    identity[name] = value.strip('"\'')
+    except IOError:
+        pass
+    return identity['WAS_CELL'], identity['WAS_NODE']
+
+
+def serverindex_files(profile_root, node=None):
+    """Function that returns the serverindex.xml files of a profile, only the given
+    node's when node is given.
+    """
+
+    return sorted(glob.glob(os.path.join(profile_root, 'config', 'cells', '*', 'nodes',
+                                         node or '*', 'serverindex.xml')))
+
+
+def _local_name(tag):
+    return tag.rsplit('}', 1)[-1] if isinstance(tag, str) else None
+
+
+def parse_serverindex(path):
+    """Function that stream parses one serverindex.xml into
+    dict(host, servers={server: dict(type, endpoints={name: dict(host, port)})}).
+    Wildcard endpoint hosts are replaced with the node's host name.
+    """
+
+    node = dict(host=None, servers={})
+    for event, elem in etree.iterparse(path, events=('start', 'end')):
+        name = _local_name(elem.tag)
+        if event == 'start':
+            if name == 'ServerIndex':
+                node['host'] = elem.get('hostName')
+            continue
+        if name != 'serverEntries':
+            continue
+
+        endpoints = {}
+        for special in elem.iter('specialEndpoints'):
+            endpoint = special.find('endPoint')
+            if endpoint is None or endpoint.get('port') is None:
+                continue
+            host = endpoint.get('host')
+            if host in (None, '', '*'):
+                host = node['host'] or 'localhost'
+            endpoints[special.get('endPointName')] = dict(host=host, port=int(endpoint.get('port')))
+        node['servers'][elem.get('serverName')] = dict(type=elem.get('serverType'), endpoints=endpoints)
+        elem.clear()
+    return node
+
+
+def endpoint_index(profile_root, cache=None):
+    """Function that returns the endpoint index of every node in the profile's
+    configuration as node -> dict(host, servers). The index is cached on the host and
+    rebuilt only when a serverindex.xml is changed, added or removed.
+    """
+
+    if profile_root in _INDEX:
+        return _INDEX[profile_root]
+
+    files = serverindex_files(profile_root)
+
+    def build():
+        return dict((path.split(os.sep)[-2], parse_serverindex(path)) for path in files)
+
+    index = (cache or fact_cache(profile_root)).get('ibm_serverindex:{0}'.format(profile_root), files, build)
+    _INDEX[profile_root] = index
+    return index
+
+
+def _node_servers(profile_root, node=None):
+    """Function that returns the servers of a node from the index, the profile's own node
+    by default, or of every node when the profile's node can't be worked out.
+    """
+
+    if node is None:
+        node = profile_identity(profile_root)[1]
+    index = endpoint_index(profile_root)
+    if node is not None:
+        return index.get(node, {}).get('servers', {})
+
+    servers = {}
+    for entry in index.values():
+        servers.update(entry['servers'])
+    return servers
+
+
+def query_endpoints(profile_root, server=None, node=None):
+    """Function that returns server -> endpoint name -> dict(host, port) for a node,
+    the profile's own node by default. With server, only that server's endpoints.
+    """
+
+    servers = _node_servers(profile_root, node)
+    if server is not None:
+        return servers.get(server, {}).get('endpoints', {})
+    return dict((name, entry['endpoints']) for name, entry in servers.items())
+
+
+def list_servers(profile_root, server_type='APPLICATION_SERVER'):
+    """Function that returns the names of the servers of server_type defined on the
+    profile's own node, e.g. every application server for server_name: all.
+    """
+
+    servers = _node_servers(profile_root)
+    return sorted(name for name, entry in servers.items()
+                  if server_type is None or entry['type'] == server_type)
+
+
+def server_endpoints(profile_root, server):
+    """Function that returns the endpoints of a server on the profile's own node as a
+    dict of endpoint name -> dict(host, port).
+    """
+
+    return query_endpoints(profile_root, server)